@@ -0,0 +1,119 @@
+"""Сравнение скорости JSON-форматтеров логов: записей в секунду.
+
+Запуск из корня репозитория:
+
+    PYTHONPATH=. python benchmarks/bench_log_format.py
+"""
+
+import json
+import logging
+import time
+import uuid
+from datetime import datetime
+
+from common import log_format
+from common.log_format import JSONFormatter
+
+RECORDS = 50000
+
+
+# Форматтер, который раньше был скопирован в каждый сервис
+class LegacyJSONFormatter(logging.Formatter):
+    def format(self, record):
+        log_entry = {
+            "timestamp": datetime.utcfromtimestamp(record.created).strftime(
+                "%Y-%m-%dT%H:%M:%SZ"
+            ),
+            "level": record.levelname,
+            "logger": record.name,
+            "message": record.getMessage(),
+            "module": record.module,
+            "function": record.funcName,
+            "line": record.lineno,
+        }
+
+        for key, value in record.__dict__.items():
+            if key not in (
+                "asctime",
+                "created",
+                "filename",
+                "funcName",
+                "levelname",
+                "levelno",
+                "lineno",
+                "module",
+                "msecs",
+                "msg",
+                "name",
+                "pathname",
+                "process",
+                "processName",
+                "relativeCreated",
+                "thread",
+                "threadName",
+            ):
+                if key not in log_entry:
+                    log_entry[key] = value
+
+        return json.dumps(log_entry, ensure_ascii=False)
+
+
+def make_records(count):
+    logger = logging.getLogger("calculator")
+    records = []
+    for i in range(count):
+        record = logger.makeRecord(
+            "calculator",
+            logging.INFO,
+            __file__,
+            42,
+            "IP — частный",
+            None,
+            None,
+            func="_is_public_ip",
+            extra={
+                "request": "IP_CHECK",
+                "client_ip": f"172.20.0.{i % 250}",
+                "public_ip": "N/A",
+                "response_status": "200",
+                "prefix": "172.",
+                "request_id": str(uuid.uuid4()),
+            },
+        )
+        records.append(record)
+    return records
+
+
+def bench(name, formatter, records):
+    start = time.perf_counter()
+    for record in records:
+        formatter.format(record)
+    elapsed = time.perf_counter() - start
+    print(f"{name:<28} {len(records) / elapsed:>12,.0f} записей/с")
+
+
+def main():
+    records = make_records(RECORDS)
+    bench("legacy (json, кортеж)", LegacyJSONFormatter(), records)
+    bench(
+        "common.log_format + json",
+        JSONFormatter(static_fields={"service": "calculator"}, backend="json"),
+        records,
+    )
+    bench(
+        "common.log_format ecs (auto)",
+        JSONFormatter(static_fields={"service": "calculator"}, schema="ecs"),
+        records,
+    )
+    if log_format.orjson is not None:
+        bench(
+            "common.log_format + orjson",
+            JSONFormatter(static_fields={"service": "calculator"}, backend="auto"),
+            records,
+        )
+    else:
+        print("orjson не установлен — вариант с orjson пропущен")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1 @@
+"""Общий код HTTP-сервисов (calculator, gallery, geoservice, weather_service)"""
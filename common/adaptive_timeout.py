@@ -0,0 +1,225 @@
+import concurrent.futures
+import math
+import os
+import threading
+import time
+
+from common import metrics
+
+# --- Таймауты upstream по наблюдаемой задержке ---
+# Для каждого upstream — компактная гистограмма задержек (логарифмические
+# корзины по 10%, ~120 счётчиков от 1 мс до 2 минут) за два последних окна
+# ADAPTIVE_WINDOW. Из неё считаются перцентили:
+#   таймаут        = p99 * ADAPTIVE_TIMEOUT_MULTIPLIER в пределах [floor, ceiling];
+#   задержка хеджа = p95 в пределах [ADAPTIVE_HEDGE_FLOOR, таймаут] — через
+#                    столько стоит отправить дублирующий запрос.
+# Пока замеров меньше ADAPTIVE_MIN_SAMPLES, таймаут — ceiling (прежний
+# статический). Ошибка у самого таймаута тоже замер: если upstream стал
+# медленным, перцентили растут, и таймаут поднимается до ceiling, а не
+# обрывает все запросы на старом p99.
+#
+#   DADATA_LATENCY = adaptive_timeout.tracker("dadata", ceiling=5)
+#   timeout = DADATA_LATENCY.timeout()
+#   with DADATA_LATENCY.measure(timeout):
+#       response = pool.request(..., timeout=timeout)
+
+ADAPTIVE_WINDOW = float(os.getenv("ADAPTIVE_WINDOW", "60"))
+ADAPTIVE_MIN_SAMPLES = int(os.getenv("ADAPTIVE_MIN_SAMPLES", "20"))
+ADAPTIVE_TIMEOUT_MULTIPLIER = float(os.getenv("ADAPTIVE_TIMEOUT_MULTIPLIER", "1.5"))
+ADAPTIVE_TIMEOUT_FLOOR = float(os.getenv("ADAPTIVE_TIMEOUT_FLOOR", "0.25"))
+ADAPTIVE_HEDGE_FLOOR = float(os.getenv("ADAPTIVE_HEDGE_FLOOR", "0.05"))
+
+_MIN_LATENCY = 0.001
+_GROWTH = 1.1
+_LOG_GROWTH = math.log(_GROWTH)
+_BUCKETS = int(math.log(120 / _MIN_LATENCY) / _LOG_GROWTH) + 2
+# Ошибка позже этой доли таймаута считается срабатыванием таймаута
+_TIMEOUT_SLACK = 0.9
+
+ADAPTIVE_TIMEOUT = metrics.gauge(
+    "adaptive_timeout_seconds", "Текущий таймаут вызова upstream", ("upstream",)
+)
+ADAPTIVE_HEDGE_DELAY = metrics.gauge(
+    "adaptive_hedge_delay_seconds",
+    "Через сколько отправляется дублирующий запрос к upstream",
+    ("upstream",),
+)
+ADAPTIVE_LATENCY = metrics.gauge(
+    "adaptive_latency_seconds",
+    "Перцентили задержки upstream за последние окна",
+    ("upstream", "quantile"),
+)
+HEDGED_REQUESTS = metrics.counter(
+    "hedged_requests_total", "Дублирующие запросы к upstream", ("upstream",)
+)
+
+
+def _bucket(seconds):
+    if seconds <= _MIN_LATENCY:
+        return 0
+    return min(_BUCKETS - 1, int(math.log(seconds / _MIN_LATENCY) / _LOG_GROWTH) + 1)
+
+
+def _upper_bound(index):
+    return _MIN_LATENCY * _GROWTH**index
+
+
+class LatencyTracker:
+    """Скользящие перцентили задержки одного upstream"""
+
+    def __init__(
+        self,
+        name,
+        ceiling,
+        floor=ADAPTIVE_TIMEOUT_FLOOR,
+        multiplier=ADAPTIVE_TIMEOUT_MULTIPLIER,
+        window=ADAPTIVE_WINDOW,
+        min_samples=ADAPTIVE_MIN_SAMPLES,
+    ):
+        self.name = name
+        self.ceiling = ceiling
+        self.floor = min(floor, ceiling)
+        self.multiplier = multiplier
+        self.window = window
+        self.min_samples = min_samples
+        # Текущее и предыдущее окно: перцентили — по обоим, так что после
+        # смены окна история не обнуляется
+        self._current = [0] * _BUCKETS
+        self._previous = [0] * _BUCKETS
+        self._rotated_at = time.monotonic()
+        self._lock = threading.Lock()
+        os.register_at_fork(after_in_child=self._after_fork_child)
+        ADAPTIVE_TIMEOUT.labels(name).set_function(self.timeout)
+        ADAPTIVE_HEDGE_DELAY.labels(name).set_function(self.hedge_delay)
+        for q in (0.5, 0.99):
+            ADAPTIVE_LATENCY.labels(name, str(q)).set_function(
+                lambda q=q: self.percentile(q) or 0.0
+            )
+
+    def _after_fork_child(self):
+        # Замеры родителя — разумный старт; замок мог остаться занятым
+        self._lock = threading.Lock()
+
+    def _rotate(self, now):
+        elapsed = now - self._rotated_at
+        if elapsed < self.window:
+            return
+        if elapsed < 2 * self.window:
+            self._previous = self._current
+        else:
+            # Запросов не было дольше двух окон — старые замеры не в счёт
+            self._previous = [0] * _BUCKETS
+        self._current = [0] * _BUCKETS
+        self._rotated_at = now
+
+    def observe(self, seconds):
+        index = _bucket(seconds)
+        with self._lock:
+            self._rotate(time.monotonic())
+            self._current[index] += 1
+
+    def percentile(self, q):
+        """Верхняя граница корзины перцентиля q или None, если замеров мало"""
+        with self._lock:
+            self._rotate(time.monotonic())
+            counts = [a + b for a, b in zip(self._current, self._previous)]
+        total = sum(counts)
+        if total < self.min_samples:
+            return None
+        rank = q * total
+        seen = 0
+        for index, count in enumerate(counts):
+            seen += count
+            if seen >= rank:
+                return _upper_bound(index)
+        return _upper_bound(_BUCKETS - 1)
+
+    def timeout(self):
+        p99 = self.percentile(0.99)
+        if p99 is None:
+            return self.ceiling
+        return min(self.ceiling, max(self.floor, p99 * self.multiplier))
+
+    def hedge_delay(self):
+        timeout = self.timeout()
+        p95 = self.percentile(0.95)
+        if p95 is None:
+            return min(ADAPTIVE_HEDGE_FLOOR, timeout)
+        return min(timeout, max(ADAPTIVE_HEDGE_FLOOR, p95))
+
+    def measure(self, timeout):
+        """with tracker.measure(timeout): замер вызова с этим таймаутом"""
+        return _Measure(self, timeout)
+
+
+class _Measure:
+    __slots__ = ("tracker", "timeout", "start")
+
+    def __init__(self, tracker, timeout):
+        self.tracker = tracker
+        self.timeout = timeout
+
+    def __enter__(self):
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        elapsed = time.perf_counter() - self.start
+        # Быстрая ошибка (отказ в соединении, 4xx) о задержке ничего не говорит
+        if exc_type is None or elapsed >= self.timeout * _TIMEOUT_SLACK:
+            self.tracker.observe(elapsed)
+        return False
+
+
+_trackers = {}
+_trackers_lock = threading.Lock()
+
+
+def tracker(name, ceiling, **kwargs):
+    """Общий трекер процесса для upstream name"""
+    latency = _trackers.get(name)
+    if latency is None:
+        with _trackers_lock:
+            latency = _trackers.get(name)
+            if latency is None:
+                latency = LatencyTracker(name, ceiling, **kwargs)
+                _trackers[name] = latency
+    return latency
+
+
+def first_result(executor, calls, tracker, timeout=None):
+    """Первый непустой результат calls с хеджированием.
+
+    calls — функции без аргументов, опрашивающие равноценные upstream.
+    Следующая запускается, если предыдущие не ответили за
+    tracker.hedge_delay() или ответили пусто. Общий предел ожидания —
+    timeout (по умолчанию tracker.timeout()). None — никто не ответил.
+    """
+    timeout = tracker.timeout() if timeout is None else timeout
+    hedge_delay = tracker.hedge_delay()
+    deadline = time.monotonic() + timeout
+    pending = set()
+    calls = list(calls)
+    for position, call in enumerate(calls):
+        if position:
+            HEDGED_REQUESTS.labels(tracker.name).inc()
+        pending.add(executor.submit(call))
+        last = position == len(calls) - 1
+        # Ждём ответа; пустой ответ — сразу к следующему upstream
+        while pending:
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                return None
+            done, pending = concurrent.futures.wait(
+                pending,
+                timeout=remaining if last else min(hedge_delay, remaining),
+                return_when=concurrent.futures.FIRST_COMPLETED,
+            )
+            if not done:
+                break  # хедж: пора запускать следующий
+            for future in done:
+                if future.exception() is None and future.result():
+                    return future.result()
+            if not last:
+                break
+    return None
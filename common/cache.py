@@ -0,0 +1,102 @@
+import collections
+import ipaddress
+import threading
+import time
+
+from common import metrics
+
+# --- Ограниченный кэш с TTL и вытеснением по LRU ---
+# Для ответов внешних API, которые меняются редко (город по IP и т.п.).
+# Неудачные ответы кладутся с коротким negative_ttl, чтобы при сбое
+# upstream не ходить в него на каждый запрос, но и не помнить ошибку долго.
+# stale_ttl — сколько ещё держать истёкшее удачное значение: get() его уже
+# не отдаёт, а get_stale() отдаёт, когда upstream недоступен.
+# Попадания и промахи — в cache_requests_total{cache=name}.
+
+_MISSING = object()
+
+
+class TTLCache:
+    def __init__(self, name, maxsize, ttl, negative_ttl=None, stale_ttl=0):
+        self.name = name
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self.negative_ttl = ttl if negative_ttl is None else negative_ttl
+        self.stale_ttl = stale_ttl
+        # key -> (истекает, значение, хранить до)
+        self._items = collections.OrderedDict()
+        self._lock = threading.Lock()
+        metrics.CACHE_ENTRIES.labels(name).set_function(lambda: len(self._items))
+
+    def __len__(self):
+        return len(self._items)
+
+    def get(self, key, default=None):
+        now = time.monotonic()
+        with self._lock:
+            item = self._items.get(key, _MISSING)
+            if item is not _MISSING:
+                if item[0] > now:
+                    self._items.move_to_end(key)
+                else:
+                    if item[2] <= now:
+                        del self._items[key]
+                    item = _MISSING
+        if item is _MISSING:
+            metrics.cache_miss(self.name)
+            return default
+        metrics.cache_hit(self.name)
+        return item[1]
+
+    def get_stale(self, key, default=None):
+        """Удачное значение, в том числе истёкшее, но не старше stale_ttl"""
+        with self._lock:
+            item = self._items.get(key)
+        if item is None or item[2] <= time.monotonic():
+            return default
+        return item[1]
+
+    def set(self, key, value, ttl=None, stale=True):
+        expires = time.monotonic() + (self.ttl if ttl is None else ttl)
+        keep_until = expires + self.stale_ttl if stale else expires
+        with self._lock:
+            self._items[key] = (expires, value, keep_until)
+            self._items.move_to_end(key)
+            while len(self._items) > self.maxsize:
+                self._items.popitem(last=False)
+
+    def extend(self, key, ttl):
+        """Продлевает свежесть записи на ttl, не трогая срок хранения.
+
+        Для устаревшего значения, отданного вместо ошибки: повторная
+        попытка откладывается, но дольше stale_ttl запись не живёт.
+        """
+        now = time.monotonic()
+        with self._lock:
+            item = self._items.get(key)
+            if item is None or item[2] <= now:
+                return False
+            self._items[key] = (min(now + ttl, item[2]), item[1], item[2])
+            return True
+
+    def set_negative(self, key, value):
+        self.set(key, value, self.negative_ttl, stale=False)
+
+    def clear(self):
+        with self._lock:
+            self._items.clear()
+
+
+def ip_prefix_key(ip, ipv4_prefix=24, ipv6_prefix=48):
+    """Ключ кэша по подсети: 203.0.113.7 -> 203.0.113.0/24.
+
+    Некорректный адрес возвращается как есть.
+    """
+    try:
+        address = ipaddress.ip_address(ip)
+    except ValueError:
+        return ip
+    if address.version == 6 and address.ipv4_mapped is not None:
+        address = address.ipv4_mapped
+    prefix = ipv4_prefix if address.version == 4 else ipv6_prefix
+    return str(ipaddress.ip_network(f"{address}/{prefix}", strict=False))
@@ -0,0 +1,167 @@
+import collections
+import os
+import threading
+import time
+
+from common import metrics
+
+# --- Размыкатель цепи для внешних зависимостей ---
+# closed    — запросы идут в upstream, результаты копятся в окне;
+# open      — upstream считается лежащим: allow() сразу False, вызывающий
+#             отдаёт запасной ответ без ожидания таймаута;
+# half_open — по истечении BREAKER_OPEN_SECONDS пропускается пробный запрос:
+#             успех замыкает цепь, ошибка снова размыкает.
+#
+# Цепь размыкается после BREAKER_CONSECUTIVE_FAILURES ошибок подряд (при
+# малом трафике окно не успевает набраться) или когда в окне
+# BREAKER_WINDOW секунд не меньше BREAKER_MIN_REQUESTS вызовов и доля
+# ошибок достигла BREAKER_FAILURE_RATE.
+#
+#   if not breaker.allow():
+#       return fallback()
+#   try:
+#       result = call()
+#   except Exception:
+#       breaker.record_failure()
+#       raise
+#   breaker.record_success()
+
+BREAKER_FAILURE_RATE = float(os.getenv("BREAKER_FAILURE_RATE", "0.5"))
+BREAKER_MIN_REQUESTS = int(os.getenv("BREAKER_MIN_REQUESTS", "10"))
+BREAKER_CONSECUTIVE_FAILURES = int(os.getenv("BREAKER_CONSECUTIVE_FAILURES", "5"))
+BREAKER_WINDOW = float(os.getenv("BREAKER_WINDOW", "30"))
+BREAKER_OPEN_SECONDS = float(os.getenv("BREAKER_OPEN_SECONDS", "15"))
+
+CLOSED = "closed"
+OPEN = "open"
+HALF_OPEN = "half_open"
+STATE_VALUES = {CLOSED: 0, OPEN: 1, HALF_OPEN: 2}
+
+BREAKER_STATE = metrics.gauge(
+    "circuit_breaker_state",
+    "Состояние размыкателя: 0 — closed, 1 — open, 2 — half_open",
+    ("name",),
+)
+BREAKER_REJECTED = metrics.counter(
+    "circuit_breaker_rejected_total",
+    "Вызовы, не отправленные в upstream из-за разомкнутой цепи",
+    ("name",),
+)
+BREAKER_TRANSITIONS = metrics.counter(
+    "circuit_breaker_transitions_total", "Смены состояния размыкателя", ("name", "state")
+)
+
+
+class CircuitBreaker:
+    def __init__(
+        self,
+        name,
+        logger=None,
+        failure_rate=BREAKER_FAILURE_RATE,
+        min_requests=BREAKER_MIN_REQUESTS,
+        consecutive_failures=BREAKER_CONSECUTIVE_FAILURES,
+        window=BREAKER_WINDOW,
+        open_seconds=BREAKER_OPEN_SECONDS,
+    ):
+        self.name = name
+        self.logger = logger
+        self.failure_rate = failure_rate
+        self.min_requests = min_requests
+        self.consecutive_failures = consecutive_failures
+        self.window = window
+        self.open_seconds = open_seconds
+        self.state = CLOSED
+        self.opened_at = 0.0
+        self.consecutive = 0
+        self._results = collections.deque()  # (время, успех)
+        self._failures = 0
+        self._probe = False  # пробный запрос half_open уже выдан
+        self._lock = threading.Lock()
+        BREAKER_STATE.labels(name).set_function(lambda: STATE_VALUES[self.state])
+
+    def allow(self):
+        """False — цепь разомкнута, upstream вызывать не нужно"""
+        if self.state == CLOSED:
+            return True
+        with self._lock:
+            if self.state == OPEN:
+                if time.monotonic() - self.opened_at < self.open_seconds:
+                    BREAKER_REJECTED.labels(self.name).inc()
+                    return False
+                self._transition(HALF_OPEN)
+            if self.state == HALF_OPEN:
+                if self._probe:
+                    BREAKER_REJECTED.labels(self.name).inc()
+                    return False
+                self._probe = True
+            return True
+
+    def record_success(self):
+        with self._lock:
+            self.consecutive = 0
+            if self.state == HALF_OPEN:
+                self._reset_window()
+                self._transition(CLOSED)
+                return
+            self._add(True)
+
+    def record_failure(self):
+        with self._lock:
+            self.consecutive += 1
+            if self.state == HALF_OPEN:
+                self._open()
+                return
+            self._add(False)
+            if self.state == CLOSED and self._should_open():
+                self._open()
+
+    def record_ignored(self):
+        """Вызов прерван не по вине upstream (кончился бюджет запроса):
+        не успех и не ошибка; пробный запрос half_open можно выдать снова"""
+        with self._lock:
+            self._probe = False
+
+    def _add(self, ok):
+        now = time.monotonic()
+        results = self._results
+        results.append((now, ok))
+        if not ok:
+            self._failures += 1
+        while results and now - results[0][0] > self.window:
+            _, old_ok = results.popleft()
+            if not old_ok:
+                self._failures -= 1
+
+    def _should_open(self):
+        if self.consecutive >= self.consecutive_failures:
+            return True
+        total = len(self._results)
+        return (
+            total >= self.min_requests
+            and self._failures / total >= self.failure_rate
+        )
+
+    def _reset_window(self):
+        self._results.clear()
+        self._failures = 0
+
+    def _open(self):
+        self.opened_at = time.monotonic()
+        self._reset_window()
+        self._transition(OPEN)
+
+    def _transition(self, state):
+        previous, self.state = self.state, state
+        self._probe = False
+        BREAKER_TRANSITIONS.labels(self.name, state).inc()
+        if self.logger is not None and previous != state:
+            log = self.logger.warning if state == OPEN else self.logger.info
+            log(
+                f"Размыкатель {self.name}: {previous} -> {state}",
+                extra={
+                    "action": "circuit_breaker",
+                    "breaker": self.name,
+                    "breaker_state": state,
+                    "consecutive_failures": self.consecutive,
+                },
+            )
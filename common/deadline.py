@@ -0,0 +1,107 @@
+import contextvars
+import os
+import time
+
+from common import metrics
+
+# --- Сквозной бюджет времени запроса ---
+# Срок запроса задаётся на входе (geoservice) и делится между этапами:
+# таймаут каждого этапа — не больше его собственного предела и не больше
+# того, что осталось от бюджета. Вниз по цепочке остаток уходит в заголовке
+# X-Deadline-Ms (миллисекунды, а не абсолютное время — часы сервисов не
+# обязаны совпадать), и weather_service не ждёт OpenWeather дольше, чем
+# geoservice готов ждать его самого.
+#
+#   deadline.start(self.headers, REQUEST_DEADLINE)
+#   try:
+#       timeout = deadline.timeout(5, stage="dadata")
+#   except deadline.DeadlineExceeded:
+#       return fallback()
+#   headers.update(deadline.outgoing_headers(timeout))
+#   response = pool.request(..., headers=headers, timeout=timeout)
+
+DEADLINE_HEADER = "X-Deadline-Ms"
+# Меньше этого этап не запускается: ответ всё равно не успеет прийти
+DEADLINE_MIN_STAGE = float(os.getenv("DEADLINE_MIN_STAGE", "0.05"))
+
+DEADLINE_EXCEEDED = metrics.counter(
+    "deadline_exceeded_total",
+    "Этапы, не запущенные из-за исчерпанного бюджета запроса",
+    ("stage",),
+)
+
+_current = contextvars.ContextVar("deadline", default=None)
+
+
+class DeadlineExceeded(Exception):
+    pass
+
+
+class Deadline:
+    __slots__ = ("expires",)
+
+    def __init__(self, seconds):
+        self.expires = time.monotonic() + seconds
+
+    def remaining(self):
+        return max(0.0, self.expires - time.monotonic())
+
+    def expired(self, margin=0.0):
+        return time.monotonic() + margin >= self.expires
+
+    def timeout(self, limit, reserve=0.0, stage=None):
+        """Таймаут этапа: min(limit, остаток - reserve).
+
+        reserve — время, которое нужно оставить следующим этапам.
+        DeadlineExceeded, если на этап остаётся меньше DEADLINE_MIN_STAGE.
+        """
+        budget = min(limit, self.remaining() - reserve)
+        if budget < DEADLINE_MIN_STAGE:
+            if stage is not None:
+                DEADLINE_EXCEEDED.labels(stage).inc()
+            raise DeadlineExceeded(stage or "deadline")
+        return budget
+
+
+def parse_header(headers):
+    """Остаток бюджета из X-Deadline-Ms в секундах или None"""
+    value = headers.get(DEADLINE_HEADER) if headers is not None else None
+    if not value:
+        return None
+    try:
+        ms = float(value)
+    except ValueError:
+        return None
+    return max(0.0, ms / 1000) if ms == ms else None  # NaN — как нет заголовка
+
+
+def start(headers, seconds):
+    """Бюджет запроса: из заголовка, но не больше seconds; делает его текущим"""
+    incoming = parse_header(headers)
+    if incoming is not None:
+        seconds = min(seconds, incoming)
+    deadline = Deadline(seconds)
+    _current.set(deadline)
+    return deadline
+
+
+def current():
+    return _current.get()
+
+
+def timeout(limit, reserve=0.0, stage=None):
+    """Таймаут этапа по текущему бюджету; вне запроса — просто limit"""
+    deadline = _current.get()
+    if deadline is None:
+        return limit
+    return deadline.timeout(limit, reserve, stage)
+
+
+def outgoing_headers(timeout=None):
+    """X-Deadline-Ms для исходящего запроса: timeout этапа или весь остаток"""
+    if timeout is None:
+        deadline = _current.get()
+        if deadline is None:
+            return {}
+        timeout = deadline.remaining()
+    return {DEADLINE_HEADER: str(int(timeout * 1000))}
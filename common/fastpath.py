@@ -0,0 +1,135 @@
+import os
+import random
+from http import HTTPStatus
+
+# --- Быстрый путь для CORS preflight и проб живости/готовности ---
+# Ответы собираются заранее и пишутся в сокет одним write: без резолва IP,
+# без исходящих запросов и (по умолчанию) без логирования.
+
+CORS_MAX_AGE = int(os.getenv("CORS_MAX_AGE", "86400"))
+# Заголовки трассировки и Server-Timing разрешены для запросов из браузера
+CORS_ALLOW_HEADERS = "Content-Type, X-Request-ID, X-Server-Timing"
+# Доля быстрых ответов, попадающих в лог: 0 — не логировать, 1 — все
+FASTPATH_LOG_SAMPLE = float(os.getenv("FASTPATH_LOG_SAMPLE", "0"))
+
+HTTP_VERSIONS = ("HTTP/1.0", "HTTP/1.1")
+
+
+def build_response(status, headers=(), body=b""):
+    """Готовый ответ для обеих версий протокола: {версия: bytes}"""
+    status = HTTPStatus(status)
+    head = "".join(f"{name}: {value}\r\n" for name, value in headers)
+    head += f"Content-Length: {len(body)}\r\n\r\n"
+    return {
+        version: f"{version} {status.value} {status.phrase}\r\n{head}".encode(
+            "latin-1"
+        )
+        + body
+        for version in HTTP_VERSIONS
+    }
+
+
+class FastPath:
+    """Обработчик служебных запросов, который срабатывает до основной логики.
+
+    Использование в BaseHTTPRequestHandler:
+
+        def do_GET(self):
+            if fast_path.handle(self):
+                return
+            ...
+    """
+
+    def __init__(
+        self,
+        allow_methods,
+        allow_headers=CORS_ALLOW_HEADERS,
+        options_status=204,
+        ready_check=None,
+        logger=None,
+        log_sample_rate=FASTPATH_LOG_SAMPLE,
+    ):
+        self.ready_check = ready_check
+        self.logger = logger
+        self.log_sample_rate = log_sample_rate
+        self.cors_headers = (
+            ("Access-Control-Allow-Origin", "*"),
+            ("Access-Control-Allow-Methods", allow_methods),
+            ("Access-Control-Allow-Headers", allow_headers),
+        )
+        self.options_response = build_response(
+            options_status,
+            self.cors_headers + (("Access-Control-Max-Age", str(CORS_MAX_AGE)),),
+        )
+        plain = (("Content-Type", "text/plain; charset=utf-8"),)
+        self.health_response = build_response(200, plain, b"ok")
+        self.ready_response = build_response(200, plain, b"ready")
+        self.not_ready_response = build_response(503, plain, b"not ready")
+        self.routes = {
+            "/healthz": self._healthz,
+            "/readyz": self._readyz,
+        }
+
+    def add_route(self, path, func):
+        """Регистрирует служебный GET-эндпоинт.
+
+        func(handler) возвращает готовый ответ из build_response
+        или кортеж (status, content_type, body).
+        """
+        self.routes[path] = func
+
+    def handle(self, handler):
+        """True — запрос обработан быстрым путём, основной обработчик не нужен"""
+        if handler.command == "OPTIONS":
+            self._write(handler, self.options_response)
+            return True
+        if handler.command != "GET":
+            return False
+        route = self.routes.get(handler.path.split("?", 1)[0])
+        if route is None:
+            return False
+        result = route(handler)
+        if isinstance(result, dict):
+            self._write(handler, result)
+        else:
+            status, content_type, body = result
+            self.respond(handler, status, body, content_type)
+        return True
+
+    def respond(self, handler, status, body, content_type="application/json"):
+        """Ответ с телом, собранный без send_response/log_message"""
+        if isinstance(body, str):
+            body = body.encode("utf-8")
+        headers = (("Content-Type", content_type),) + self.cors_headers[:1]
+        response = build_response(status, headers, body)
+        self._write(handler, response)
+
+    def _healthz(self, handler):
+        return self.health_response
+
+    def _readyz(self, handler):
+        if self.ready_check is None or self.ready_check():
+            return self.ready_response
+        return self.not_ready_response
+
+    def _write(self, handler, response):
+        data = response[handler.protocol_version]
+        handler.wfile.write(data)
+        handler.wfile.flush()
+        # Для metrics.InstrumentedHandler: статус и признак быстрого пути
+        handler._response_status = int(data[9:12])
+        handler._fast_path = True
+        if (
+            self.logger is not None
+            and self.log_sample_rate > 0
+            and random.random() < self.log_sample_rate
+        ):
+            self.logger.info(
+                "Быстрый ответ",
+                extra={
+                    "fast_path": handler.path,
+                    "method": handler.command,
+                    "status": handler._response_status,
+                    "sample_rate": self.log_sample_rate,
+                },
+            )
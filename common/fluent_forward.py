@@ -0,0 +1,592 @@
+import argparse
+import base64
+import fcntl
+import json
+import logging
+import os
+import socket
+import socketserver
+import struct
+import sys
+import time
+
+# --- Отправка логов в fluent-bit по Forward-протоколу ---
+# Вместо цепочки "JSON-файл -> tail -> парсинг" пачка записей уходит одним
+# сообщением MessagePack [tag, [[время, запись], ...], {"chunk": id}] в
+# Unix- или TCP-сокет. fluent-bit подтверждает приём ответом {"ack": id}.
+# Пока fluent-bit недоступен, сообщения складываются в каталог-спул
+# (не больше LOG_FORWARD_SPOOL_MAX_BYTES, старые выбрасываются) и
+# досылаются по порядку после переподключения.
+#
+#   LOG_FORWARD=unix:///var/run/fluent/forward.sock
+#   LOG_FORWARD=tcp://fluent-bit:24224
+#
+# Заглушка сервера для проверки: python -m common.fluent_forward tcp://127.0.0.1:24224
+
+LOG_FORWARD = os.getenv("LOG_FORWARD", "")
+LOG_FORWARD_ACK = os.getenv("LOG_FORWARD_ACK", "1").lower() in ("1", "true", "yes", "on")
+LOG_FORWARD_TIMEOUT = float(os.getenv("LOG_FORWARD_TIMEOUT", "5"))
+LOG_FORWARD_RECONNECT_MAX = float(os.getenv("LOG_FORWARD_RECONNECT_MAX", "30"))
+LOG_FORWARD_SPOOL_DIR = os.getenv("LOG_FORWARD_SPOOL_DIR", "")
+LOG_FORWARD_SPOOL_MAX_BYTES = int(
+    os.getenv("LOG_FORWARD_SPOOL_MAX_BYTES", str(64 * 1024 * 1024))
+)
+# 1 — писать и в файл, и в fluent-bit (например, на время перехода)
+LOG_FORWARD_KEEP_FILE = os.getenv("LOG_FORWARD_KEEP_FILE", "0").lower() in (
+    "1",
+    "true",
+    "yes",
+    "on",
+)
+
+SPOOL_SUFFIX = ".fwd"
+
+
+# --- Минимальный MessagePack (только то, что нужно логам) ---
+
+
+class EventTime:
+    """Время события Forward-протокола: ext-тип 0, секунды и наносекунды"""
+
+    __slots__ = ("seconds", "nanoseconds")
+
+    def __init__(self, timestamp):
+        self.seconds = int(timestamp)
+        self.nanoseconds = int((timestamp - self.seconds) * 1e9)
+
+    def __float__(self):
+        return self.seconds + self.nanoseconds / 1e9
+
+
+def _pack(obj, out):
+    if obj is None:
+        out.append(0xC0)
+    elif obj is True:
+        out.append(0xC3)
+    elif obj is False:
+        out.append(0xC2)
+    elif isinstance(obj, int):
+        if 0 <= obj < 0x80:
+            out.append(obj)
+        elif -32 <= obj < 0:
+            out.append(obj & 0xFF)
+        elif 0 <= obj <= 0xFFFFFFFF:
+            out += b"\xce" + struct.pack(">I", obj)
+        elif 0 <= obj <= 0xFFFFFFFFFFFFFFFF:
+            out += b"\xcf" + struct.pack(">Q", obj)
+        elif -(1 << 63) <= obj < 0:
+            out += b"\xd3" + struct.pack(">q", obj)
+        else:
+            _pack(str(obj), out)
+    elif isinstance(obj, float):
+        out += b"\xcb" + struct.pack(">d", obj)
+    elif isinstance(obj, str):
+        data = obj.encode("utf-8", "surrogateescape")
+        size = len(data)
+        if size < 32:
+            out.append(0xA0 | size)
+        elif size < 0x100:
+            out += b"\xd9" + struct.pack(">B", size)
+        elif size < 0x10000:
+            out += b"\xda" + struct.pack(">H", size)
+        else:
+            out += b"\xdb" + struct.pack(">I", size)
+        out += data
+    elif isinstance(obj, (bytes, bytearray)):
+        size = len(obj)
+        if size < 0x100:
+            out += b"\xc4" + struct.pack(">B", size)
+        elif size < 0x10000:
+            out += b"\xc5" + struct.pack(">H", size)
+        else:
+            out += b"\xc6" + struct.pack(">I", size)
+        out += obj
+    elif isinstance(obj, (list, tuple)):
+        size = len(obj)
+        if size < 16:
+            out.append(0x90 | size)
+        elif size < 0x10000:
+            out += b"\xdc" + struct.pack(">H", size)
+        else:
+            out += b"\xdd" + struct.pack(">I", size)
+        for item in obj:
+            _pack(item, out)
+    elif isinstance(obj, dict):
+        size = len(obj)
+        if size < 16:
+            out.append(0x80 | size)
+        elif size < 0x10000:
+            out += b"\xde" + struct.pack(">H", size)
+        else:
+            out += b"\xdf" + struct.pack(">I", size)
+        for key, value in obj.items():
+            _pack(key if isinstance(key, str) else str(key), out)
+            _pack(value, out)
+    elif isinstance(obj, EventTime):
+        out += b"\xd7\x00" + struct.pack(">II", obj.seconds, obj.nanoseconds)
+    else:
+        _pack(str(obj), out)
+
+
+def packb(obj):
+    out = bytearray()
+    _pack(obj, out)
+    return bytes(out)
+
+
+class NeedMoreData(Exception):
+    """В буфере неполное сообщение"""
+
+
+def _take(buf, pos, size):
+    end = pos + size
+    if end > len(buf):
+        raise NeedMoreData()
+    return buf[pos:end], end
+
+
+def unpack_from(buf, pos=0):
+    """Разбирает один объект из buf с позиции pos -> (объект, новая позиция)"""
+    if pos >= len(buf):
+        raise NeedMoreData()
+    code = buf[pos]
+    pos += 1
+    if code < 0x80:
+        return code, pos
+    if code >= 0xE0:
+        return code - 0x100, pos
+    if 0x80 <= code <= 0x8F:
+        return _unpack_map(buf, pos, code & 0x0F)
+    if 0x90 <= code <= 0x9F:
+        return _unpack_array(buf, pos, code & 0x0F)
+    if 0xA0 <= code <= 0xBF:
+        data, pos = _take(buf, pos, code & 0x1F)
+        return bytes(data).decode("utf-8", "surrogateescape"), pos
+    if code == 0xC0:
+        return None, pos
+    if code == 0xC2:
+        return False, pos
+    if code == 0xC3:
+        return True, pos
+    if code in _SIZED:
+        kind, fmt = _SIZED[code]
+        raw, pos = _take(buf, pos, struct.calcsize(fmt))
+        value = struct.unpack(fmt, raw)[0]
+        if kind == "num":
+            return value, pos
+        if kind == "str":
+            data, pos = _take(buf, pos, value)
+            return bytes(data).decode("utf-8", "surrogateescape"), pos
+        if kind == "bin":
+            data, pos = _take(buf, pos, value)
+            return bytes(data), pos
+        if kind == "array":
+            return _unpack_array(buf, pos, value)
+        return _unpack_map(buf, pos, value)
+    if code in _EXT:
+        if code in (0xC7, 0xC8, 0xC9):
+            fmt = _EXT[code]
+            raw, pos = _take(buf, pos, struct.calcsize(fmt))
+            size = struct.unpack(fmt, raw)[0]
+        else:
+            size = _EXT[code]
+        raw, pos = _take(buf, pos, 1 + size)
+        ext_type, data = raw[0], bytes(raw[1:])
+        if ext_type == 0 and size == 8:
+            seconds, nanoseconds = struct.unpack(">II", data)
+            return seconds + nanoseconds / 1e9, pos
+        return data, pos
+    raise ValueError(f"Неподдерживаемый тип MessagePack: 0x{code:02x}")
+
+
+_SIZED = {
+    0xC4: ("bin", ">B"),
+    0xC5: ("bin", ">H"),
+    0xC6: ("bin", ">I"),
+    0xCA: ("num", ">f"),
+    0xCB: ("num", ">d"),
+    0xCC: ("num", ">B"),
+    0xCD: ("num", ">H"),
+    0xCE: ("num", ">I"),
+    0xCF: ("num", ">Q"),
+    0xD0: ("num", ">b"),
+    0xD1: ("num", ">h"),
+    0xD2: ("num", ">i"),
+    0xD3: ("num", ">q"),
+    0xD9: ("str", ">B"),
+    0xDA: ("str", ">H"),
+    0xDB: ("str", ">I"),
+    0xDC: ("array", ">H"),
+    0xDD: ("array", ">I"),
+    0xDE: ("map", ">H"),
+    0xDF: ("map", ">I"),
+}
+_EXT = {0xD4: 1, 0xD5: 2, 0xD6: 4, 0xD7: 8, 0xD8: 16, 0xC7: ">B", 0xC8: ">H", 0xC9: ">I"}
+
+
+def _unpack_array(buf, pos, size):
+    items = []
+    for _ in range(size):
+        item, pos = unpack_from(buf, pos)
+        items.append(item)
+    return items, pos
+
+
+def _unpack_map(buf, pos, size):
+    result = {}
+    for _ in range(size):
+        key, pos = unpack_from(buf, pos)
+        value, pos = unpack_from(buf, pos)
+        result[key] = value
+    return result, pos
+
+
+# --- Адреса ---
+
+
+def parse_address(address):
+    """'unix:///path' | 'tcp://host:port' | 'host:port' -> (family, адрес)"""
+    if address.startswith("unix://"):
+        return socket.AF_UNIX, address[len("unix://") :]
+    if address.startswith("tcp://"):
+        address = address[len("tcp://") :]
+    host, _, port = address.rpartition(":")
+    return socket.AF_INET, (host or "127.0.0.1", int(port or 24224))
+
+
+# --- Обработчик логов ---
+
+
+class ForwardHandler(logging.Handler):
+    """Отправляет пачки записей в fluent-bit, при недоступности — в спул.
+
+    Пишет из фонового writer'а (emit_batch), поэтому ожидание сети и
+    подтверждений не задерживает обработку запросов.
+    """
+
+    def __init__(
+        self,
+        address,
+        tag,
+        ack=LOG_FORWARD_ACK,
+        timeout=LOG_FORWARD_TIMEOUT,
+        spool_dir=LOG_FORWARD_SPOOL_DIR,
+        spool_max_bytes=LOG_FORWARD_SPOOL_MAX_BYTES,
+        reconnect_max=LOG_FORWARD_RECONNECT_MAX,
+    ):
+        super().__init__()
+        self.family, self.address = parse_address(address)
+        self.tag = tag
+        self.ack = ack
+        self.timeout = timeout
+        self.spool_dir = spool_dir
+        self.spool_max_bytes = spool_max_bytes
+        self.reconnect_max = reconnect_max
+        self.sock = None
+        self.backoff = 0.0
+        self.next_attempt = 0.0
+        self.sent = 0
+        self.spooled = 0
+        self.dropped = 0
+        self.spool_pending = False
+        if spool_dir:
+            os.makedirs(spool_dir, exist_ok=True)
+            self.spool_pending = bool(self._spool_files())
+        os.register_at_fork(after_in_child=self._after_fork_child)
+
+    # Записи
+
+    def _entry(self, record):
+        to_dict = getattr(self.formatter, "to_dict", None)
+        if to_dict is not None:
+            return to_dict(record)
+        return {"message": self.format(record)}
+
+    def emit(self, record):
+        self.emit_batch([record])
+
+    def emit_batch(self, records):
+        entries = []
+        for record in records:
+            if record.levelno < self.level or not self.filter(record):
+                continue
+            try:
+                entries.append((EventTime(record.created), self._entry(record)))
+            except Exception:
+                self.handleError(record)
+        if not entries:
+            return
+        chunk = base64.b64encode(os.urandom(16)).decode("ascii")
+        message = packb([self.tag, entries, {"chunk": chunk, "size": len(entries)}])
+        with self.lock:
+            self._deliver(message, chunk, len(entries))
+
+    def _deliver(self, message, chunk, count):
+        # Пока в спуле что-то есть, новые пачки встают за ним — порядок сохраняется
+        if self.spool_pending:
+            self._spool(message, chunk, count)
+            self._replay()
+        elif self._send(message, chunk):
+            self.sent += count
+        else:
+            self._spool(message, chunk, count)
+
+    # Сеть
+
+    def _connect(self):
+        if time.monotonic() < self.next_attempt:
+            return False
+        sock = socket.socket(self.family, socket.SOCK_STREAM)
+        sock.settimeout(self.timeout)
+        try:
+            sock.connect(self.address)
+        except OSError:
+            sock.close()
+            self._schedule_reconnect()
+            return False
+        self.sock = sock
+        return True
+
+    def _schedule_reconnect(self):
+        self.backoff = min(self.reconnect_max, max(0.5, self.backoff * 2))
+        self.next_attempt = time.monotonic() + self.backoff
+
+    def _disconnect(self):
+        if self.sock is not None:
+            try:
+                self.sock.close()
+            except OSError:
+                pass
+            self.sock = None
+
+    def _send(self, message, chunk):
+        if self.sock is None and not self._connect():
+            return False
+        try:
+            self.sock.sendall(message)
+            if self.ack:
+                self._wait_ack(chunk)
+        except (OSError, ValueError):
+            self._disconnect()
+            self._schedule_reconnect()
+            return False
+        self.backoff = 0.0
+        return True
+
+    def _wait_ack(self, chunk):
+        buf = b""
+        while True:
+            data = self.sock.recv(4096)
+            if not data:
+                raise ConnectionError("fluent-bit закрыл соединение")
+            buf += data
+            try:
+                response, _ = unpack_from(buf)
+            except NeedMoreData:
+                continue
+            if not isinstance(response, dict) or response.get("ack") != chunk:
+                raise ValueError("Неверное подтверждение Forward-протокола")
+            return
+
+    # Спул на диске
+
+    def _spool_files(self):
+        try:
+            names = os.listdir(self.spool_dir)
+        except FileNotFoundError:
+            return []
+        return sorted(name for name in names if name.endswith(SPOOL_SUFFIX))
+
+    def _spool(self, message, chunk, count):
+        if not self.spool_dir:
+            self.dropped += count
+            return
+        # Имя: время-pid-число записей-chunk; сортировка по имени = порядок отправки
+        safe_chunk = chunk.replace("/", "_").replace("+", "-")
+        name = f"{time.time_ns():020d}-{os.getpid()}-{count}-{safe_chunk}{SPOOL_SUFFIX}"
+        path = os.path.join(self.spool_dir, name)
+        try:
+            with open(path + ".tmp", "wb") as f:
+                f.write(message)
+            os.replace(path + ".tmp", path)
+        except OSError:
+            self.dropped += count
+            return
+        self.spooled += count
+        self.spool_pending = True
+        self._trim_spool()
+
+    def _trim_spool(self):
+        files = []
+        total = 0
+        for name in self._spool_files():
+            try:
+                size = os.path.getsize(os.path.join(self.spool_dir, name))
+            except FileNotFoundError:
+                continue
+            files.append((name, size))
+            total += size
+        for name, size in files:
+            if total <= self.spool_max_bytes:
+                break
+            try:
+                os.remove(os.path.join(self.spool_dir, name))
+            except FileNotFoundError:
+                continue
+            total -= size
+            self.dropped += int(name.split("-")[2])
+
+    def _replay(self):
+        if self.sock is None and not self._connect():
+            return
+        # Спул общий для воркеров prefork: досылает тот, кто взял блокировку
+        with open(os.path.join(self.spool_dir, ".lock"), "a") as lock_file:
+            try:
+                fcntl.flock(lock_file, fcntl.LOCK_EX | fcntl.LOCK_NB)
+            except BlockingIOError:
+                return
+            for name in self._spool_files():
+                path = os.path.join(self.spool_dir, name)
+                try:
+                    with open(path, "rb") as f:
+                        message = f.read()
+                except FileNotFoundError:
+                    continue
+                _, _, count, rest = name.split("-", 3)
+                chunk = rest[: -len(SPOOL_SUFFIX)].replace("_", "/").replace("-", "+")
+                if not self._send(message, chunk):
+                    return
+                os.remove(path)
+                self.sent += int(count)
+            self.spool_pending = False
+
+    def close(self):
+        with self.lock:
+            self._disconnect()
+        super().close()
+
+    def _after_fork_child(self):
+        # Соединение родителя не используем: дочерний процесс откроет своё
+        self.sock = None
+
+
+def install(logger, tag, spool_dir=None):
+    """Переключает логгер на отправку в fluent-bit, если задан LOG_FORWARD.
+
+    Вызывается до log_pipeline.install. Форматтер берётся у файлового
+    обработчика; сам файл остаётся только при LOG_FORWARD_KEEP_FILE=1.
+    Спул по умолчанию — каталог forward-spool рядом с файлом лога.
+    """
+    if not LOG_FORWARD:
+        return None
+    file_handlers = [h for h in logger.handlers if isinstance(h, logging.FileHandler)]
+    if spool_dir is None:
+        spool_dir = LOG_FORWARD_SPOOL_DIR
+        if not spool_dir and file_handlers:
+            spool_dir = os.path.join(
+                os.path.dirname(file_handlers[0].baseFilename), "forward-spool"
+            )
+    handler = ForwardHandler(LOG_FORWARD, tag, spool_dir=spool_dir)
+    if file_handlers:
+        handler.setLevel(file_handlers[0].level)
+        handler.setFormatter(file_handlers[0].formatter)
+        if not LOG_FORWARD_KEEP_FILE:
+            for file_handler in file_handlers:
+                logger.removeHandler(file_handler)
+                file_handler.close()
+    logger.addHandler(handler)
+    return handler
+
+
+# --- Заглушка Forward-сервера для локальной проверки ---
+
+
+def _iter_events(message):
+    """(tag, время, запись) из сообщения Message/Forward/PackedForward"""
+    tag = message[0]
+    if isinstance(message[1], list):
+        for event_time, record in message[1]:
+            yield tag, event_time, record
+    elif isinstance(message[1], bytes):
+        pos = 0
+        while pos < len(message[1]):
+            (event_time, record), pos = unpack_from(message[1], pos)
+            yield tag, event_time, record
+    else:
+        yield tag, message[1], message[2]
+
+
+def _options(message):
+    if isinstance(message[1], (list, bytes)):
+        return message[2] if len(message) > 2 else {}
+    return message[3] if len(message) > 3 else {}
+
+
+class StubForwardHandler(socketserver.BaseRequestHandler):
+    def handle(self):
+        buf = b""
+        while True:
+            data = self.request.recv(65536)
+            if not data:
+                return
+            buf += data
+            while buf:
+                try:
+                    message, pos = unpack_from(buf)
+                except NeedMoreData:
+                    break
+                buf = buf[pos:]
+                for tag, event_time, record in _iter_events(message):
+                    line = json.dumps(
+                        {"tag": tag, "time": event_time, "record": record},
+                        ensure_ascii=False,
+                        default=str,
+                    )
+                    self.server.out.write(line + "\n")
+                self.server.out.flush()
+                chunk = _options(message).get("chunk")
+                if chunk and self.server.ack:
+                    self.request.sendall(packb({"ack": chunk}))
+
+
+class ThreadingUnixStreamServer(socketserver.ThreadingMixIn, socketserver.UnixStreamServer):
+    daemon_threads = True
+
+
+class ThreadingTCPServer(socketserver.ThreadingMixIn, socketserver.TCPServer):
+    daemon_threads = True
+    allow_reuse_address = True
+
+
+def make_stub_server(address, ack=True, out=sys.stdout):
+    family, addr = parse_address(address)
+    if family == socket.AF_UNIX:
+        if os.path.exists(addr):
+            os.remove(addr)
+        server = ThreadingUnixStreamServer(addr, StubForwardHandler)
+    else:
+        server = ThreadingTCPServer(addr, StubForwardHandler)
+    server.ack = ack
+    server.out = out
+    return server
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="Заглушка fluent-bit: принимает Forward-сообщения и печатает записи"
+    )
+    parser.add_argument("address", help="unix:///path или tcp://host:port")
+    parser.add_argument("--no-ack", action="store_true", help="не отвечать ack")
+    args = parser.parse_args()
+    server = make_stub_server(args.address, ack=not args.no_ack)
+    print(f"Forward-заглушка слушает {args.address}", file=sys.stderr)
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,277 @@
+import collections
+import http.client
+import os
+import socket
+import ssl
+import threading
+import time
+from urllib.parse import urlsplit
+
+from common import metrics
+
+# --- Пул keep-alive соединений к одному хосту ---
+# Вместо нового HTTPConnection на каждый запрос (TCP connect, DNS, для HTTPS
+# ещё и TLS-рукопожатие) соединения возвращаются в пул и переиспользуются.
+# Для HTTPS сохраняется TLS-сессия: новые соединения к тому же хосту делают
+# сокращённое рукопожатие.
+#
+# Соединение, которое сервер успел закрыть, пока оно лежало в пуле,
+# обнаруживается только при отправке запроса — такой запрос повторяется один
+# раз на новом соединении.
+#
+#   pool = http_pool.get_pool("http://weather_service:8002")
+#   response = pool.request("POST", "/api/weather", body=payload, headers=headers)
+#
+# unix_socket — путь Unix domain socket сервиса на той же машине: соединения
+# идут через него, host остаётся только в заголовке Host.
+
+HTTP_POOL_MAXSIZE = int(os.getenv("HTTP_POOL_MAXSIZE", "8"))
+# Соединение, простоявшее дольше, закрывается, не дожидаясь сервера
+# (keep-alive timeout у nginx — 75 с, у http.server — пока клиент не закроет)
+HTTP_POOL_IDLE_TIMEOUT = float(os.getenv("HTTP_POOL_IDLE_TIMEOUT", "30"))
+
+# Ошибки, по которым понятно, что переиспользованное соединение уже закрыто
+STALE_ERRORS = (
+    http.client.RemoteDisconnected,
+    http.client.BadStatusLine,
+    ConnectionResetError,
+    ConnectionAbortedError,
+    BrokenPipeError,
+)
+
+POOL_REQUESTS = metrics.counter(
+    "http_pool_requests_total",
+    "Запросы через пул: на новом или переиспользованном соединении",
+    ("pool", "connection"),
+)
+POOL_RETRIES = metrics.counter(
+    "http_pool_stale_retries_total",
+    "Повторы запроса после закрытого сервером соединения",
+    ("pool",),
+)
+POOL_DISCARDED = metrics.counter(
+    "http_pool_discarded_total",
+    "Закрытые пулом соединения: idle — простой, full — пул полон, error — ошибка",
+    ("pool", "reason"),
+)
+POOL_IDLE = metrics.gauge(
+    "http_pool_idle_connections", "Свободные соединения в пуле", ("pool",)
+)
+POOL_TLS_RESUMED = metrics.counter(
+    "http_pool_tls_resumed_total", "TLS-рукопожатия с возобновлённой сессией", ("pool",)
+)
+
+
+class Response:
+    __slots__ = ("status", "reason", "headers", "data")
+
+    def __init__(self, status, reason, headers, data):
+        self.status = status
+        self.reason = reason
+        self.headers = headers
+        self.data = data
+
+    def text(self, encoding="utf-8"):
+        return self.data.decode(encoding)
+
+
+class _HTTPSConnection(http.client.HTTPSConnection):
+    """HTTPSConnection, возобновляющий TLS-сессию пула"""
+
+    def __init__(self, host, port, timeout, context, pool):
+        super().__init__(host, port, timeout=timeout, context=context)
+        self._pool = pool
+
+    def connect(self):
+        # Повторяет HTTPSConnection.connect, но передаёт session в wrap_socket
+        http.client.HTTPConnection.connect(self)
+        server_hostname = self.host if ssl.HAS_SNI else None
+        session = self._pool.tls_session
+        try:
+            self.sock = self._context.wrap_socket(
+                self.sock, server_hostname=server_hostname, session=session
+            )
+        except ssl.SSLError:
+            if session is None:
+                raise
+            # Сессию могли отозвать — рукопожатие с нуля
+            self._pool.tls_session = None
+            http.client.HTTPConnection.connect(self)
+            self.sock = self._context.wrap_socket(
+                self.sock, server_hostname=server_hostname
+            )
+        if self.sock.session_reused:
+            POOL_TLS_RESUMED.labels(self._pool.name).inc()
+
+
+class _UnixHTTPConnection(http.client.HTTPConnection):
+    """HTTPConnection через Unix domain socket"""
+
+    def __init__(self, host, path, timeout):
+        super().__init__(host, timeout=timeout)
+        self.unix_socket = path
+
+    def connect(self):
+        sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        sock.settimeout(self.timeout)
+        try:
+            sock.connect(self.unix_socket)
+        except BaseException:
+            sock.close()
+            raise
+        self.sock = sock
+
+
+class HTTPPool:
+    """Потокобезопасный пул соединений к scheme://host:port"""
+
+    def __init__(
+        self,
+        host,
+        port=None,
+        scheme="http",
+        maxsize=HTTP_POOL_MAXSIZE,
+        idle_timeout=HTTP_POOL_IDLE_TIMEOUT,
+        timeout=5,
+        name=None,
+        unix_socket=None,
+    ):
+        if scheme not in ("http", "https"):
+            raise ValueError(f"Неподдерживаемая схема: {scheme}")
+        if unix_socket and scheme != "http":
+            raise ValueError("Через Unix domain socket — только http")
+        self.host = host
+        self.scheme = scheme
+        self.port = port or (443 if scheme == "https" else 80)
+        self.maxsize = maxsize
+        self.idle_timeout = idle_timeout
+        self.timeout = timeout
+        self.name = name or f"{host}:{self.port}"
+        self.context = ssl.create_default_context() if scheme == "https" else None
+        self.tls_session = None
+        self.unix_socket = unix_socket
+        self._idle = collections.deque()  # (соединение, время возврата)
+        self._lock = threading.Lock()
+        POOL_IDLE.labels(self.name).set_function(lambda: len(self._idle))
+        os.register_at_fork(after_in_child=self._after_fork_child)
+
+    def _after_fork_child(self):
+        # Сокеты унаследованы от родителя: пользоваться ими вдвоём нельзя
+        idle, self._idle = self._idle, collections.deque()
+        self._lock = threading.Lock()
+        for conn, _ in idle:
+            conn.close()
+
+    def _new_connection(self, timeout):
+        if self.unix_socket:
+            return _UnixHTTPConnection(self.host, self.unix_socket, timeout)
+        if self.scheme == "https":
+            return _HTTPSConnection(self.host, self.port, timeout, self.context, self)
+        return http.client.HTTPConnection(self.host, self.port, timeout=timeout)
+
+    def _get(self):
+        """Самое свежее свободное соединение или None"""
+        now = time.monotonic()
+        expired = []
+        conn = None
+        with self._lock:
+            while self._idle:
+                candidate, returned = self._idle.pop()
+                if now - returned <= self.idle_timeout:
+                    conn = candidate
+                    break
+                expired.append(candidate)
+                # Всё, что глубже в стеке, простояло ещё дольше
+                expired.extend(c for c, _ in self._idle)
+                self._idle.clear()
+        for stale in expired:
+            stale.close()
+            POOL_DISCARDED.labels(self.name, "idle").inc()
+        return conn
+
+    def _put(self, conn):
+        with self._lock:
+            if len(self._idle) < self.maxsize:
+                self._idle.append((conn, time.monotonic()))
+                return
+        conn.close()
+        POOL_DISCARDED.labels(self.name, "full").inc()
+
+    def _send(self, conn, method, path, body, headers, timeout):
+        if conn.sock is not None:
+            conn.sock.settimeout(timeout)
+        else:
+            conn.timeout = timeout
+        conn.request(method, path, body=body, headers=headers)
+        response = conn.getresponse()
+        data = response.read()
+        if self.scheme == "https" and conn.sock is not None:
+            # В TLS 1.3 тикет сессии приходит после рукопожатия
+            self.tls_session = conn.sock.session
+        return response, data
+
+    def request(self, method, path, body=None, headers=None, timeout=None):
+        """Выполняет запрос и читает ответ целиком; ошибки сети — исключения"""
+        timeout = self.timeout if timeout is None else timeout
+        headers = dict(headers or {})
+        conn = self._get()
+        reused = conn is not None
+        if conn is None:
+            conn = self._new_connection(timeout)
+        try:
+            try:
+                response, data = self._send(conn, method, path, body, headers, timeout)
+            except STALE_ERRORS:
+                if not reused:
+                    raise
+                # Сервер закрыл соединение, пока оно ждало в пуле
+                conn.close()
+                POOL_RETRIES.labels(self.name).inc()
+                conn, reused = self._new_connection(timeout), False
+                response, data = self._send(conn, method, path, body, headers, timeout)
+        except BaseException:
+            conn.close()
+            POOL_DISCARDED.labels(self.name, "error").inc()
+            raise
+
+        POOL_REQUESTS.labels(self.name, "reused" if reused else "new").inc()
+        if response.will_close:
+            conn.close()
+        else:
+            self._put(conn)
+        return Response(response.status, response.reason, response.headers, data)
+
+    def close(self):
+        with self._lock:
+            idle, self._idle = self._idle, collections.deque()
+        for conn, _ in idle:
+            conn.close()
+
+
+_pools = {}
+_pools_lock = threading.Lock()
+
+
+def get_pool(url, **kwargs):
+    """Общий пул процесса для scheme://host:port из url"""
+    parts = urlsplit(url)
+    scheme = parts.scheme or "http"
+    port = parts.port or (443 if scheme == "https" else 80)
+    key = (scheme, parts.hostname, port)
+    pool = _pools.get(key)
+    if pool is None:
+        with _pools_lock:
+            pool = _pools.get(key)
+            if pool is None:
+                pool = HTTPPool(parts.hostname, port, scheme, **kwargs)
+                _pools[key] = pool
+    return pool
+
+
+def request(method, url, body=None, headers=None, timeout=None):
+    """Запрос по полному URL через общий пул хоста"""
+    parts = urlsplit(url)
+    path = parts.path or "/"
+    if parts.query:
+        path += "?" + parts.query
+    return get_pool(url).request(method, path, body, headers, timeout)
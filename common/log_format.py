@@ -0,0 +1,252 @@
+import functools
+import ipaddress
+import json
+import logging
+import os
+import time
+
+try:
+    import orjson
+except ImportError:  # orjson — необязательная зависимость
+    orjson = None
+
+# --- Общий JSON-форматтер логов ---
+# Один на все сервисы. На каждую запись: поиск служебных полей по frozenset,
+# строка времени кэшируется на секунду, статические поля закодированы заранее,
+# сериализация через orjson, если он установлен.
+
+# auto — orjson при наличии, json — всегда стандартная библиотека
+LOG_JSON_BACKEND = os.getenv("LOG_JSON_BACKEND", "auto")
+# legacy — прежний набор полей, ecs — схема Elastic Common Schema
+LOG_SCHEMA = os.getenv("LOG_SCHEMA", "legacy")
+
+TIMESTAMP_FORMAT = "%Y-%m-%dT%H:%M:%SZ"
+
+# Атрибуты LogRecord, которые не попадают в лог как extra-поля
+RESERVED_ATTRS = frozenset(
+    (
+        "args",
+        "asctime",
+        "created",
+        "exc_info",
+        "exc_text",
+        "filename",
+        "funcName",
+        "levelname",
+        "levelno",
+        "lineno",
+        "message",
+        "module",
+        "msecs",
+        "msg",
+        "name",
+        "pathname",
+        "process",
+        "processName",
+        "relativeCreated",
+        "stack_info",
+        "taskName",
+        "thread",
+        "threadName",
+    )
+)
+
+
+ECS_VERSION = "8.11"
+
+
+@functools.lru_cache(maxsize=4096)
+def _ecs_ip(value):
+    # Заглушки вида "UNKNOWN"/"N/A" в поле типа ip сломают индексацию
+    try:
+        return str(ipaddress.ip_address(value))
+    except (TypeError, ValueError):
+        return None
+
+
+def _ecs_status(value):
+    try:
+        status = int(value)
+    except (TypeError, ValueError):
+        return None
+    return status if 100 <= status <= 599 else None
+
+
+def _ecs_duration(value):
+    # event.duration в ECS — наносекунды
+    try:
+        return int(float(value) * 1_000_000)
+    except (TypeError, ValueError):
+        return None
+
+
+def _ecs_url_path(value):
+    return str(value).split("?", 1)[0]
+
+
+# Поля сервисов -> (поле ECS, приведение типа или None)
+ECS_FIELDS = {
+    "service": ("service.name", None),
+    "client_ip": ("client.ip", _ecs_ip),
+    "public_ip": ("client.nat.ip", _ecs_ip),
+    "response_status": ("http.response.status_code", _ecs_status),
+    "duration_ms": ("event.duration", _ecs_duration),
+    "request_target": ("url.path", _ecs_url_path),
+    "status": ("http.response.status_code", _ecs_status),
+    "request_id": ("http.request.id", None),
+    "trace_id": ("trace.id", None),
+    "span_id": ("span.id", None),
+    "request": ("event.action", None),
+    "action": ("event.action", None),
+    "city": ("client.geo.city_name", None),
+    "requested_city": ("client.geo.city_name", None),
+    "error": ("error.message", None),
+}
+
+
+def _dumps_json(data):
+    return json.dumps(data, ensure_ascii=False, default=str)
+
+
+if orjson is not None:
+
+    def _dumps_orjson(data):
+        try:
+            return orjson.dumps(
+                data, default=str, option=orjson.OPT_NON_STR_KEYS
+            ).decode("utf-8")
+        except TypeError:
+            # Например, целые больше 64 бит — отдаём стандартному json
+            return _dumps_json(data)
+
+else:
+    _dumps_orjson = None
+
+
+def get_dumps(backend=LOG_JSON_BACKEND):
+    if backend != "json" and _dumps_orjson is not None:
+        return _dumps_orjson
+    return _dumps_json
+
+
+class JSONFormatter(logging.Formatter):
+    """JSON-строка на запись: базовые поля, статические поля, все extra.
+
+    timestamp_fields — имена полей со временем в ISO-формате (UTC, секунды);
+    static_fields — поля, одинаковые для всех записей (например, service).
+    schema="ecs" — поля по ECS (@timestamp с миллисекундами, log.level,
+    client.ip, http.response.status_code, event.duration в нс, url.path...)
+    с числовыми типами; остальные extra-поля пишутся как есть.
+    """
+
+    def __init__(
+        self,
+        static_fields=None,
+        timestamp_fields=("timestamp",),
+        backend=LOG_JSON_BACKEND,
+        schema=LOG_SCHEMA,
+    ):
+        super().__init__()
+        if schema not in ("legacy", "ecs"):
+            raise ValueError(f"Неизвестная схема логов: {schema}")
+        self.dumps = get_dumps(backend)
+        self.schema = schema
+        # extra-поля с именами статических полей не дублируем
+        self.skip_keys = RESERVED_ATTRS | frozenset(static_fields or ())
+        if schema == "ecs":
+            timestamp_fields = ()
+            static_fields = {
+                ECS_FIELDS.get(key, (key,))[0]: value
+                for key, value in dict(static_fields or {}).items()
+            }
+            static_fields["ecs.version"] = ECS_VERSION
+            self.build_entry = self.build_ecs_entry
+        self.timestamp_fields = timestamp_fields
+        self.static_fields = dict(static_fields or {})
+        self.skip_keys |= frozenset(self.static_fields)
+        static = self.dumps(self.static_fields)[1:-1]
+        self._static_fragment = static + "," if static else ""
+        self._ts_cache = (None, "", "")
+
+    def _timestamp(self, created):
+        second = int(created)
+        cache = self._ts_cache
+        if cache[0] != second:
+            stamp = time.strftime(TIMESTAMP_FORMAT, time.gmtime(second))
+            prefix = "".join(f'"{name}":"{stamp}",' for name in self.timestamp_fields)
+            cache = self._ts_cache = (second, stamp, prefix)
+        return cache
+
+    def format_timestamp(self, created):
+        return self._timestamp(created)[2]
+
+    def build_entry(self, record):
+        """Словарь динамических полей записи (без времени и статических полей)"""
+        entry = {
+            "level": record.levelname,
+            "logger": record.name,
+            "message": record.getMessage(),
+            "module": record.module,
+            "function": record.funcName,
+            "line": record.lineno,
+        }
+        if record.exc_info and not record.exc_text:
+            record.exc_text = self.formatException(record.exc_info)
+        if record.exc_text:
+            entry["exception"] = record.exc_text
+
+        skip = self.skip_keys
+        for key, value in record.__dict__.items():
+            if key not in skip and key not in entry:
+                entry[key] = value
+        return entry
+
+    def build_ecs_entry(self, record):
+        """Динамические поля записи по схеме ECS (вместе с @timestamp)"""
+        stamp = self._timestamp(record.created)[1]
+        entry = {
+            "@timestamp": f"{stamp[:-1]}.{int(record.msecs):03d}Z",
+            "log.level": record.levelname.lower(),
+            "log.logger": record.name,
+            "message": record.getMessage(),
+            "log.origin.file.name": record.filename,
+            "log.origin.function": record.funcName,
+            "log.origin.file.line": record.lineno,
+        }
+        if record.exc_info and not record.exc_text:
+            record.exc_text = self.formatException(record.exc_info)
+        if record.exc_text:
+            entry["error.stack_trace"] = record.exc_text
+
+        skip = self.skip_keys
+        for key, value in record.__dict__.items():
+            if key in skip:
+                continue
+            mapped = ECS_FIELDS.get(key)
+            if mapped is None:
+                entry.setdefault(key, value)
+                continue
+            field, convert = mapped
+            if convert is not None:
+                value = convert(value)
+                if value is None:
+                    continue
+            entry.setdefault(field, value)
+        return entry
+
+    def to_dict(self, record):
+        """Запись целиком в виде словаря — для бинарных транспортов"""
+        stamp = self._timestamp(record.created)[1]
+        entry = {name: stamp for name in self.timestamp_fields}
+        entry.update(self.static_fields)
+        entry.update(self.build_entry(record))
+        return entry
+
+    def format(self, record):
+        body = self.dumps(self.build_entry(record))
+        return (
+            "{"
+            + self.format_timestamp(record.created)
+            + self._static_fragment
+            + body[1:]
+        )
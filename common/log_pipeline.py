@@ -0,0 +1,252 @@
+import atexit
+import collections
+import logging
+import os
+import threading
+import time
+
+# --- Неблокирующее логирование ---
+# Поток запроса только кладёт запись в ограниченную очередь (QueueHandler).
+# Форматирование и запись в файл делает фоновый поток: пачками, с flush
+# по таймеру. При переполнении очереди:
+#   drop_oldest — выбрасываем самую старую запись и считаем потери;
+#   block       — поток запроса ждёт, пока writer освободит место.
+
+LOG_ASYNC = os.getenv("LOG_ASYNC", "1").lower() in ("1", "true", "yes", "on")
+LOG_QUEUE_SIZE = int(os.getenv("LOG_QUEUE_SIZE", "10000"))
+LOG_OVERFLOW = os.getenv("LOG_OVERFLOW", "drop_oldest")
+LOG_BATCH_SIZE = int(os.getenv("LOG_BATCH_SIZE", "256"))
+LOG_FLUSH_INTERVAL = float(os.getenv("LOG_FLUSH_INTERVAL", "1.0"))
+
+OVERFLOW_POLICIES = ("drop_oldest", "block")
+
+
+class BoundedLogQueue:
+    """Ограниченная очередь записей с политикой переполнения"""
+
+    def __init__(self, maxsize=LOG_QUEUE_SIZE, overflow=LOG_OVERFLOW):
+        if overflow not in OVERFLOW_POLICIES:
+            raise ValueError(f"Неизвестная политика переполнения: {overflow}")
+        self.maxsize = maxsize
+        self.overflow = overflow
+        self.dropped = 0
+        self._reset()
+
+    def _reset(self):
+        self.items = collections.deque()
+        self.lock = threading.Lock()
+        self.not_empty = threading.Condition(self.lock)
+        self.not_full = threading.Condition(self.lock)
+
+    def put_nowait(self, record):
+        # Имя как у queue.Queue — его вызывает logging.handlers.QueueHandler
+        with self.lock:
+            if len(self.items) >= self.maxsize:
+                if self.overflow == "block":
+                    while len(self.items) >= self.maxsize:
+                        self.not_full.wait()
+                else:
+                    self.items.popleft()
+                    self.dropped += 1
+            self.items.append(record)
+            self.not_empty.notify()
+
+    def get_batch(self, max_items, timeout):
+        """До max_items записей; ждёт не дольше timeout, если очередь пуста"""
+        with self.lock:
+            if not self.items:
+                self.not_empty.wait(timeout)
+            batch = []
+            while self.items and len(batch) < max_items:
+                batch.append(self.items.popleft())
+            if batch:
+                self.not_full.notify_all()
+            return batch
+
+    def __len__(self):
+        return len(self.items)
+
+
+class BatchFileHandler(logging.FileHandler):
+    """FileHandler, который пишет пачку записей одним write и не делает flush"""
+
+    def emit_batch(self, records):
+        lines = []
+        for record in records:
+            if record.levelno < self.level or not self.filter(record):
+                continue
+            try:
+                lines.append(self.format(record))
+            except Exception:
+                self.handleError(record)
+        if not lines:
+            return
+        with self.lock:
+            if self.stream is None:
+                self.stream = self._open()
+            try:
+                self.stream.write("\n".join(lines) + "\n")
+            except Exception:
+                self.handleError(records[-1])
+
+
+class AsyncQueueHandler(logging.Handler):
+    """Фронтенд конвейера: готовит запись и кладёт её в очередь"""
+
+    def __init__(self, pipeline):
+        super().__init__()
+        self.pipeline = pipeline
+        self._exc_formatter = logging.Formatter()
+
+    def prepare(self, record):
+        # Сообщение собираем сразу: аргументы могут измениться после возврата
+        record.msg = record.getMessage()
+        record.args = None
+        if record.exc_info:
+            record.exc_text = self._exc_formatter.formatException(record.exc_info)
+            record.exc_info = None
+        return record
+
+    def emit(self, record):
+        try:
+            self.pipeline.queue.put_nowait(self.prepare(record))
+        except Exception:
+            self.handleError(record)
+
+    def close(self):
+        self.pipeline.stop()
+        super().close()
+
+
+class AsyncLogPipeline:
+    """Очередь + фоновый writer, пишущий в целевые обработчики"""
+
+    def __init__(
+        self,
+        handlers,
+        queue_size=LOG_QUEUE_SIZE,
+        overflow=LOG_OVERFLOW,
+        batch_size=LOG_BATCH_SIZE,
+        flush_interval=LOG_FLUSH_INTERVAL,
+        name="log",
+    ):
+        self.handlers = list(handlers)
+        self.queue = BoundedLogQueue(queue_size, overflow)
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        self.name = name
+        self.reported_dropped = 0
+        self.write_lock = threading.Lock()
+        self._stop = threading.Event()
+        self._thread = None
+        os.register_at_fork(
+            before=self._before_fork,
+            after_in_parent=self._after_fork_parent,
+            after_in_child=self._after_fork_child,
+        )
+
+    def start(self):
+        self._stop.clear()
+        self._thread = threading.Thread(
+            target=self._run, name=f"{self.name}-writer", daemon=True
+        )
+        self._thread.start()
+
+    def stop(self, timeout=5.0):
+        """Дописывает очередь и сбрасывает буферы на диск"""
+        thread = self._thread
+        if thread is None:
+            return
+        self._thread = None
+        self._stop.set()
+        with self.queue.lock:
+            self.queue.not_empty.notify_all()
+        thread.join(timeout)
+        self._drain()
+        self._flush()
+
+    def _run(self):
+        last_flush = time.monotonic()
+        while not self._stop.is_set():
+            batch = self.queue.get_batch(self.batch_size, self.flush_interval)
+            with self.write_lock:
+                if batch:
+                    self._write(batch)
+                self._report_dropped()
+                if time.monotonic() - last_flush >= self.flush_interval:
+                    self._flush()
+                    last_flush = time.monotonic()
+
+    def _drain(self):
+        with self.write_lock:
+            while True:
+                batch = self.queue.get_batch(self.batch_size, 0)
+                if not batch:
+                    break
+                self._write(batch)
+            self._report_dropped()
+
+    def _write(self, batch):
+        for handler in self.handlers:
+            emit_batch = getattr(handler, "emit_batch", None)
+            if emit_batch is not None:
+                emit_batch(batch)
+            else:
+                for record in batch:
+                    if record.levelno >= handler.level:
+                        handler.handle(record)
+
+    def _flush(self):
+        for handler in self.handlers:
+            handler.flush()
+
+    def _report_dropped(self):
+        dropped = self.queue.dropped
+        if dropped == self.reported_dropped:
+            return
+        record = logging.LogRecord(
+            self.name,
+            logging.WARNING,
+            __file__,
+            0,
+            "Очередь логов переполнена: записи отброшены",
+            None,
+            None,
+            func="_report_dropped",
+        )
+        record.dropped_records = dropped - self.reported_dropped
+        record.dropped_total = dropped
+        self.reported_dropped = dropped
+        self._write([record])
+
+    # Writer не переживает fork: в дочернем процессе запускаем новый, а то,
+    # что уже лежит в очереди и буферах, допишет родитель
+    def _before_fork(self):
+        self.write_lock.acquire()
+        self._flush()
+
+    def _after_fork_parent(self):
+        self.write_lock.release()
+
+    def _after_fork_child(self):
+        self.write_lock = threading.Lock()
+        self.queue._reset()
+        self.reported_dropped = self.queue.dropped
+        if self._thread is not None:
+            self.start()
+
+
+def install(logger, **options):
+    """Переводит обработчики logger на фоновую запись.
+
+    Текущие обработчики становятся целями writer'а, у логгера остаётся один
+    AsyncQueueHandler. Фильтры логгера по-прежнему выполняются в потоке
+    запроса. LOG_ASYNC=0 оставляет синхронную запись.
+    """
+    if not LOG_ASYNC:
+        return None
+    pipeline = AsyncLogPipeline(logger.handlers, name=logger.name, **options)
+    logger.handlers = [AsyncQueueHandler(pipeline)]
+    pipeline.start()
+    atexit.register(pipeline.stop)
+    return pipeline
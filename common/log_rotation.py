@@ -0,0 +1,257 @@
+import fcntl
+import gzip
+import os
+import queue
+import shutil
+import threading
+import time
+
+from common.log_pipeline import BatchFileHandler
+
+# --- Ротация логов по размеру и времени со сжатием в фоне ---
+# Текущий файл переименовывается в <имя>.<время> (тот же inode — fluent-bit
+# дочитывает его по открытому дескриптору), на его месте создаётся новый.
+# Через LOG_ROTATE_COMPRESS_DELAY секунд сегмент сжимается в .gz фоновым
+# потоком, лишние сегменты сверх LOG_ROTATE_BACKUPS удаляются.
+# Сегменты не совпадают с маской *.log, поэтому tail их повторно не читает.
+
+LOG_ROTATE_MAX_BYTES = int(os.getenv("LOG_ROTATE_MAX_BYTES", str(50 * 1024 * 1024)))
+LOG_ROTATE_INTERVAL = int(os.getenv("LOG_ROTATE_INTERVAL", "86400"))
+LOG_ROTATE_BACKUPS = int(os.getenv("LOG_ROTATE_BACKUPS", "7"))
+LOG_ROTATE_COMPRESS = os.getenv("LOG_ROTATE_COMPRESS", "1").lower() in (
+    "1",
+    "true",
+    "yes",
+    "on",
+)
+# Должна быть больше Rotate_Wait у fluent-bit (по умолчанию 5 с)
+LOG_ROTATE_COMPRESS_DELAY = float(os.getenv("LOG_ROTATE_COMPRESS_DELAY", "15"))
+
+SEGMENT_TIME_FORMAT = "%Y%m%d-%H%M%S"
+
+
+class SegmentCompressor:
+    """Фоновый поток: сжимает ротированные сегменты и удаляет старые"""
+
+    def __init__(self):
+        self.tasks = queue.Queue()
+        self._thread = None
+        self._lock = threading.Lock()
+        os.register_at_fork(after_in_child=self._after_fork_child)
+
+    def submit(self, handler):
+        with self._lock:
+            if self._thread is None:
+                self._thread = threading.Thread(
+                    target=self._run, name="log-compressor", daemon=True
+                )
+                self._thread.start()
+        self.tasks.put((time.monotonic() + handler.compress_delay, handler))
+
+    def _run(self):
+        while True:
+            due, handler = self.tasks.get()
+            delay = due - time.monotonic()
+            if delay > 0:
+                time.sleep(delay)
+            handler.maintain()
+
+    def _after_fork_child(self):
+        self.tasks = queue.Queue()
+        self._thread = None
+        self._lock = threading.Lock()
+
+
+compressor = SegmentCompressor()
+
+
+def compress_segment(segment):
+    target = segment + ".gz"
+    try:
+        with open(segment, "rb") as src, gzip.open(target + ".tmp", "wb") as dst:
+            shutil.copyfileobj(src, dst, 1024 * 1024)
+        os.replace(target + ".tmp", target)
+        os.remove(segment)
+    except FileNotFoundError:
+        pass  # сегмент уже сжат или удалён другим процессом
+    except OSError:
+        try:
+            os.remove(target + ".tmp")
+        except OSError:
+            pass
+
+
+class RotatingBatchFileHandler(BatchFileHandler):
+    """BatchFileHandler с ротацией по размеру и времени.
+
+    Безопасен для нескольких процессов (prefork): ротацию выполняет тот, кто
+    первым взял flock, а остальные по смене inode просто переоткрывают файл.
+    """
+
+    def __init__(
+        self,
+        filename,
+        mode="a",
+        encoding="utf-8",
+        max_bytes=LOG_ROTATE_MAX_BYTES,
+        interval=LOG_ROTATE_INTERVAL,
+        backup_count=LOG_ROTATE_BACKUPS,
+        compress=LOG_ROTATE_COMPRESS,
+        compress_delay=LOG_ROTATE_COMPRESS_DELAY,
+    ):
+        self.max_bytes = max_bytes
+        self.interval = interval
+        self.backup_count = backup_count
+        self.compress = compress
+        self.compress_delay = compress_delay
+        self.rollover_at = None
+        self._held_lock = None  # .lock, пока его flock держит _rollover
+        super().__init__(filename, mode, encoding)
+
+    def _open(self):
+        stream = super()._open()
+        if self.interval > 0:
+            try:
+                started = self._segment_started(stream)
+            except OSError:
+                started = time.time()
+            self.rollover_at = started + self.interval
+        return stream
+
+    def _segment_started(self, stream):
+        """Когда начат текущий файл лога.
+
+        ctime файла — время последней записи, а не создания: по нему каждый
+        перезапуск отодвигал бы ротацию по времени. Начало сегмента хранится
+        в .lock вместе с inode файла; чужой inode — файл новый, начат сейчас.
+        """
+        inode = os.fstat(stream.fileno()).st_ino
+        if self._held_lock is not None:
+            return self._read_segment_start(self._held_lock, inode)
+        with open(self.baseFilename + ".lock", "a+") as lock_file:
+            fcntl.flock(lock_file, fcntl.LOCK_EX)
+            try:
+                return self._read_segment_start(lock_file, inode)
+            finally:
+                fcntl.flock(lock_file, fcntl.LOCK_UN)
+
+    @staticmethod
+    def _read_segment_start(lock_file, inode):
+        lock_file.seek(0)
+        try:
+            recorded_inode, started = lock_file.read().split()
+            if int(recorded_inode) == inode:
+                return float(started)
+        except ValueError:
+            pass
+        started = time.time()
+        lock_file.truncate(0)
+        lock_file.write(f"{inode} {started}\n")
+        lock_file.flush()
+        return started
+
+    def emit(self, record):
+        self._check_rollover()
+        super().emit(record)
+
+    def emit_batch(self, records):
+        self._check_rollover()
+        super().emit_batch(records)
+
+    def _check_rollover(self):
+        with self.lock:
+            if self.stream is None:
+                return
+            if self._reopen_if_rotated():
+                return
+            if self._should_rollover():
+                self._rollover()
+
+    def _stream_stat(self):
+        self.stream.flush()
+        return os.fstat(self.stream.fileno())
+
+    def _reopen_if_rotated(self):
+        """Файл переименовал другой процесс — переоткрываем по имени"""
+        try:
+            path_stat = os.stat(self.baseFilename)
+        except FileNotFoundError:
+            path_stat = None
+        own = self._stream_stat()
+        if path_stat is not None and (path_stat.st_dev, path_stat.st_ino) == (
+            own.st_dev,
+            own.st_ino,
+        ):
+            return False
+        self.stream.close()
+        self.stream = self._open()
+        return True
+
+    def _should_rollover(self):
+        if self.max_bytes > 0 and self._stream_stat().st_size >= self.max_bytes:
+            return True
+        return self.rollover_at is not None and time.time() >= self.rollover_at
+
+    def _rollover(self):
+        lock_path = self.baseFilename + ".lock"
+        with open(lock_path, "a+") as lock_file:
+            fcntl.flock(lock_file, fcntl.LOCK_EX)
+            # Повторный flock из _open на новом дескрипторе заблокировал бы сам себя
+            self._held_lock = lock_file
+            try:
+                # Пока ждали блокировку, файл мог ротировать соседний процесс
+                if self._reopen_if_rotated():
+                    return
+                segment = self._segment_name()
+                self.stream.close()
+                self.stream = None
+                os.rename(self.baseFilename, segment)
+                self.stream = self._open()
+            finally:
+                self._held_lock = None
+                fcntl.flock(lock_file, fcntl.LOCK_UN)
+        compressor.submit(self)
+
+    def _segment_name(self):
+        stamp = time.strftime(SEGMENT_TIME_FORMAT, time.gmtime())
+        segment = f"{self.baseFilename}.{stamp}"
+        suffix = 1
+        while os.path.exists(segment) or os.path.exists(segment + ".gz"):
+            segment = f"{self.baseFilename}.{stamp}.{suffix}"
+            suffix += 1
+        return segment
+
+    def maintain(self):
+        """Сжимает выдержанные сегменты и удаляет лишние, начиная со старых.
+
+        Обходит каталог целиком: подбирает и сегменты, оставшиеся несжатыми
+        после перезапуска или от завершившегося воркера.
+        """
+        segments = self._segments()
+        if self.compress:
+            ready = time.time() - self.compress_delay
+            for mtime, path in segments:
+                if not path.endswith(".gz") and mtime <= ready:
+                    compress_segment(path)
+            segments = self._segments()
+        for _, path in segments[: max(0, len(segments) - self.backup_count)]:
+            try:
+                os.remove(path)
+            except FileNotFoundError:
+                pass
+
+    def _segments(self):
+        """Ротированные сегменты [(mtime, путь)], старые первыми"""
+        directory, base = os.path.split(self.baseFilename)
+        prefix = base + "."
+        segments = []
+        for name in os.listdir(directory or "."):
+            if not name.startswith(prefix) or name.endswith((".lock", ".tmp")):
+                continue
+            path = os.path.join(directory, name)
+            try:
+                segments.append((os.stat(path).st_mtime, path))
+            except FileNotFoundError:
+                continue
+        segments.sort()
+        return segments
@@ -0,0 +1,134 @@
+import atexit
+import logging
+import os
+import random
+import threading
+import time
+
+# --- Сэмплирование и агрегация частых диагностических событий ---
+# Для событий из правил в лог попадает только доля rate записей, а все
+# остальные учитываются счётчиком. Раз в LOG_AGGREGATE_INTERVAL секунд
+# счётчики сбрасываются в лог одной записью на событие:
+#   "IP_CHECK x 3412 in 10s"
+# Записи уровня WARNING и выше не сэмплируются никогда.
+#
+# LOG_SAMPLE_RATES дополняет/переопределяет правила сервиса:
+#   LOG_SAMPLE_RATES="IP_CHECK=0,HEADER_IP=0.05,Извлечён индекс=0.1"
+
+LOG_SAMPLING = os.getenv("LOG_SAMPLING", "1").lower() in ("1", "true", "yes", "on")
+LOG_SAMPLE_RATES = os.getenv("LOG_SAMPLE_RATES", "")
+LOG_AGGREGATE_INTERVAL = float(os.getenv("LOG_AGGREGATE_INTERVAL", "10"))
+
+ALWAYS_KEEP_LEVEL = logging.WARNING
+
+
+def parse_rates(value):
+    """'EVENT=0.1,OTHER=0' -> {"EVENT": 0.1, "OTHER": 0.0}"""
+    rates = {}
+    for item in value.split(","):
+        if "=" not in item:
+            continue
+        event, rate = item.rsplit("=", 1)
+        try:
+            rates[event.strip()] = min(1.0, max(0.0, float(rate)))
+        except ValueError:
+            continue
+    return rates
+
+
+class SamplingFilter(logging.Filter):
+    """Фильтр логгера: сэмплирует события из правил и считает отброшенные.
+
+    Событие определяется по первому из event_fields, найденному в правилах,
+    а если ни одно не подошло — по шаблону сообщения (record.msg).
+    """
+
+    def __init__(
+        self,
+        logger,
+        rates,
+        event_fields=("request", "action"),
+        interval=LOG_AGGREGATE_INTERVAL,
+    ):
+        super().__init__()
+        self.logger = logger
+        self.rates = dict(rates)
+        self.rates.update(parse_rates(LOG_SAMPLE_RATES))
+        self.event_fields = event_fields
+        self.interval = interval
+        self.lock = threading.Lock()
+        self.counts = {}  # событие -> [всего, записано]
+        self.window_start = time.monotonic()
+
+    def _event(self, record):
+        for field in self.event_fields:
+            value = getattr(record, field, None)
+            if value in self.rates:
+                return value
+        if isinstance(record.msg, str) and record.msg in self.rates:
+            return record.msg
+        return None
+
+    def filter(self, record):
+        if getattr(record, "aggregated", False):
+            return True
+        self._maybe_flush()
+        if record.levelno >= ALWAYS_KEEP_LEVEL:
+            return True
+        event = self._event(record)
+        if event is None:
+            return True
+
+        rate = self.rates[event]
+        keep = rate >= 1.0 or (rate > 0.0 and random.random() < rate)
+        with self.lock:
+            counter = self.counts.get(event)
+            if counter is None:
+                counter = self.counts[event] = [0, 0]
+            counter[0] += 1
+            if keep:
+                counter[1] += 1
+        if keep:
+            record.sample_rate = rate
+        return keep
+
+    def _maybe_flush(self):
+        if time.monotonic() - self.window_start >= self.interval:
+            self.flush()
+
+    def flush(self):
+        """Пишет накопленные счётчики и начинает новое окно"""
+        with self.lock:
+            now = time.monotonic()
+            window = now - self.window_start
+            counts, self.counts = self.counts, {}
+            self.window_start = now
+        for event, (total, kept) in counts.items():
+            record = self.logger.makeRecord(
+                self.logger.name,
+                logging.INFO,
+                __file__,
+                0,
+                f"{event} x {total} in {window:.0f}s",
+                None,
+                None,
+                func="flush",
+                extra={
+                    "aggregated": True,
+                    "event": event,
+                    "count": total,
+                    "sampled": kept,
+                    "window_s": round(window, 1),
+                },
+            )
+            self.logger.handle(record)
+
+
+def install(logger, rates, event_fields=("request", "action")):
+    """Добавляет SamplingFilter к логгеру (LOG_SAMPLING=0 — отключено)"""
+    if not LOG_SAMPLING:
+        return None
+    sampling = SamplingFilter(logger, rates, event_fields)
+    logger.addFilter(sampling)
+    atexit.register(sampling.flush)
+    return sampling
@@ -0,0 +1,271 @@
+import gc
+import json
+import os
+import threading
+import time
+import tracemalloc
+from urllib.parse import parse_qs, urlsplit
+
+from common import profiling
+
+# --- Диагностика памяти ---
+# GET /debug/memory (тот же токен, что у /debug/profile) отдаёт RSS процесса,
+# лимит и потребление cgroup, размеры внутренних кэшей и, если включён
+# tracemalloc, топ мест выделения памяти. Каждый вызов запоминает снимок,
+# следующий показывает разницу с ним — видно, что выросло между вызовами.
+#
+# Сторож раз в MEMORY_WATCHDOG_INTERVAL секунд сравнивает RSS с долей
+# MEMORY_WATCHDOG_FRACTION от лимита cgroup и при превышении пишет в лог ту
+# же сводку — она остаётся в логах, даже если процесс затем убьёт OOM killer.
+#
+# Под prefork всё считается по воркеру; лимит cgroup — общий на контейнер.
+
+MEMORY_PATH = os.getenv("MEMORY_PATH", "/debug/memory")
+# Глубина стека tracemalloc; 0 — не запускать при старте (?tracemalloc=start)
+MEMORY_TRACEMALLOC = int(os.getenv("MEMORY_TRACEMALLOC", "0"))
+MEMORY_TOP = int(os.getenv("MEMORY_TOP", "20"))
+MEMORY_WATCHDOG_FRACTION = float(os.getenv("MEMORY_WATCHDOG_FRACTION", "0.8"))
+MEMORY_WATCHDOG_INTERVAL = float(os.getenv("MEMORY_WATCHDOG_INTERVAL", "10"))
+# Повторная запись не чаще, чем раз в столько секунд, пока RSS выше порога
+MEMORY_WATCHDOG_COOLDOWN = float(os.getenv("MEMORY_WATCHDOG_COOLDOWN", "300"))
+
+PAGE_SIZE = os.sysconf("SC_PAGE_SIZE") if hasattr(os, "sysconf") else 4096
+# memory.limit_in_bytes без лимита в cgroup v1 — близко к 2**63
+UNLIMITED = 1 << 60
+
+# Служебные выделения самого tracemalloc и импорта в отчёт не попадают
+_SNAPSHOT_FILTERS = (
+    tracemalloc.Filter(False, tracemalloc.__file__),
+    tracemalloc.Filter(False, "<frozen importlib._bootstrap>"),
+    tracemalloc.Filter(False, "<frozen importlib._bootstrap_external>"),
+    tracemalloc.Filter(False, "<unknown>"),
+)
+
+# имя -> (число записей, байты или None)
+_caches = {}
+
+
+def register_cache(name, entries, nbytes=None):
+    """Кэш в сводке: entries() — число записей, nbytes() — оценка в байтах"""
+    _caches[name] = (entries, nbytes)
+
+
+def rss_bytes():
+    try:
+        with open("/proc/self/statm") as f:
+            return int(f.read().split()[1]) * PAGE_SIZE
+    except (OSError, ValueError, IndexError):
+        import resource
+
+        return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024
+
+
+def peak_rss_bytes():
+    try:
+        with open("/proc/self/status") as f:
+            for line in f:
+                if line.startswith("VmHWM:"):
+                    return int(line.split()[1]) * 1024
+    except (OSError, ValueError):
+        pass
+    return None
+
+
+def _read_int(path):
+    try:
+        with open(path) as f:
+            value = f.read().strip()
+    except OSError:
+        return None
+    if value == "max":
+        return None
+    try:
+        return int(value)
+    except ValueError:
+        return None
+
+
+def cgroup_memory():
+    """(лимит, потребление) контейнера в байтах: cgroup v2, затем v1"""
+    limit = _read_int("/sys/fs/cgroup/memory.max")
+    usage = _read_int("/sys/fs/cgroup/memory.current")
+    if limit is None and usage is None:
+        limit = _read_int("/sys/fs/cgroup/memory/memory.limit_in_bytes")
+        usage = _read_int("/sys/fs/cgroup/memory/memory.usage_in_bytes")
+    if limit is not None and limit >= UNLIMITED:
+        limit = None
+    return limit, usage
+
+
+def cache_sizes():
+    result = {}
+    for name, (entries, nbytes) in list(_caches.items()):
+        try:
+            info = {"entries": entries()}
+            if nbytes is not None:
+                info["bytes"] = nbytes()
+        except Exception as e:
+            info = {"error": str(e)}
+        result[name] = info
+    return result
+
+
+def _stat_entry(stat):
+    frame = stat.traceback[0]
+    return {
+        "site": f"{frame.filename}:{frame.lineno}",
+        "size": stat.size,
+        "count": stat.count,
+    }
+
+
+def _diff_entry(stat):
+    entry = _stat_entry(stat)
+    entry["size_diff"] = stat.size_diff
+    entry["count_diff"] = stat.count_diff
+    return entry
+
+
+class _State:
+    """Последний снимок и сторож; после fork у воркера — свои"""
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.snapshot = None
+        self.snapshot_time = None
+        self.watchdog = None
+        os.register_at_fork(after_in_child=self._after_fork_child)
+
+    def _after_fork_child(self):
+        self.lock = threading.Lock()
+        self.snapshot = None
+        self.snapshot_time = None
+        if self.watchdog is not None:
+            self.watchdog = Watchdog(self.watchdog.logger, self.watchdog.fraction)
+            self.watchdog.start()
+
+
+_state = _State()
+
+
+def report(top=MEMORY_TOP, snapshot=True):
+    """Сводка по памяти процесса; snapshot=True — с топом и разницей tracemalloc"""
+    limit, usage = cgroup_memory()
+    rss = rss_bytes()
+    result = {
+        "pid": os.getpid(),
+        "rss_bytes": rss,
+        "peak_rss_bytes": peak_rss_bytes(),
+        "cgroup_limit_bytes": limit,
+        "cgroup_usage_bytes": usage,
+        "rss_fraction": round(rss / limit, 3) if limit else None,
+        "gc_counts": gc.get_count(),
+        "caches": cache_sizes(),
+        "tracemalloc": {"tracing": tracemalloc.is_tracing()},
+    }
+    if not tracemalloc.is_tracing():
+        return result
+
+    current, peak = tracemalloc.get_traced_memory()
+    info = result["tracemalloc"]
+    info["traced_bytes"] = current
+    info["traced_peak_bytes"] = peak
+    info["overhead_bytes"] = tracemalloc.get_tracemalloc_memory()
+    if not snapshot:
+        return result
+
+    new = tracemalloc.take_snapshot().filter_traces(_SNAPSHOT_FILTERS)
+    info["top"] = [_stat_entry(s) for s in new.statistics("lineno")[:top]]
+    with _state.lock:
+        previous, previous_time = _state.snapshot, _state.snapshot_time
+        _state.snapshot, _state.snapshot_time = new, time.time()
+    if previous is not None:
+        diff = new.compare_to(previous, "lineno")
+        info["diff_since"] = previous_time
+        info["diff"] = [_diff_entry(s) for s in diff[:top] if s.size_diff]
+    return result
+
+
+class Watchdog:
+    """Пишет сводку в лог, когда RSS превышает долю лимита cgroup"""
+
+    def __init__(self, logger, fraction=MEMORY_WATCHDOG_FRACTION):
+        self.logger = logger
+        self.fraction = fraction
+        self.last_report = 0.0
+        self._thread = None
+
+    def start(self):
+        self._thread = threading.Thread(
+            target=self._run, name="memory-watchdog", daemon=True
+        )
+        self._thread.start()
+
+    def _run(self):
+        while True:
+            time.sleep(MEMORY_WATCHDOG_INTERVAL)
+            try:
+                self.check()
+            except Exception:
+                self.logger.exception("Ошибка сторожа памяти")
+
+    def check(self):
+        limit, usage = cgroup_memory()
+        if not limit:
+            return False
+        rss = rss_bytes()
+        if rss < limit * self.fraction:
+            return False
+        now = time.monotonic()
+        if self.last_report and now - self.last_report < MEMORY_WATCHDOG_COOLDOWN:
+            return False
+        self.last_report = now
+        # Снимок не запоминаем: он займёт память, которой и так мало
+        summary = report(top=10, snapshot=False)
+        if tracemalloc.is_tracing():
+            stats = tracemalloc.take_snapshot().filter_traces(_SNAPSHOT_FILTERS)
+            summary["tracemalloc"]["top"] = [
+                _stat_entry(s) for s in stats.statistics("lineno")[:10]
+            ]
+        self.logger.warning(
+            "RSS приближается к лимиту памяти контейнера",
+            extra={"memory": summary, "threshold": self.fraction},
+        )
+        return True
+
+
+def _json_response(status, payload):
+    return status, "application/json", json.dumps(payload, ensure_ascii=False)
+
+
+def _memory_route(handler):
+    if not profiling.authorized(handler.headers):
+        return _json_response(403, {"error": "Доступ запрещён"})
+    query = parse_qs(urlsplit(handler.path).query)
+    action = query.get("tracemalloc", [""])[0]
+    if action == "start" and not tracemalloc.is_tracing():
+        tracemalloc.start(max(1, MEMORY_TRACEMALLOC))
+    elif action == "stop" and tracemalloc.is_tracing():
+        tracemalloc.stop()
+        with _state.lock:
+            _state.snapshot = _state.snapshot_time = None
+    try:
+        top = max(1, min(int(query.get("top", [MEMORY_TOP])[0]), 500))
+    except ValueError:
+        top = MEMORY_TOP
+    return _json_response(200, report(top))
+
+
+def install(fast_path):
+    """tracemalloc по MEMORY_TRACEMALLOC, сторож RSS и (с токеном) /debug/memory"""
+    if MEMORY_TRACEMALLOC > 0 and not tracemalloc.is_tracing():
+        tracemalloc.start(MEMORY_TRACEMALLOC)
+    if (
+        fast_path.logger is not None
+        and MEMORY_WATCHDOG_FRACTION > 0
+        and _state.watchdog is None
+    ):
+        _state.watchdog = Watchdog(fast_path.logger)
+        _state.watchdog.start()
+    if profiling.PROFILE_TOKEN:
+        fast_path.add_route(MEMORY_PATH, _memory_route)
@@ -0,0 +1,395 @@
+import bisect
+import math
+import os
+import threading
+import time
+
+from common import tracing
+
+# --- Метрики в формате Prometheus без внешних зависимостей ---
+# Реестр создаётся при импорте, сервисы заводят в нём свои метрики, а
+# install() добавляет GET /metrics в FastPath. Блокировка — своя у каждой
+# серии (метрика + значения меток) и держится только на время сложения;
+# блокировка метрики берётся лишь при создании новой серии.
+#
+# Под prefork каждый воркер считает своё: /metrics отдаёт метрики того
+# воркера, которому ядро отдало соединение (метка worker в process_info).
+
+METRICS_ENABLED = os.getenv("METRICS_ENABLED", "1").lower() in ("1", "true", "yes", "on")
+METRICS_PATH = os.getenv("METRICS_PATH", "/metrics")
+
+CONTENT_TYPE = "text/plain; version=0.0.4; charset=utf-8"
+
+# Секунды: от 1 мс (быстрый путь) до 10 с (таймауты внешних API)
+DEFAULT_BUCKETS = (
+    0.001,
+    0.0025,
+    0.005,
+    0.01,
+    0.025,
+    0.05,
+    0.1,
+    0.25,
+    0.5,
+    1.0,
+    2.5,
+    5.0,
+    10.0,
+)
+
+
+def _format_value(value):
+    if value == math.inf:
+        return "+Inf"
+    if value == -math.inf:
+        return "-Inf"
+    if isinstance(value, float) and value.is_integer():
+        return str(int(value))
+    return repr(value)
+
+
+def _escape(value):
+    return str(value).replace("\\", r"\\").replace("\n", r"\n").replace('"', r"\"")
+
+
+def _labels_text(names, values, extra=()):
+    pairs = [f'{n}="{_escape(v)}"' for n, v in zip(names, values)]
+    pairs.extend(f'{n}="{_escape(v)}"' for n, v in extra)
+    return "{" + ",".join(pairs) + "}" if pairs else ""
+
+
+class _CounterChild:
+    __slots__ = ("_lock", "value")
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.value = 0.0
+
+    def inc(self, amount=1):
+        with self._lock:
+            self.value += amount
+
+
+class _GaugeChild:
+    __slots__ = ("_lock", "value", "function")
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.value = 0.0
+        self.function = None
+
+    def set(self, value):
+        self.value = value
+
+    def inc(self, amount=1):
+        with self._lock:
+            self.value += amount
+
+    def dec(self, amount=1):
+        with self._lock:
+            self.value -= amount
+
+    def set_function(self, function):
+        """Значение вычисляется при каждом чтении /metrics"""
+        self.function = function
+
+    def get(self):
+        if self.function is not None:
+            return self.function()
+        return self.value
+
+
+class _Timer:
+    __slots__ = ("child", "start")
+
+    def __init__(self, child):
+        self.child = child
+
+    def __enter__(self):
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        self.child.observe(time.perf_counter() - self.start)
+        return False
+
+
+class _HistogramChild:
+    __slots__ = ("_lock", "upper_bounds", "counts", "sum")
+
+    def __init__(self, upper_bounds):
+        self._lock = threading.Lock()
+        self.upper_bounds = upper_bounds
+        self.counts = [0] * (len(upper_bounds) + 1)  # последний — +Inf
+        self.sum = 0.0
+
+    def observe(self, value):
+        index = bisect.bisect_left(self.upper_bounds, value)
+        with self._lock:
+            self.counts[index] += 1
+            self.sum += value
+
+    def time(self):
+        return _Timer(self)
+
+
+class Metric:
+    """Метрика; серия для конкретных значений меток — labels(...)"""
+
+    kind = None
+
+    def __init__(self, name, documentation, labelnames=()):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        self._children = {}
+        self._lock = threading.Lock()
+        if not self.labelnames:
+            self._default = self.labels()
+
+    def _new_child(self):
+        raise NotImplementedError
+
+    def labels(self, *values):
+        values = tuple(str(v) for v in values)
+        child = self._children.get(values)
+        if child is None:
+            if len(values) != len(self.labelnames):
+                raise ValueError(
+                    f"{self.name}: ожидались метки {self.labelnames}, получено {values}"
+                )
+            with self._lock:
+                child = self._children.setdefault(values, self._new_child())
+        return child
+
+    def render(self, lines):
+        lines.append(f"# HELP {self.name} {self.documentation}")
+        lines.append(f"# TYPE {self.name} {self.kind}")
+        for values, child in sorted(self._children.items()):
+            self._render_child(lines, values, child)
+
+    def _render_child(self, lines, values, child):
+        raise NotImplementedError
+
+
+class Counter(Metric):
+    kind = "counter"
+
+    def _new_child(self):
+        return _CounterChild()
+
+    def inc(self, amount=1):
+        self._default.inc(amount)
+
+    @property
+    def value(self):
+        return self._default.value
+
+    def _render_child(self, lines, values, child):
+        labels = _labels_text(self.labelnames, values)
+        lines.append(f"{self.name}{labels} {_format_value(child.value)}")
+
+
+class Gauge(Metric):
+    kind = "gauge"
+
+    def _new_child(self):
+        return _GaugeChild()
+
+    def set(self, value):
+        self._default.set(value)
+
+    def inc(self, amount=1):
+        self._default.inc(amount)
+
+    def dec(self, amount=1):
+        self._default.dec(amount)
+
+    def set_function(self, function):
+        self._default.set_function(function)
+
+    def get(self):
+        return self._default.get()
+
+    def _render_child(self, lines, values, child):
+        try:
+            value = child.get()
+        except Exception:
+            return
+        labels = _labels_text(self.labelnames, values)
+        lines.append(f"{self.name}{labels} {_format_value(float(value))}")
+
+
+class Histogram(Metric):
+    kind = "histogram"
+
+    def __init__(self, name, documentation, labelnames=(), buckets=DEFAULT_BUCKETS):
+        self.upper_bounds = tuple(sorted(float(b) for b in buckets))
+        super().__init__(name, documentation, labelnames)
+
+    def _new_child(self):
+        return _HistogramChild(self.upper_bounds)
+
+    def observe(self, value):
+        self._default.observe(value)
+
+    def time(self):
+        return self._default.time()
+
+    def _render_child(self, lines, values, child):
+        with child._lock:
+            counts = list(child.counts)
+            total = child.sum
+        cumulative = 0
+        for bound, count in zip(self.upper_bounds + (math.inf,), counts):
+            cumulative += count
+            labels = _labels_text(
+                self.labelnames, values, (("le", _format_value(bound)),)
+            )
+            lines.append(f"{self.name}_bucket{labels} {cumulative}")
+        labels = _labels_text(self.labelnames, values)
+        lines.append(f"{self.name}_sum{labels} {_format_value(total)}")
+        lines.append(f"{self.name}_count{labels} {cumulative}")
+
+
+class Registry:
+    def __init__(self):
+        self._metrics = {}
+        self._lock = threading.Lock()
+
+    def _register(self, cls, name, documentation, labelnames, **kwargs):
+        with self._lock:
+            metric = self._metrics.get(name)
+            if metric is None:
+                metric = cls(name, documentation, labelnames, **kwargs)
+                self._metrics[name] = metric
+            elif not isinstance(metric, cls) or metric.labelnames != tuple(labelnames):
+                raise ValueError(f"Метрика {name} уже зарегистрирована иначе")
+            return metric
+
+    def counter(self, name, documentation, labelnames=()):
+        return self._register(Counter, name, documentation, labelnames)
+
+    def gauge(self, name, documentation, labelnames=()):
+        return self._register(Gauge, name, documentation, labelnames)
+
+    def histogram(self, name, documentation, labelnames=(), buckets=DEFAULT_BUCKETS):
+        return self._register(
+            Histogram, name, documentation, labelnames, buckets=buckets
+        )
+
+    def render(self):
+        lines = []
+        for name in sorted(self._metrics):
+            self._metrics[name].render(lines)
+        return "\n".join(lines) + "\n"
+
+
+REGISTRY = Registry()
+counter = REGISTRY.counter
+gauge = REGISTRY.gauge
+histogram = REGISTRY.histogram
+
+
+# --- Общие метрики HTTP-сервисов ---
+
+HTTP_REQUESTS = counter(
+    "http_requests_total", "Обработанные HTTP-запросы", ("method", "status")
+)
+HTTP_LATENCY = histogram(
+    "http_request_duration_seconds",
+    "Время обработки запроса основной логикой (без быстрого пути)",
+    ("method",),
+)
+HTTP_IN_FLIGHT = gauge("http_requests_in_flight", "Запросы в обработке")
+# Метод берётся из строки запроса клиента: прочие значения сводятся в OTHER,
+# иначе любой клиент мог бы плодить серии метрик
+HTTP_METHODS = frozenset(("GET", "POST", "OPTIONS", "HEAD"))
+STAGE_LATENCY = histogram(
+    "stage_duration_seconds",
+    "Время этапов обработки, в том числе вызовов внешних API",
+    ("stage",),
+)
+STAGE_ERRORS = counter(
+    "stage_errors_total", "Этапы, завершившиеся исключением", ("stage",)
+)
+CACHE_REQUESTS = counter(
+    "cache_requests_total", "Обращения к кэшам", ("cache", "result")
+)
+CACHE_ENTRIES = gauge("cache_entries", "Записей в кэше", ("cache",))
+PROCESS_INFO = gauge("process_info", "Процесс, отдавший метрики", ("worker",))
+
+
+def cache_hit(cache):
+    CACHE_REQUESTS.labels(cache, "hit").inc()
+
+
+def cache_miss(cache):
+    CACHE_REQUESTS.labels(cache, "miss").inc()
+
+
+def observe_stage(name, duration_ms, failed):
+    STAGE_LATENCY.labels(name).observe(duration_ms / 1000)
+    if failed:
+        STAGE_ERRORS.labels(name).inc()
+
+
+class InstrumentedHandler:
+    """Примесь к BaseHTTPRequestHandler: счётчики, задержка и in-flight.
+
+    class Handler(metrics.InstrumentedHandler, BaseHTTPRequestHandler): ...
+
+    Время считается от разбора строки запроса (ожидание клиента не входит).
+    Ответы быстрого пути учитываются в http_requests_total, но не в
+    гистограмме задержки.
+    """
+
+    _metrics_start = None
+    _response_status = None
+    _fast_path = False
+
+    def parse_request(self):
+        self._metrics_start = time.perf_counter()
+        self._response_status = None
+        self._fast_path = False
+        HTTP_IN_FLIGHT.inc()
+        return super().parse_request()
+
+    def send_response_only(self, code, message=None):
+        self._response_status = code
+        super().send_response_only(code, message)
+
+    def handle_one_request(self):
+        try:
+            super().handle_one_request()
+        finally:
+            start = self._metrics_start
+            if start is not None:
+                self._metrics_start = None
+                HTTP_IN_FLIGHT.dec()
+                method = method_label(self.command)
+                HTTP_REQUESTS.labels(method, self._response_status or 0).inc()
+                if not self._fast_path:
+                    HTTP_LATENCY.labels(method).observe(time.perf_counter() - start)
+
+
+def method_label(method):
+    """Значение метки method: один из HTTP_METHODS или OTHER"""
+    return method if method in HTTP_METHODS else "OTHER"
+
+
+def render():
+    PROCESS_INFO.labels(os.getpid()).set(1)
+    return REGISTRY.render()
+
+
+def _metrics_route(handler):
+    return 200, CONTENT_TYPE, render()
+
+
+def install(fast_path):
+    """Регистрирует GET /metrics и замер этапов трассировки"""
+    if not METRICS_ENABLED:
+        return
+    tracing.add_span_observer(observe_stage)
+    fast_path.add_route(METRICS_PATH, _metrics_route)
@@ -0,0 +1,338 @@
+import logging
+import math
+import os
+import select
+import signal
+import socket
+import threading
+import time
+import traceback
+
+# --- Prefork: мастер-процесс и N воркеров на одном порту ---
+# Каждый воркер открывает свой слушающий сокет с SO_REUSEPORT, и ядро само
+# распределяет соединения между ними. Мастер следит за воркерами:
+#   SIGCHLD        — упавший воркер перезапускается;
+#   SIGHUP         — плавная перезагрузка: новое поколение воркеров,
+#                    затем SIGTERM старому;
+#   SIGTERM/SIGINT — остановка: воркеры дообрабатывают текущие запросы.
+#
+# На Unix domain socket (address — путь) SO_REUSEPORT нет: мастер сам
+# открывает один слушающий сокет, воркеры наследуют его при fork и
+# принимают соединения по очереди.
+#
+# PREFORK_WORKERS: "1" (по умолчанию) — один процесс без мастера,
+# "auto" — по квоте CPU контейнера, число — ровно столько воркеров.
+
+PREFORK_WORKERS = os.getenv("PREFORK_WORKERS", "1")
+# Сколько секунд даём воркерам дообработать запросы при остановке
+GRACEFUL_TIMEOUT = float(os.getenv("PREFORK_GRACEFUL_TIMEOUT", "30"))
+# Максимальная пауза перед перезапуском воркера, падающего сразу после старта
+MAX_RESTART_DELAY = 10.0
+# Воркер, проживший меньше этого времени, считается упавшим при старте
+MIN_WORKER_UPTIME = 1.0
+
+
+def cpu_quota():
+    """Число ядер, доступных контейнеру: cgroup v2, cgroup v1, affinity"""
+    try:
+        available = len(os.sched_getaffinity(0))
+    except AttributeError:
+        available = os.cpu_count() or 1
+
+    quota = None
+    try:
+        with open("/sys/fs/cgroup/cpu.max") as f:
+            limit, period = f.read().split()
+        if limit != "max":
+            quota = int(limit) / int(period)
+    except (OSError, ValueError):
+        try:
+            with open("/sys/fs/cgroup/cpu/cpu.cfs_quota_us") as f:
+                limit = int(f.read())
+            with open("/sys/fs/cgroup/cpu/cpu.cfs_period_us") as f:
+                period = int(f.read())
+            if limit > 0:
+                quota = limit / period
+        except (OSError, ValueError):
+            pass
+
+    if quota is not None:
+        available = min(available, max(1, math.floor(quota)))
+    return max(1, available)
+
+
+def worker_count(value=PREFORK_WORKERS):
+    if str(value).strip().lower() == "auto":
+        return cpu_quota()
+    try:
+        return max(1, int(value))
+    except (TypeError, ValueError):
+        return 1
+
+
+def _set_reuseport(sock):
+    sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+    sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEPORT, 1)
+
+
+class PreforkMaster:
+    def __init__(
+        self,
+        server_factory,
+        address,
+        workers,
+        logger=None,
+        on_worker_start=None,
+        graceful_timeout=GRACEFUL_TIMEOUT,
+    ):
+        """server_factory(address, bind_and_activate=False) -> socketserver.TCPServer"""
+        self.server_factory = server_factory
+        self.address = address
+        self.workers = workers
+        self.logger = logger
+        self.on_worker_start = on_worker_start
+        self.graceful_timeout = graceful_timeout
+        self.generation = 0
+        self.children = {}  # pid -> (слот, поколение, время старта)
+        self.pending = []  # (когда запускать, слот)
+        self.failures = {}
+        self.stopping = False
+        self.reload_requested = False
+        self.reserve_socket = None
+        self.unix_server = None  # общий слушающий UDS-сервер мастера
+
+    def _log(self, message, **fields):
+        if self.logger is not None:
+            self.logger.info(message, extra=dict(fields, prefork_pid=os.getpid()))
+
+    def run(self):
+        # Мастер занимает порт сам: если он занят не-reuseport сокетом,
+        # ошибка будет сразу, а не в каждом воркере
+        if isinstance(self.address, str):
+            self.unix_server = self.server_factory(self.address)
+            # Соединение забирает один воркер, остальные не блокируются в accept
+            self.unix_server.socket.setblocking(False)
+        else:
+            self.reserve_socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+            _set_reuseport(self.reserve_socket)
+            self.reserve_socket.bind(self.address)
+
+        wakeup_r, wakeup_w = os.pipe()
+        os.set_blocking(wakeup_r, False)
+        os.set_blocking(wakeup_w, False)
+        signal.set_wakeup_fd(wakeup_w)
+        signal.signal(signal.SIGTERM, self._on_stop)
+        signal.signal(signal.SIGINT, self._on_stop)
+        signal.signal(signal.SIGHUP, self._on_reload)
+        signal.signal(signal.SIGCHLD, lambda signum, frame: None)
+
+        self._log(
+            "Prefork: мастер запущен",
+            prefork="master_start",
+            workers=self.workers,
+            address=self.address if self.unix_server else self.address[1],
+        )
+        for slot in range(self.workers):
+            self._spawn(slot)
+
+        try:
+            while not self.stopping:
+                try:
+                    select.select([wakeup_r], [], [], 1.0)
+                except InterruptedError:
+                    pass
+                try:
+                    while os.read(wakeup_r, 512):
+                        pass
+                except BlockingIOError:
+                    pass
+                if self.reload_requested:
+                    self.reload_requested = False
+                    self._reload()
+                self._reap()
+                self._spawn_pending()
+        finally:
+            self._shutdown()
+            signal.set_wakeup_fd(-1)
+            os.close(wakeup_r)
+            os.close(wakeup_w)
+            if self.unix_server is not None:
+                self.unix_server.server_close()  # и удаляет файл сокета
+            else:
+                self.reserve_socket.close()
+
+    def _on_stop(self, signum, frame):
+        self.stopping = True
+
+    def _on_reload(self, signum, frame):
+        self.reload_requested = True
+
+    def _spawn(self, slot):
+        pid = os.fork()
+        if pid == 0:
+            code = 1
+            try:
+                self._worker()
+                code = 0
+            except BaseException:
+                # os._exit ниже не даёт исключению дойти до трейсбека:
+                # без записи здесь причина перезапусков воркера теряется
+                if self.logger is not None:
+                    self.logger.exception(
+                        "Prefork: воркер упал",
+                        extra={
+                            "prefork": "worker_crash",
+                            "prefork_pid": os.getpid(),
+                            "slot": slot,
+                        },
+                    )
+                else:
+                    traceback.print_exc()
+            finally:
+                # os._exit не вызывает atexit — дописываем логи явно
+                logging.shutdown()
+                os._exit(code)
+        self.children[pid] = (slot, self.generation, time.monotonic())
+        self._log(
+            "Prefork: воркер запущен",
+            prefork="worker_start",
+            worker_pid=pid,
+            slot=slot,
+            generation=self.generation,
+        )
+
+    def _worker(self):
+        signal.set_wakeup_fd(-1)
+        signal.signal(signal.SIGCHLD, signal.SIG_DFL)
+        # Ctrl+C и перезагрузку обрабатывает мастер
+        signal.signal(signal.SIGHUP, signal.SIG_IGN)
+        signal.signal(signal.SIGINT, signal.SIG_IGN)
+        server = self.server_factory(self.address, bind_and_activate=False)
+        if self.unix_server is not None:
+            server.socket.close()
+            server.socket = self.unix_server.socket
+        else:
+            self.reserve_socket.close()
+            try:
+                _set_reuseport(server.socket)
+                server.server_bind()
+                server.server_activate()
+            except BaseException:
+                server.server_close()
+                raise
+
+        def drain(signum, frame):
+            # shutdown() ждёт выхода из serve_forever, поэтому не из этого потока.
+            # Соединения, уже стоящие в backlog этого сокета, при закрытии
+            # будут сброшены — ядро не переносит их в соседние сокеты.
+            threading.Thread(target=server.shutdown, daemon=True).start()
+
+        signal.signal(signal.SIGTERM, drain)
+        if self.on_worker_start is not None:
+            self.on_worker_start()
+        try:
+            server.serve_forever()
+        finally:
+            server.server_close()
+
+    def _reap(self):
+        while True:
+            try:
+                pid, status = os.waitpid(-1, os.WNOHANG)
+            except ChildProcessError:
+                return
+            if pid == 0:
+                return
+            info = self.children.pop(pid, None)
+            if info is None:
+                continue
+            slot, generation, started = info
+            code = os.waitstatus_to_exitcode(status)
+            if self.stopping or generation != self.generation:
+                continue
+
+            # Воркер текущего поколения умер сам — перезапускаем с нарастающей
+            # паузой, если он падает сразу после старта
+            if time.monotonic() - started < MIN_WORKER_UPTIME:
+                self.failures[slot] = self.failures.get(slot, 0) + 1
+            else:
+                self.failures[slot] = 0
+            failures = self.failures[slot]
+            delay = min(MAX_RESTART_DELAY, 0.1 * 2**failures) if failures else 0.0
+            self.pending.append((time.monotonic() + delay, slot))
+            if self.logger is not None:
+                self.logger.warning(
+                    "Prefork: воркер завершился, перезапуск",
+                    extra={
+                        "prefork": "worker_exit",
+                        "prefork_pid": os.getpid(),
+                        "worker_pid": pid,
+                        "slot": slot,
+                        "exit_code": code,
+                        "restart_delay": delay,
+                    },
+                )
+
+    def _spawn_pending(self):
+        now = time.monotonic()
+        due = [slot for when, slot in self.pending if when <= now]
+        self.pending = [(when, slot) for when, slot in self.pending if when > now]
+        for slot in due:
+            self._spawn(slot)
+
+    def _reload(self):
+        old = list(self.children)
+        self.generation += 1
+        self.pending = []
+        self._log(
+            "Prefork: перезагрузка воркеров",
+            prefork="reload",
+            generation=self.generation,
+        )
+        # Новые воркеры уже слушают порт, когда старые перестают принимать
+        for slot in range(self.workers):
+            self._spawn(slot)
+        for pid in old:
+            self._signal(pid, signal.SIGTERM)
+
+    def _signal(self, pid, signum):
+        try:
+            os.kill(pid, signum)
+        except ProcessLookupError:
+            pass
+
+    def _shutdown(self):
+        self._log("Prefork: остановка воркеров", prefork="master_stop")
+        for pid in list(self.children):
+            self._signal(pid, signal.SIGTERM)
+        deadline = time.monotonic() + self.graceful_timeout
+        while self.children and time.monotonic() < deadline:
+            self._reap()
+            time.sleep(0.05)
+        for pid in list(self.children):
+            self._signal(pid, signal.SIGKILL)
+        while self.children:
+            try:
+                pid, _ = os.waitpid(-1, 0)
+            except ChildProcessError:
+                break
+            self.children.pop(pid, None)
+
+
+def serve(
+    server_factory,
+    address,
+    workers,
+    logger=None,
+    on_worker_start=None,
+    graceful_timeout=GRACEFUL_TIMEOUT,
+):
+    """Запускает мастер с workers воркерами; возвращается после остановки"""
+    PreforkMaster(
+        server_factory,
+        address,
+        workers,
+        logger=logger,
+        on_worker_start=on_worker_start,
+        graceful_timeout=graceful_timeout,
+    ).run()
@@ -0,0 +1,367 @@
+import collections
+import cProfile
+import hmac
+import io
+import json
+import os
+import pstats
+import sys
+import tempfile
+import threading
+import time
+from urllib.parse import parse_qs, urlsplit
+
+from common.fastpath import build_response
+
+# --- Профилирование под живым трафиком ---
+# Включается только при заданном PROFILE_TOKEN; без него эндпоинт не
+# регистрируется. Токен передаётся в заголовке X-Debug-Token или
+# Authorization: Bearer.
+#
+#   GET /debug/profile?seconds=N — запускает сэмплирующий профайлер: фоновый
+#       поток раз в PROFILE_INTERVAL_MS снимает стеки всех потоков через
+#       sys._current_frames(). Сервисы однопоточные, поэтому ответ приходит
+#       сразу (202 с id), а результат забирается по
+#   GET /debug/profile?id=ID — collapsed stacks ("a;b;c 42" построчно) для
+#       flamegraph.pl/speedscope; пока замер идёт — 202 с Retry-After.
+#   Заголовок X-Profile: 1 у обычного запроса — этот запрос выполняется под
+#       cProfile, в ответе X-Profile-Id, отчёт pstats — по тому же /debug/profile?id=.
+#
+# Результаты пишутся в PROFILE_DIR, поэтому под prefork их отдаёт любой
+# воркер; сам замер видит только трафик воркера, принявшего запрос на старт.
+
+PROFILE_TOKEN = os.getenv("PROFILE_TOKEN", "")
+PROFILE_PATH = os.getenv("PROFILE_PATH", "/debug/profile")
+PROFILE_DIR = os.getenv(
+    "PROFILE_DIR", os.path.join(tempfile.gettempdir(), "profiles")
+)
+PROFILE_INTERVAL_MS = float(os.getenv("PROFILE_INTERVAL_MS", "10"))
+PROFILE_MAX_SECONDS = float(os.getenv("PROFILE_MAX_SECONDS", "60"))
+# Сколько последних результатов хранить в PROFILE_DIR
+PROFILE_KEEP = int(os.getenv("PROFILE_KEEP", "50"))
+# Строк в отчёте cProfile
+PROFILE_TOP = int(os.getenv("PROFILE_TOP", "40"))
+
+TOKEN_HEADER = "X-Debug-Token"
+PROFILE_REQUEST_HEADER = "X-Profile"
+PROFILE_ID_HEADER = "X-Profile-Id"
+
+RESULT_SUFFIXES = (".collapsed", ".pstats.txt")
+PENDING_SUFFIX = ".pending"
+
+# Листья стеков потоков, ждущих работы: без ?idle=1 такие стеки не
+# попадают в результат, иначе ожидание accept/select заслоняет всё остальное
+IDLE_FRAMES = frozenset(
+    (
+        ("socketserver.py", "serve_forever"),
+        ("selectors.py", "select"),
+        ("threading.py", "wait"),
+        ("queue.py", "get"),
+        ("socket.py", "readinto"),
+        ("socket.py", "accept"),
+        ("log_pipeline.py", "get_batch"),
+    )
+)
+
+
+def authorized(headers):
+    if not PROFILE_TOKEN:
+        return False
+    token = headers.get(TOKEN_HEADER)
+    if token is None:
+        auth = headers.get("Authorization") or ""
+        if not auth.startswith("Bearer "):
+            return False
+        token = auth[7:]
+    return hmac.compare_digest(token.strip().encode(), PROFILE_TOKEN.encode())
+
+
+def _new_id():
+    return f"{os.getpid()}-{int(time.time())}-{os.urandom(4).hex()}"
+
+
+def _write_atomic(path, data):
+    tmp = f"{path}.tmp"
+    with open(tmp, "w", encoding="utf-8") as f:
+        f.write(data)
+    os.replace(tmp, path)
+
+
+def _prune(directory, keep=PROFILE_KEEP):
+    try:
+        names = [n for n in os.listdir(directory) if n.endswith(RESULT_SUFFIXES)]
+    except OSError:
+        return
+    if len(names) <= keep:
+        return
+    paths = [os.path.join(directory, n) for n in names]
+    paths.sort(key=lambda p: os.stat(p).st_mtime)
+    for path in paths[:-keep]:
+        try:
+            os.remove(path)
+        except OSError:
+            pass
+
+
+def save_result(profile_id, suffix, data, directory=PROFILE_DIR):
+    os.makedirs(directory, mode=0o700, exist_ok=True)
+    _write_atomic(os.path.join(directory, profile_id + suffix), data)
+    _prune(directory)
+
+
+class StackSampler:
+    """Сэмплирующий профайлер: счётчик свёрнутых стеков всех потоков"""
+
+    def __init__(self, interval=PROFILE_INTERVAL_MS / 1000, include_idle=False):
+        self.interval = interval
+        self.include_idle = include_idle
+        self.stacks = collections.Counter()
+        self.samples = 0
+        self._names = {}
+        self._stop = threading.Event()
+        self._thread = None
+
+    def _frame_name(self, code):
+        name = self._names.get(code)
+        if name is None:
+            # ";" — разделитель кадров в collapsed-формате
+            filename = os.path.basename(code.co_filename).replace(";", ":")
+            name = f"{code.co_name} ({filename}:{code.co_firstlineno})"
+            self._names[code] = name
+        return name
+
+    def sample(self):
+        own = threading.get_ident()
+        threads = {t.ident: t.name for t in threading.enumerate()}
+        for ident, frame in sys._current_frames().items():
+            if ident == own:
+                continue
+            code = frame.f_code
+            if (
+                not self.include_idle
+                and (os.path.basename(code.co_filename), code.co_name) in IDLE_FRAMES
+            ):
+                continue
+            stack = []
+            while frame is not None:
+                stack.append(self._frame_name(frame.f_code))
+                frame = frame.f_back
+            stack.append(threads.get(ident, f"thread-{ident}"))
+            stack.reverse()
+            self.stacks[";".join(stack)] += 1
+        self.samples += 1
+
+    def run(self, seconds):
+        deadline = time.monotonic() + seconds
+        while not self._stop.is_set():
+            started = time.monotonic()
+            if started >= deadline:
+                break
+            self.sample()
+            self._stop.wait(max(0.0, self.interval - (time.monotonic() - started)))
+
+    def start(self, seconds, on_done=None):
+        def target():
+            self.run(seconds)
+            if on_done is not None:
+                on_done(self)
+
+        self._thread = threading.Thread(
+            target=target, name="stack-sampler", daemon=True
+        )
+        self._thread.start()
+
+    def stop(self):
+        self._stop.set()
+
+    def collapsed(self):
+        return "".join(
+            f"{stack} {count}\n" for stack, count in self.stacks.most_common()
+        )
+
+
+class _Sessions:
+    """Текущий замер процесса; после fork в воркере — своё состояние"""
+
+    def __init__(self):
+        self._after_fork_child()
+        os.register_at_fork(after_in_child=self._after_fork_child)
+
+    def _after_fork_child(self):
+        self.lock = threading.Lock()
+        self.sampling = None  # (id, sampler)
+        # cProfile — один на процесс, запрос под ним ждать не должен
+        self.request_lock = threading.Lock()
+
+
+_sessions = _Sessions()
+
+
+def start_sampling(seconds, include_idle=False, logger=None):
+    """Запускает сэмплирование; None — в процессе уже идёт замер"""
+    with _sessions.lock:
+        if _sessions.sampling is not None:
+            return None
+        profile_id = _new_id()
+        sampler = StackSampler(include_idle=include_idle)
+        _sessions.sampling = (profile_id, sampler)
+
+    os.makedirs(PROFILE_DIR, mode=0o700, exist_ok=True)
+    pending = os.path.join(PROFILE_DIR, profile_id + PENDING_SUFFIX)
+    _write_atomic(pending, str(time.time() + seconds))
+
+    def on_done(sampler):
+        try:
+            save_result(profile_id, ".collapsed", sampler.collapsed())
+        except OSError as e:
+            if logger is not None:
+                logger.error(
+                    "Не удалось сохранить профиль",
+                    extra={"profile_id": profile_id, "error": str(e)},
+                )
+        finally:
+            try:
+                os.remove(pending)
+            except OSError:
+                pass
+            with _sessions.lock:
+                _sessions.sampling = None
+        if logger is not None:
+            logger.info(
+                "Профилирование завершено",
+                extra={
+                    "profile_id": profile_id,
+                    "samples": sampler.samples,
+                    "stacks": len(sampler.stacks),
+                },
+            )
+
+    sampler.start(seconds, on_done)
+    if logger is not None:
+        logger.warning(
+            "Запущено профилирование",
+            extra={"profile_id": profile_id, "seconds": seconds},
+        )
+    return profile_id
+
+
+def _json_response(status, payload, extra_headers=()):
+    body = json.dumps(payload, ensure_ascii=False).encode("utf-8")
+    headers = (("Content-Type", "application/json"),) + tuple(extra_headers)
+    return build_response(status, headers, body)
+
+
+def _result_response(profile_id):
+    # id приходит от клиента — только символы, которые порождает _new_id()
+    if not profile_id or not all(c.isalnum() or c == "-" for c in profile_id):
+        return _json_response(400, {"error": "Некорректный id"})
+    base = os.path.join(PROFILE_DIR, profile_id)
+    for suffix in RESULT_SUFFIXES:
+        try:
+            with open(base + suffix, encoding="utf-8") as f:
+                return 200, "text/plain; charset=utf-8", f.read()
+        except FileNotFoundError:
+            continue
+    try:
+        with open(base + PENDING_SUFFIX) as f:
+            remaining = float(f.read()) - time.time()
+    except (OSError, ValueError):
+        return _json_response(404, {"error": "Профиль не найден"})
+    retry = max(1, int(remaining + 1))
+    return _json_response(
+        202, {"id": profile_id, "status": "running"}, (("Retry-After", str(retry)),)
+    )
+
+
+def make_route(logger=None):
+    def route(handler):
+        if not authorized(handler.headers):
+            return _json_response(403, {"error": "Доступ запрещён"})
+        query = parse_qs(urlsplit(handler.path).query)
+        if "id" in query:
+            return _result_response(query["id"][0])
+        try:
+            seconds = float(query.get("seconds", ["10"])[0])
+        except ValueError:
+            seconds = 0
+        if not 0 < seconds <= PROFILE_MAX_SECONDS:
+            return _json_response(
+                400, {"error": f"seconds — от 0 до {PROFILE_MAX_SECONDS:g}"}
+            )
+        include_idle = query.get("idle", ["0"])[0] in ("1", "true", "yes")
+        try:
+            profile_id = start_sampling(seconds, include_idle, logger)
+        except OSError as e:
+            return _json_response(500, {"error": f"PROFILE_DIR недоступен: {e}"})
+        if profile_id is None:
+            return _json_response(409, {"error": "Профилирование уже идёт"})
+        return _json_response(
+            202,
+            {
+                "id": profile_id,
+                "seconds": seconds,
+                "result": f"{PROFILE_PATH}?id={profile_id}",
+            },
+            (("Retry-After", str(int(seconds + 1))),),
+        )
+
+    return route
+
+
+class ProfiledHandler:
+    """Примесь к BaseHTTPRequestHandler: запрос с X-Profile: 1 и токеном
+    выполняется под cProfile.
+
+    class Handler(profiling.ProfiledHandler, BaseHTTPRequestHandler): ...
+    """
+
+    _profile = None
+    _profile_id = None
+
+    def parse_request(self):
+        ok = super().parse_request()
+        self._profile = None
+        if (
+            ok
+            and PROFILE_TOKEN
+            and self.headers.get(PROFILE_REQUEST_HEADER, "").strip() == "1"
+            and authorized(self.headers)
+            and _sessions.request_lock.acquire(blocking=False)
+        ):
+            self._profile_id = _new_id()
+            self._profile = cProfile.Profile()
+            self._profile.enable()
+        return ok
+
+    def end_headers(self):
+        if self._profile is not None:
+            self.send_header(PROFILE_ID_HEADER, self._profile_id)
+        super().end_headers()
+
+    def handle_one_request(self):
+        try:
+            super().handle_one_request()
+        finally:
+            profile = self._profile
+            if profile is not None:
+                self._profile = None
+                profile.disable()
+                _sessions.request_lock.release()
+                self._save_profile(profile)
+
+    def _save_profile(self, profile):
+        stream = io.StringIO()
+        stream.write(f"{self.requestline}\n")
+        stats = pstats.Stats(profile, stream=stream)
+        stats.sort_stats("cumulative").print_stats(PROFILE_TOP)
+        try:
+            save_result(self._profile_id, ".pstats.txt", stream.getvalue())
+        except OSError:
+            pass
+
+
+def install(fast_path):
+    """Регистрирует /debug/profile, если задан PROFILE_TOKEN"""
+    if not PROFILE_TOKEN:
+        return
+    fast_path.add_route(PROFILE_PATH, make_route(fast_path.logger))
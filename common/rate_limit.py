@@ -0,0 +1,113 @@
+import ipaddress
+import math
+import mmap
+import os
+import threading
+import time
+
+from common import metrics
+
+# --- Ограничение частоты запросов по клиенту ---
+# Token bucket в форме GCRA: на клиента хранится одно число — «теоретическое
+# время прихода» (TAT) следующего запроса. Скорость rate запросов в секунду,
+# всплеск до burst запросов подряд.
+#
+# Таблица фиксированного размера: slots ячеек по 16 байт (отпечаток ключа и
+# TAT), наборы по WAYS ячеек, набор выбирается хешем ключа. Память не растёт
+# с числом клиентов: ячейка, чей TAT уже в прошлом (ведро снова полное),
+# считается свободной — ленивое истечение без фоновой чистки. Если весь набор
+# занят активными клиентами, вытесняется тот, чьё ведро ближе всего к полному.
+#
+# Таблица лежит в анонимной разделяемой памяти, созданной до fork: воркеры
+# prefork видят общие ведра. Между процессами обновление без блокировки —
+# гонка может пропустить лишний запрос, но не заблокировать лишнего.
+#
+#   limiter = rate_limit.RateLimiter("get_city", rate=1, burst=20)
+#   allowed, retry_after = limiter.hit(client_ip)
+
+WAYS = 4
+
+RATE_LIMITED = metrics.counter(
+    "rate_limited_total", "Запросы, отклонённые ограничением частоты", ("limiter",)
+)
+RATE_LIMIT_EVICTIONS = metrics.counter(
+    "rate_limit_evictions_total",
+    "Вытеснения активных клиентов из переполненного набора таблицы",
+    ("limiter",),
+)
+
+
+def client_key(ip):
+    """Ключ клиента: IPv4 — адрес, IPv6 — подсеть /64 (её выдают одному клиенту)"""
+    try:
+        address = ipaddress.ip_address(ip)
+    except ValueError:
+        return ip
+    if address.version == 6:
+        if address.ipv4_mapped is not None:
+            return str(address.ipv4_mapped)
+        return str(ipaddress.ip_network(f"{address}/64", strict=False))
+    return str(address)
+
+
+class RateLimiter:
+    def __init__(self, name, rate, burst, slots=65536):
+        if rate <= 0 or burst < 1:
+            raise ValueError("rate > 0 и burst >= 1")
+        self.name = name
+        self.interval = 1.0 / rate
+        self.tolerance = burst * self.interval
+        self.sets = max(1, slots // WAYS)
+        size = self.sets * WAYS
+        self._mmap = mmap.mmap(-1, size * 16)  # MAP_SHARED: общая для воркеров
+        view = memoryview(self._mmap)
+        self._keys = view[: size * 8].cast("Q")
+        self._tats = view[size * 8 :].cast("d")
+        self._lock = threading.Lock()
+        os.register_at_fork(after_in_child=self._after_fork_child)
+
+    def _after_fork_child(self):
+        self._lock = threading.Lock()
+
+    def _slot(self, fingerprint, now):
+        """Индекс ячейки клиента; занимает свободную или вытесняет"""
+        keys, tats = self._keys, self._tats
+        base = (fingerprint % self.sets) * WAYS
+        free = None
+        victim = base
+        for slot in range(base, base + WAYS):
+            if keys[slot] == fingerprint:
+                return slot
+            if free is None and (keys[slot] == 0 or tats[slot] <= now):
+                free = slot
+            if tats[slot] < tats[victim]:
+                victim = slot
+        if free is None:
+            RATE_LIMIT_EVICTIONS.labels(self.name).inc()
+            free = victim
+        keys[free] = fingerprint
+        tats[free] = now
+        return free
+
+    def hit(self, key):
+        """(разрешено, через сколько секунд повторить)"""
+        fingerprint = (hash(key) & 0xFFFFFFFFFFFFFFFF) or 1
+        now = time.monotonic()
+        with self._lock:
+            slot = self._slot(fingerprint, now)
+            tat = max(self._tats[slot], now) + self.interval
+            excess = tat - now - self.tolerance
+            if excess > 0:
+                allowed = False
+            else:
+                self._tats[slot] = tat
+                allowed = True
+        if allowed:
+            return True, 0.0
+        RATE_LIMITED.labels(self.name).inc()
+        return False, excess
+
+    @staticmethod
+    def retry_after_header(seconds):
+        """Значение Retry-After: целые секунды, не меньше 1"""
+        return str(max(1, math.ceil(seconds)))
@@ -0,0 +1,243 @@
+import contextvars
+import logging
+import os
+import re
+import time
+import uuid
+
+# --- Сквозная трассировка запросов ---
+# Контекст приходит в заголовках X-Request-ID и traceparent (W3C Trace
+# Context) и передаётся дальше в исходящие запросы. Внутри запроса каждый
+# этап оборачивается в span(); по завершении пишется одна сводная запись
+# с длительностью каждого этапа вместо россыпи INFO-строк:
+#
+#   trace = tracing.start(self.headers)
+#   with tracing.span("dadata"):
+#       city = get_city_by_ip(ip)
+#   tracing.finish(logger, "Запрос обработан", client_ip=ip, city=city)
+#
+# Этапы можно отдать браузеру в заголовке Server-Timing: для всех ответов
+# (SERVER_TIMING=1) или для запроса с заголовком X-Server-Timing: 1.
+
+SERVER_TIMING = os.getenv("SERVER_TIMING", "0").lower() in ("1", "true", "yes", "on")
+
+REQUEST_ID_HEADER = "X-Request-ID"
+TRACEPARENT_HEADER = "traceparent"
+SERVER_TIMING_REQUEST_HEADER = "X-Server-Timing"
+
+_TRACEPARENT_RE = re.compile(r"^00-([0-9a-f]{32})-([0-9a-f]{16})-([0-9a-f]{2})$")
+_REQUEST_ID_RE = re.compile(r"^[\w.:-]{1,128}$")
+
+_current = contextvars.ContextVar("trace", default=None)
+# func(имя этапа, мс, завершился исключением) — например, метрики
+_span_observers = []
+
+
+def _new_id(length):
+    return os.urandom(length // 2).hex()
+
+
+class Span:
+    __slots__ = ("name", "span_id", "start", "duration_ms")
+
+    def __init__(self, name):
+        self.name = name
+        self.span_id = _new_id(16)
+        self.start = time.perf_counter()
+        self.duration_ms = None
+
+
+class _SpanContext:
+    """with trace.span(...): замеряет этап и добавляет его в трассу"""
+
+    __slots__ = ("trace", "span")
+
+    def __init__(self, trace, name):
+        self.trace = trace
+        self.span = Span(name)
+
+    def __enter__(self):
+        self.span.start = time.perf_counter()
+        return self.span
+
+    def __exit__(self, exc_type, exc, tb):
+        span = self.span
+        span.duration_ms = (time.perf_counter() - span.start) * 1000
+        if self.trace is not None:
+            self.trace.spans.append(span)
+        for observer in _span_observers:
+            observer(span.name, span.duration_ms, exc_type is not None)
+        return False
+
+
+class _NoopSpan:
+    """Заглушка span() вне трассируемого запроса"""
+
+    span_id = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        return False
+
+
+_NOOP_SPAN = _NoopSpan()
+
+
+class Trace:
+    """Контекст одного запроса: идентификаторы и замеренные этапы"""
+
+    def __init__(self, trace_id, parent_id=None, request_id=None, sampled=True):
+        self.trace_id = trace_id
+        self.span_id = _new_id(16)
+        self.parent_id = parent_id
+        self.request_id = request_id or str(uuid.uuid4())
+        self.sampled = sampled
+        self.start = time.perf_counter()
+        self.spans = []
+        self._token = None
+
+    @classmethod
+    def from_headers(cls, headers):
+        """Продолжает трассу из входящих заголовков или начинает новую"""
+        trace_id = parent_id = None
+        sampled = True
+        match = _TRACEPARENT_RE.match((headers.get(TRACEPARENT_HEADER) or "").strip())
+        if match and match.group(1) != "0" * 32 and match.group(2) != "0" * 16:
+            trace_id, parent_id = match.group(1), match.group(2)
+            sampled = bool(int(match.group(3), 16) & 1)
+        request_id = (headers.get(REQUEST_ID_HEADER) or "").strip()
+        if not _REQUEST_ID_RE.match(request_id):
+            request_id = None
+        return cls(trace_id or _new_id(32), parent_id, request_id, sampled)
+
+    def span(self, name):
+        return _SpanContext(self, name)
+
+    def traceparent(self, span_id=None):
+        flags = "01" if self.sampled else "00"
+        return f"00-{self.trace_id}-{span_id or self.span_id}-{flags}"
+
+    def outgoing_headers(self, span=None):
+        """Заголовки для исходящего запроса (родитель — текущий этап)"""
+        return {
+            REQUEST_ID_HEADER: self.request_id,
+            TRACEPARENT_HEADER: self.traceparent(getattr(span, "span_id", None)),
+        }
+
+    def elapsed_ms(self):
+        return (time.perf_counter() - self.start) * 1000
+
+    def timings(self):
+        """{этап: мс}; повторяющиеся этапы суммируются"""
+        result = {}
+        for span in self.spans:
+            result[span.name] = round(result.get(span.name, 0.0) + span.duration_ms, 2)
+        return result
+
+    def server_timing(self):
+        """Значение заголовка Server-Timing: этапы и общее время"""
+        parts = [f"{name};dur={ms:.1f}" for name, ms in self.timings().items()]
+        parts.append(f"total;dur={self.elapsed_ms():.1f}")
+        return ", ".join(parts)
+
+    def log_fields(self):
+        fields = {
+            "request_id": self.request_id,
+            "trace_id": self.trace_id,
+            "span_id": self.span_id,
+        }
+        if self.parent_id:
+            fields["parent_span_id"] = self.parent_id
+        return fields
+
+
+def start(headers):
+    """Начинает трассу запроса и делает её текущей"""
+    trace = Trace.from_headers(headers)
+    trace._token = _current.set(trace)
+    return trace
+
+
+def current():
+    return _current.get()
+
+
+def server_timing_requested(headers):
+    if SERVER_TIMING:
+        return True
+    value = headers.get(SERVER_TIMING_REQUEST_HEADER) if headers is not None else None
+    return value is not None and value.strip().lower() in ("1", "true", "yes", "on")
+
+
+def start_timing(headers):
+    """Трасса только ради Server-Timing (сервисы без сводных логов).
+
+    Если замер для запроса не включён, текущая трасса снимается и span()
+    ничего не стоит.
+    """
+    if server_timing_requested(headers):
+        return start(headers)
+    _current.set(None)
+    return None
+
+
+def send_server_timing(handler):
+    """Добавляет Server-Timing в ответ handler'а; вызывать до end_headers()"""
+    trace = _current.get()
+    if trace is None or not server_timing_requested(handler.headers):
+        return
+    handler.send_header("Server-Timing", trace.server_timing())
+    # Без него браузер не покажет Server-Timing для кросс-доменного запроса
+    handler.send_header("Timing-Allow-Origin", "*")
+
+
+def span(name):
+    """Этап текущей трассы; вне трассы замеряется только для наблюдателей"""
+    trace = _current.get()
+    if trace is None:
+        return _SpanContext(None, name) if _span_observers else _NOOP_SPAN
+    return trace.span(name)
+
+
+def add_span_observer(observer):
+    if observer not in _span_observers:
+        _span_observers.append(observer)
+
+
+def outgoing_headers(span=None):
+    trace = _current.get()
+    if trace is None:
+        return {}
+    return trace.outgoing_headers(span)
+
+
+def finish(logger, message, level=logging.INFO, **fields):
+    """Пишет сводную запись запроса и снимает текущую трассу"""
+    trace = _current.get()
+    if trace is None:
+        return None
+    extra = trace.log_fields()
+    extra["duration_ms"] = round(trace.elapsed_ms(), 2)
+    extra["timings_ms"] = trace.timings()
+    extra.update(fields)
+    logger.log(level, message, extra=extra, stacklevel=2)
+    if trace._token is not None:
+        _current.reset(trace._token)
+        trace._token = None
+    return trace
+
+
+class TraceContextFilter(logging.Filter):
+    """Добавляет идентификаторы текущей трассы в записи внутри запроса"""
+
+    def filter(self, record):
+        trace = _current.get()
+        if trace is not None:
+            if not hasattr(record, "request_id"):
+                record.request_id = trace.request_id
+            if not hasattr(record, "trace_id"):
+                record.trace_id = trace.trace_id
+                record.span_id = trace.span_id
+        return True
@@ -0,0 +1,111 @@
+import grp
+import os
+import socket
+import stat
+
+# --- Прослушивание Unix domain socket ---
+# Когда клиент на той же машине (nginx, geoservice -> weather_service в общем
+# томе), UDS вместо TCP убирает сетевой стек: нет TCP-рукопожатия, Nagle,
+# маршрутизации через bridge. Сервис слушает путь из <SERVICE>_UNIX_SOCKET
+# вместо порта:
+#
+#   server_class = unix_socket.server_class(socketserver.TCPServer, UNIX_SOCKET)
+#   httpd = server_class(UNIX_SOCKET or ("", PORT), Handler)
+#
+# Права на сокет — UNIX_SOCKET_MODE (по умолчанию 660: владелец и группа),
+# группа — UNIX_SOCKET_GROUP. Оставшийся от упавшего процесса файл сокета
+# удаляется при старте, если его никто не слушает; при остановке файл удаляет
+# процесс, который его создал (не воркеры prefork).
+
+UNIX_SOCKET_MODE = int(os.getenv("UNIX_SOCKET_MODE", "660"), 8)
+UNIX_SOCKET_GROUP = os.getenv("UNIX_SOCKET_GROUP", "")
+
+# У соединения по UDS нет адреса клиента: обработчики и логи получают
+# адрес локальной машины, настоящий IP — в X-Real-IP/X-Forwarded-For
+CLIENT_ADDRESS = ("127.0.0.1", 0)
+
+
+def _remove_stale(path):
+    try:
+        mode = os.lstat(path).st_mode
+    except FileNotFoundError:
+        return
+    if not stat.S_ISSOCK(mode):
+        raise OSError(f"{path} существует и не является сокетом")
+    probe = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    try:
+        probe.connect(path)
+    except ConnectionRefusedError:
+        os.unlink(path)  # процесс, создавший сокет, уже не слушает
+        return
+    except FileNotFoundError:
+        return
+    finally:
+        probe.close()
+    raise OSError(f"{path} уже слушает другой процесс")
+
+
+def bind(sock, path, mode=UNIX_SOCKET_MODE, group=UNIX_SOCKET_GROUP):
+    """Привязывает sock к path с правами mode; возвращает inode файла сокета"""
+    _remove_stale(path)
+    # До chmod сокет не должен быть доступен никому, кроме владельца
+    umask = os.umask(0o177)
+    try:
+        sock.bind(path)
+    finally:
+        os.umask(umask)
+    if group:
+        os.chown(path, -1, grp.getgrnam(group).gr_gid)
+    os.chmod(path, mode)
+    return os.stat(path).st_ino
+
+
+def listen(path, backlog=128):
+    """(слушающий сокет, inode файла) — для aiohttp: web.run_app(sock=...)"""
+    sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    try:
+        inode = bind(sock, path)
+        sock.listen(backlog)
+    except BaseException:
+        sock.close()
+        raise
+    return sock, inode
+
+
+def remove(path, inode):
+    """Удаляет файл сокета, если это всё ещё наш файл"""
+    try:
+        if os.stat(path).st_ino == inode:
+            os.unlink(path)
+    except FileNotFoundError:
+        pass
+
+
+class UnixServerMixin:
+    """socketserver.TCPServer и наследники на AF_UNIX"""
+
+    address_family = socket.AF_UNIX
+    _unix_owner = None  # (pid, inode) процесса, создавшего файл сокета
+
+    def server_bind(self):
+        inode = bind(self.socket, self.server_address)
+        self._unix_owner = (os.getpid(), inode)
+        self.server_name = "localhost"
+        self.server_port = 0
+
+    def get_request(self):
+        request, _ = self.socket.accept()
+        return request, CLIENT_ADDRESS
+
+    def server_close(self):
+        super().server_close()
+        if self._unix_owner is not None and self._unix_owner[0] == os.getpid():
+            remove(self.server_address, self._unix_owner[1])
+            self._unix_owner = None
+
+
+def server_class(base, path):
+    """base, если path пуст, иначе его вариант, слушающий UDS"""
+    if not path:
+        return base
+    return type(f"Unix{base.__name__}", (UnixServerMixin, base), {})
@@ -2,18 +2,56 @@ import os
 import logging
 from http.server import BaseHTTPRequestHandler, HTTPServer
 import json
+import math
+import queue
+import selectors
+import threading
+import time
 from urllib.request import urlopen, Request
 from urllib.error import URLError
 import socket
 from urllib.parse import urlparse
 from cerberus import Validator
-from datetime import datetime
+from catalog import CatalogStore
+from common import (
+    adaptive_timeout,
+    fluent_forward,
+    log_pipeline,
+    log_sampling,
+    memory,
+    metrics,
+    prefork,
+    profiling,
+    tracing,
+    unix_socket,
+)
+from common.log_format import JSONFormatter
+from common.log_rotation import RotatingBatchFileHandler
+from common.fastpath import FastPath
 import uuid
 
 # --- Загрузка переменных окружения ---
 PORT = int(os.getenv("CALCULATOR_PORT", 5000))
+# Путь Unix domain socket вместо порта (nginx на той же машине)
+UNIX_SOCKET = os.getenv("CALCULATOR_UNIX_SOCKET", "")
 LOG_DIR = os.getenv("CALCULATOR_LOG_DIR", "/var/log/calculator")
 
+# Контроль допуска: сколько запросов обрабатываем одновременно,
+# сколько держим в очереди и сколько запрос может в ней ждать
+MAX_IN_FLIGHT = int(os.getenv("CALCULATOR_MAX_IN_FLIGHT", 8))
+QUEUE_SIZE = int(os.getenv("CALCULATOR_QUEUE_SIZE", 64))
+QUEUE_TIMEOUT_MS = int(os.getenv("CALCULATOR_QUEUE_TIMEOUT_MS", 1000))
+RETRY_AFTER = int(os.getenv("CALCULATOR_RETRY_AFTER", 1))
+ADMISSION_STATS_PATH = "/admission"
+
+# Каталог цен для смет (CSV или JSON); пустой путь — сметы отключены
+CATALOG_PATH = os.getenv("CALCULATOR_CATALOG_PATH", "")
+CATALOG_RELOAD_INTERVAL = float(os.getenv("CALCULATOR_CATALOG_RELOAD_INTERVAL", 5))
+ESTIMATE_PATH = "/estimate"
+
+# Потолок таймаута сервиса определения IP; сам таймаут — по p99 его задержки
+IP_SERVICE_TIMEOUT = float(os.getenv("CALCULATOR_IP_SERVICE_TIMEOUT", 3))
+
 # Создание директории логов
 os.makedirs(LOG_DIR, exist_ok=True)
 
@@ -23,56 +61,20 @@ logger.setLevel(logging.INFO)
 logger.handlers.clear()  # Убираем возможные дубликаты
 
 log_file = os.path.join(LOG_DIR, "calculator.log")
-file_handler = logging.FileHandler(log_file, encoding="utf-8")
+file_handler = RotatingBatchFileHandler(log_file, encoding="utf-8")
 file_handler.setLevel(logging.INFO)
 
 
-# --- JSON-форматтер ---
-class JSONFormatter(logging.Formatter):
-    def format(self, record):
-        log_entry = {
-            "timestamp": datetime.utcfromtimestamp(record.created).strftime(
-                "%Y-%m-%dT%H:%M:%SZ"
-            ),
-            "level": record.levelname,
-            "logger": record.name,
-            "message": record.getMessage(),  # ← Это поле формируется из msg, а не из extra
-            "module": record.module,
-            "function": record.funcName,
-            "line": record.lineno,
-        }
-
-        # Добавляем все поля из extra, кроме стандартных
-        for key, value in record.__dict__.items():
-            if key not in (
-                "asctime",
-                "created",
-                "filename",
-                "funcName",
-                "levelname",
-                "levelno",
-                "lineno",
-                "module",
-                "msecs",
-                "msg",
-                "name",
-                "pathname",
-                "process",
-                "processName",
-                "relativeCreated",
-                "thread",
-                "threadName",
-            ):
-                if key not in log_entry:
-                    log_entry[key] = value
-
-        return json.dumps(log_entry, ensure_ascii=False)
-
-
-file_handler.setFormatter(JSONFormatter())
+file_handler.setFormatter(JSONFormatter(static_fields={"service": "calculator"}))
 logger.addHandler(file_handler)
 logger.propagate = False
 
+# LOG_FORWARD — отправка в fluent-bit по Forward-протоколу вместо файла
+fluent_forward.install(logger, tag="calculator")
+
+# Запись в файл — в фоновом потоке, пачками (LOG_ASYNC=0 — синхронно)
+log_pipeline.install(logger)
+
 
 # --- Фильтр для автодобавления полей ---
 class CalculatorContextFilter(logging.Filter):
@@ -90,12 +92,67 @@ class CalculatorContextFilter(logging.Filter):
 
 logger.addFilter(CalculatorContextFilter())
 
+# --- Сэмплирование частой диагностики: 1% записей + счётчики раз в 10 с ---
+log_sampling.install(
+    logger,
+    {
+        "IP_CHECK": 0.01,
+        "IP_VALIDATE": 0.01,
+        "HEADER_IP": 0.01,
+        "SOCKET_IP": 0.01,
+        "HEADERS_SET": 0.01,
+    },
+)
+
 # --- Валидация данных ---
 schema = {
     "quantity": {"type": "float", "required": True, "min": 0},
     "costPerUnit": {"type": "float", "required": True, "min": 0},
 }
-validator = Validator(schema)
+
+
+def _check_finite(field, value, error):
+    # json.loads принимает NaN и Infinity, а min их не отсекает;
+    # такая смета сериализовалась бы в невалидный JSON
+    if not math.isfinite(value):
+        error(field, "должно быть конечным числом")
+
+
+estimate_schema = {
+    "items": {
+        "type": "list",
+        "required": True,
+        "minlength": 1,
+        "maxlength": 1000,
+        "schema": {
+            "type": "dict",
+            "schema": {
+                "code": {"type": "string", "required": True, "empty": False},
+                "quantity": {
+                    "type": "float",
+                    "required": True,
+                    "min": 0,
+                    "check_with": _check_finite,
+                },
+            },
+        },
+    },
+}
+
+# Validator хранит документ и ошибки в себе, а запросы обрабатывает пул
+# воркеров AdmissionController: у каждого потока свои экземпляры
+_validators = threading.local()
+
+
+def thread_validator(name, schema):
+    validator = getattr(_validators, name, None)
+    if validator is None:
+        validator = Validator(schema)
+        setattr(_validators, name, validator)
+    return validator
+
+
+catalog_store = CatalogStore(CATALOG_PATH, CATALOG_RELOAD_INTERVAL)
 
 
 class IPResolver:
@@ -206,11 +263,17 @@ class IPResolver:
 
     def _resolve_public_ip(self, client_ip):
         for service_url in self.ip_services:
+            latency = adaptive_timeout.tracker(
+                urlparse(service_url).netloc, IP_SERVICE_TIMEOUT
+            )
+            timeout = latency.timeout()
             try:
                 req = Request(
                     service_url, headers={"User-Agent": "Calculator-Server/1.0"}
                 )
-                with urlopen(req, timeout=3) as response:
+                with latency.measure(timeout), urlopen(
+                    req, timeout=timeout
+                ) as response:
                     if response.status == 200:
                         ip = response.read().decode("utf-8").strip()
                         if self._is_valid_ip(ip):
@@ -316,7 +379,9 @@ class IPResolver:
 ip_resolver = IPResolver()
 
 
-class RequestHandler(BaseHTTPRequestHandler):
+class RequestHandler(
+    profiling.ProfiledHandler, metrics.InstrumentedHandler, BaseHTTPRequestHandler
+):
     def _get_client_ip(self):
         ip_headers = [
             "X-Real-IP",
@@ -361,7 +426,8 @@ class RequestHandler(BaseHTTPRequestHandler):
         if cached:
             return cached
         client_ip = self._get_client_ip()
-        public_ip = ip_resolver.get_public_ip(client_ip)
+        with tracing.span("resolve"):
+            public_ip = ip_resolver.get_public_ip(client_ip)
         self._resolved_public_ip = public_ip
         logger.info(
             "Клиент → публичный IP",
@@ -380,6 +446,7 @@ class RequestHandler(BaseHTTPRequestHandler):
         self.send_header("Access-Control-Allow-Origin", "*")
         self.send_header("Access-Control-Allow-Methods", "POST, OPTIONS")
         self.send_header("Access-Control-Allow-Headers", "Content-Type")
+        tracing.send_server_timing(self)
         self.end_headers()
         logger.info(
             "CORS и Content-Type заголовки установлены",
@@ -392,18 +459,16 @@ class RequestHandler(BaseHTTPRequestHandler):
         )
 
     def do_OPTIONS(self):
-        logger.info(
-            "OPTIONS запрос",
-            extra={
-                "request": "OPTIONS",
-                "client_ip": self.client_address[0],
-                "public_ip": self._get_public_ip(),
-                "response_status": "204",
-            },
-        )
-        self._set_headers(204)
+        fast_path.handle(self)
+
+    def do_GET(self):
+        # Только служебные эндпоинты — без резолва IP и логирования
+        if not fast_path.handle(self):
+            self.send_error(404)
 
     def do_POST(self):
+        # Этапы для Server-Timing (SERVER_TIMING=1 или X-Server-Timing: 1)
+        tracing.start_timing(self.headers)
         client_ip = self._get_client_ip()
         public_ip = self._get_public_ip()
 
@@ -417,12 +482,19 @@ class RequestHandler(BaseHTTPRequestHandler):
             },
         )
 
+        if urlparse(self.path).path == ESTIMATE_PATH:
+            self._handle_estimate(client_ip, public_ip)
+            return
+
         try:
-            content_length = int(self.headers.get("Content-Length", 0))
-            body = self.rfile.read(content_length)
-            data = json.loads(body)
+            with tracing.span("validate"):
+                content_length = int(self.headers.get("Content-Length", 0))
+                body = self.rfile.read(content_length)
+                data = json.loads(body)
+                validator = thread_validator("calculate", schema)
+                valid = validator.validate(data)
 
-            if not validator.validate(data):
+            if not valid:
                 self._set_headers(400)
                 response_data = {
                     "error": "Некорректные данные",
@@ -442,9 +514,10 @@ class RequestHandler(BaseHTTPRequestHandler):
                 )
                 return
 
-            quantity = float(data["quantity"])
-            cost_per_unit = float(data["costPerUnit"])
-            total_cost = quantity * cost_per_unit
+            with tracing.span("compute"):
+                quantity = float(data["quantity"])
+                cost_per_unit = float(data["costPerUnit"])
+                total_cost = quantity * cost_per_unit
 
             self._set_headers()
             response_data = {"totalCost": total_cost}
@@ -491,9 +564,133 @@ class RequestHandler(BaseHTTPRequestHandler):
                 },
             )
 
+    def _handle_estimate(self, client_ip, public_ip):
+        catalog = catalog_store.catalog
+        if catalog is None:
+            self._set_headers(503)
+            response_data = {"error": "Каталог цен не загружен"}
+            self.wfile.write(json.dumps(response_data).encode("utf-8"))
+            logger.error(
+                "Смета без каталога",
+                extra={
+                    "request": "ESTIMATE_NO_CATALOG",
+                    "client_ip": client_ip,
+                    "public_ip": public_ip,
+                    "response_status": "503",
+                },
+            )
+            return
+
+        try:
+            with tracing.span("validate"):
+                content_length = int(self.headers.get("Content-Length", 0))
+                data = json.loads(self.rfile.read(content_length))
+                estimate_validator = thread_validator("estimate", estimate_schema)
+                valid = estimate_validator.validate(data)
+
+            if not valid:
+                self._set_headers(400)
+                response_data = {
+                    "error": "Некорректные данные",
+                    "details": estimate_validator.errors,
+                }
+                self.wfile.write(json.dumps(response_data).encode("utf-8"))
+                logger.warning(
+                    "Некорректные данные сметы",
+                    extra={
+                        "request": "ESTIMATE_VALIDATION_ERROR",
+                        "client_ip": client_ip,
+                        "public_ip": public_ip,
+                        "response_status": "400",
+                        "errors": estimate_validator.errors,
+                    },
+                )
+                return
+
+            with tracing.span("compute"):
+                estimate, unknown = catalog.estimate(data["items"])
+            if unknown:
+                self._set_headers(400)
+                response_data = {"error": "Неизвестные коды", "unknownCodes": unknown}
+                self.wfile.write(
+                    json.dumps(response_data, ensure_ascii=False).encode("utf-8")
+                )
+                logger.warning(
+                    "Неизвестные коды в смете",
+                    extra={
+                        "request": "ESTIMATE_UNKNOWN_CODES",
+                        "client_ip": client_ip,
+                        "public_ip": public_ip,
+                        "response_status": "400",
+                        "unknown_codes": unknown[:20],
+                    },
+                )
+                return
+
+            # Количество и цены конечны, но их произведение может уйти в inf,
+            # а json.dumps записал бы его как невалидный Infinity
+            if not math.isfinite(estimate["totalCost"]):
+                self._set_headers(400)
+                response_data = {"error": "Слишком большая сумма сметы"}
+                self.wfile.write(
+                    json.dumps(response_data, ensure_ascii=False).encode("utf-8")
+                )
+                logger.warning(
+                    "Переполнение суммы сметы",
+                    extra={
+                        "request": "ESTIMATE_OVERFLOW",
+                        "client_ip": client_ip,
+                        "public_ip": public_ip,
+                        "response_status": "400",
+                    },
+                )
+                return
+
+            self._set_headers()
+            self.wfile.write(json.dumps(estimate, ensure_ascii=False).encode("utf-8"))
+            logger.info(
+                "Успешный расчет сметы",
+                extra={
+                    "request": "ESTIMATE_SUCCESS",
+                    "client_ip": client_ip,
+                    "public_ip": public_ip,
+                    "response_status": "200",
+                    "lines": len(estimate["lines"]),
+                    "totalCost": estimate["totalCost"],
+                },
+            )
+
+        except json.JSONDecodeError:
+            self._set_headers(400)
+            response_data = {"error": "Некорректный JSON"}
+            self.wfile.write(json.dumps(response_data).encode("utf-8"))
+            logger.error(
+                "Ошибка декодирования JSON",
+                extra={
+                    "request": "JSON_DECODE_ERROR",
+                    "client_ip": client_ip,
+                    "public_ip": public_ip,
+                    "response_status": "400",
+                },
+            )
+        except Exception as e:
+            self._set_headers(500)
+            response_data = {"error": "Внутренняя ошибка", "details": str(e)}
+            self.wfile.write(json.dumps(response_data).encode("utf-8"))
+            logger.error(
+                "Внутренняя ошибка",
+                extra={
+                    "request": "INTERNAL_ERROR",
+                    "client_ip": client_ip,
+                    "public_ip": public_ip,
+                    "response_status": "500",
+                    "error": str(e),
+                },
+            )
+
     def log_message(self, format, *args):
         """Переопределяем стандартное логирование — теперь всё через logger"""
-        if getattr(self, "command", "") == "OPTIONS":
+        if getattr(self, "command", "") in ("OPTIONS", "GET"):
             return
 
         message = format % args
@@ -516,9 +713,269 @@ class RequestHandler(BaseHTTPRequestHandler):
         )
 
 
+ADMISSION_ADMITTED = metrics.counter(
+    "calculator_admission_admitted_total", "Соединения, принятые пулом воркеров"
+)
+ADMISSION_REJECTED = metrics.counter(
+    "calculator_admission_rejected_total",
+    "Соединения, отклонённые с 503 (queue_full, deadline)",
+    ("reason",),
+)
+
+
+class AdmissionController:
+    """Ограничение одновременных запросов: пул воркеров и ограниченная очередь"""
+
+    def __init__(
+        self,
+        max_in_flight=MAX_IN_FLIGHT,
+        queue_size=QUEUE_SIZE,
+        queue_timeout_ms=QUEUE_TIMEOUT_MS,
+    ):
+        self.max_in_flight = max_in_flight
+        self.queue_timeout = queue_timeout_ms / 1000.0
+        self.queue = queue.Queue(maxsize=queue_size)
+        self.lock = threading.Lock()
+        self.in_flight = 0
+        self.admitted = ADMISSION_ADMITTED
+        self.rejected_queue_full = ADMISSION_REJECTED.labels("queue_full")
+        self.rejected_deadline = ADMISSION_REJECTED.labels("deadline")
+        self.workers = []
+
+    def start(self, server):
+        for i in range(self.max_in_flight):
+            worker = threading.Thread(
+                target=self._worker,
+                args=(server,),
+                name=f"calculator-worker-{i}",
+                daemon=True,
+            )
+            worker.start()
+            self.workers.append(worker)
+
+    def stop(self):
+        for _ in self.workers:
+            self.queue.put(None)
+        for worker in self.workers:
+            worker.join(timeout=5)
+        self.workers = []
+
+    def submit(self, request, client_address):
+        """Ставит соединение в очередь. False — очередь заполнена"""
+        try:
+            self.queue.put_nowait((request, client_address, time.monotonic()))
+            return True
+        except queue.Full:
+            self.rejected_queue_full.inc()
+            return False
+
+    def stats(self):
+        with self.lock:
+            return {
+                "in_flight": self.in_flight,
+                "queued": self.queue.qsize(),
+                "admitted": int(self.admitted.value),
+                "rejected_queue_full": int(self.rejected_queue_full.value),
+                "rejected_deadline": int(self.rejected_deadline.value),
+                "max_in_flight": self.max_in_flight,
+                "queue_size": self.queue.maxsize,
+            }
+
+    def _worker(self, server):
+        while True:
+            item = self.queue.get()
+            if item is None:
+                return
+            request, client_address, enqueued_at = item
+            # Клиент, прождавший дольше дедлайна, скорее всего уже ушёл —
+            # не тратим на него время, сразу отвечаем 503
+            if time.monotonic() - enqueued_at > self.queue_timeout:
+                self.rejected_deadline.inc()
+                server.reject_request(request)
+                continue
+            with self.lock:
+                self.in_flight += 1
+            self.admitted.inc()
+            try:
+                server.finish_request(request, client_address)
+            except Exception:
+                server.handle_error(request, client_address)
+            finally:
+                server.shutdown_request(request)
+                with self.lock:
+                    self.in_flight -= 1
+
+
+# Готовый ответ на отказ: без парсинга запроса и без логирования
+_REJECT_BODY = json.dumps(
+    {"error": "Сервер перегружен, повторите запрос позже"}, ensure_ascii=False
+).encode("utf-8")
+REJECT_RESPONSE = (
+    b"HTTP/1.0 503 Service Unavailable\r\n"
+    b"Content-Type: application/json\r\n"
+    b"Access-Control-Allow-Origin: *\r\n"
+    + f"Retry-After: {RETRY_AFTER}\r\n".encode("ascii")
+    + f"Content-Length: {len(_REJECT_BODY)}\r\n".encode("ascii")
+    + b"Connection: close\r\n\r\n"
+    + _REJECT_BODY
+)
+REJECT_READ_TIMEOUT = 0.05
+# Сколько отклонённых соединений дочитывается одновременно; сверх — закрываем сразу
+REJECT_LINGER_MAX = 512
+
+
+class Rejector:
+    """Дочитывает и закрывает отклонённые соединения в своём потоке.
+
+    Поток accept только отправляет готовый 503 и передаёт сокет сюда: ждать
+    REJECT_READ_TIMEOUT на каждом молчащем клиенте он не может — под
+    нагрузкой, ради которой существует отказ, очередь accept снова
+    переполнилась бы. Здесь все соединения ждут одновременно, через epoll.
+    """
+
+    def __init__(self, linger=REJECT_READ_TIMEOUT, max_pending=REJECT_LINGER_MAX):
+        self.linger = linger
+        self.incoming = queue.Queue(maxsize=max_pending)
+        self.thread = None
+
+    def start(self):
+        self.thread = threading.Thread(
+            target=self._run, name="calculator-rejector", daemon=True
+        )
+        self.thread.start()
+
+    def stop(self):
+        if self.thread is not None:
+            self.incoming.put(None)
+            self.thread.join(timeout=5)
+            self.thread = None
+
+    def submit(self, sock):
+        """False — очередь полна, сокет закрывает вызывающий"""
+        try:
+            self.incoming.put_nowait(sock)
+            return True
+        except queue.Full:
+            return False
+
+    def _run(self):
+        selector = selectors.DefaultSelector()
+        pending = {}  # сокет -> до какого времени дочитывать
+        try:
+            while True:
+                try:
+                    # Без ожидающих соединений — спим до следующего отказа
+                    sock = self.incoming.get(timeout=self.linger if pending else None)
+                    while sock is not None:
+                        pending[sock] = time.monotonic() + self.linger
+                        selector.register(sock, selectors.EVENT_READ)
+                        sock = self.incoming.get_nowait()
+                    return  # None — stop()
+                except queue.Empty:
+                    pass
+                for key, _ in selector.select(timeout=0):
+                    try:
+                        data = key.fileobj.recv(65536)
+                    except OSError:
+                        data = b""
+                    if not data:  # клиент закрыл соединение или ошибка
+                        pending[key.fileobj] = 0
+                now = time.monotonic()
+                for sock, until in list(pending.items()):
+                    if until <= now:
+                        del pending[sock]
+                        selector.unregister(sock)
+                        sock.close()
+        finally:
+            for sock in pending:
+                sock.close()
+            selector.close()
+
+
+class AdmissionHTTPServer(HTTPServer):
+    """HTTPServer, отдающий соединения пулу воркеров через AdmissionController"""
+
+    def __init__(
+        self, server_address, handler_class, controller, bind_and_activate=True
+    ):
+        self.controller = controller
+        self.rejector = Rejector()
+        super().__init__(server_address, handler_class, bind_and_activate)
+
+    def process_request(self, request, client_address):
+        if not self.controller.submit(request, client_address):
+            self.reject_request(request)
+
+    def reject_request(self, request):
+        """503 без ожидания: дочитывание и закрытие — в потоке Rejector"""
+        try:
+            request.setblocking(False)
+            # Уже пришедшее начало запроса: непрочитанные данные при
+            # закрытии превратили бы 503 у клиента в RST
+            try:
+                request.recv(65536)
+            except OSError:
+                pass
+            request.sendall(REJECT_RESPONSE)
+            request.shutdown(socket.SHUT_WR)
+        except OSError:
+            self.close_request(request)
+            return
+        if not self.rejector.submit(request):
+            self.close_request(request)
+
+    def serve_forever(self, poll_interval=0.5):
+        self.rejector.start()
+        self.controller.start(self)
+        try:
+            super().serve_forever(poll_interval)
+        finally:
+            self.controller.stop()
+            self.rejector.stop()
+
+
+admission = AdmissionController()
+
+fast_path = FastPath(
+    "POST, OPTIONS",
+    options_status=204,
+    ready_check=lambda: not CATALOG_PATH or catalog_store.catalog is not None,
+    logger=logger,
+)
+fast_path.add_route(
+    ADMISSION_STATS_PATH,
+    lambda handler: (200, "application/json", json.dumps(admission.stats())),
+)
+# GET /metrics: запросы, задержка, этапы, очередь допуска
+metrics.install(fast_path)
+# GET /debug/profile и /debug/memory: только при заданном PROFILE_TOKEN
+profiling.install(fast_path)
+memory.install(fast_path)
+metrics.gauge(
+    "calculator_admission_in_flight", "Запросы в обработке у пула воркеров"
+).set_function(lambda: admission.in_flight)
+metrics.gauge(
+    "calculator_admission_queued", "Соединения в очереди допуска"
+).set_function(lambda: admission.queue.qsize())
+
+
+def make_server(server_address, bind_and_activate=True):
+    server_class = unix_socket.server_class(AdmissionHTTPServer, UNIX_SOCKET)
+    return server_class(
+        server_address, RequestHandler, admission, bind_and_activate
+    )
+
+
+def start_background_tasks():
+    """Фоновые потоки процесса; в prefork-режиме запускаются в каждом воркере"""
+    if CATALOG_PATH:
+        catalog_store.start()
+
+
 def run(port: int = PORT):
-    server_address = ("", port)
-    httpd = HTTPServer(server_address, RequestHandler)
+    server_address = UNIX_SOCKET or ("", port)
+    listen_on = UNIX_SOCKET or f"port {port}"
+    workers = prefork.worker_count()
     logger.info(
         "Calculator server is listening on port",
         extra={
@@ -527,10 +984,37 @@ def run(port: int = PORT):
             "public_ip": "SYSTEM",
             "response_status": "200",
             "port": port,
+            "unix_socket": UNIX_SOCKET,
+            "workers": workers,
+            "max_in_flight": admission.max_in_flight,
+            "queue_size": admission.queue.maxsize,
+            "queue_timeout_ms": QUEUE_TIMEOUT_MS,
         },
     )
-    print(f"Calculator server is listening on port {port}")
+    print(f"Calculator server is listening on {listen_on}")
     print(f"Log directory: {LOG_DIR}")
+
+    if workers > 1:
+        prefork.serve(
+            make_server,
+            server_address,
+            workers,
+            logger=logger,
+            on_worker_start=start_background_tasks,
+        )
+        logger.info(
+            "Calculator server stopped",
+            extra={
+                "request": "SERVER_STOP",
+                "client_ip": "SYSTEM",
+                "public_ip": "SYSTEM",
+                "response_status": "200",
+            },
+        )
+        return
+
+    httpd = make_server(server_address)
+    start_background_tasks()
     try:
         httpd.serve_forever()
     except KeyboardInterrupt:
@@ -541,6 +1025,7 @@ def run(port: int = PORT):
                 "client_ip": "SYSTEM",
                 "public_ip": "SYSTEM",
                 "response_status": "200",
+                "admission": admission.stats(),
             },
         )
         print("\nShutting down server...")
@@ -0,0 +1,247 @@
+import csv
+import json
+import logging
+import math
+import os
+import threading
+from array import array
+
+# --- Каталог цен на материалы и работы ---
+# Формат CSV: code,name,category,unit,price (первая строка — заголовок)
+# Формат JSON: [{"code": ..., "name": ..., "category": ..., "unit": ..., "price": ...}]
+#              или {"items": [...]}
+
+logger = logging.getLogger("calculator.catalog")
+
+REQUIRED_FIELDS = ("code", "category", "price")
+
+
+class CatalogError(Exception):
+    """Ошибка загрузки каталога"""
+
+
+class Catalog:
+    """Компактный индекс каталога: код → номер строки, цены в array('d').
+
+    Названия хранятся одним UTF-8 блоком со смещениями, категории и единицы
+    измерения — номерами в небольших справочниках. Так 100k позиций занимают
+    единицы мегабайт, а поиск по коду остаётся O(1).
+    """
+
+    def __init__(self, rows, source="", mtime=0.0):
+        self.source = source
+        self.mtime = mtime
+        self.index = {}
+        self.prices = array("d")
+        self.category_ids = array("I")
+        self.unit_ids = array("I")
+        self.name_offsets = array("I", [0])
+        self.categories = []
+        self.units = []
+
+        category_lookup = {}
+        unit_lookup = {}
+        names = bytearray()
+
+        for row in rows:
+            code = str(row["code"]).strip()
+            if not code:
+                raise CatalogError("Пустой код позиции")
+            if code in self.index:
+                raise CatalogError(f"Повторяющийся код позиции: {code}")
+            try:
+                price = float(row["price"])
+            except (TypeError, ValueError):
+                raise CatalogError(f"Некорректная цена у позиции {code}")
+            if not math.isfinite(price):
+                raise CatalogError(f"Нечисловая цена у позиции {code}")
+            if price < 0:
+                raise CatalogError(f"Отрицательная цена у позиции {code}")
+
+            category = str(row["category"]).strip()
+            unit = str(row.get("unit") or "").strip()
+            if category not in category_lookup:
+                category_lookup[category] = len(self.categories)
+                self.categories.append(category)
+            if unit not in unit_lookup:
+                unit_lookup[unit] = len(self.units)
+                self.units.append(unit)
+
+            self.index[code] = len(self.prices)
+            self.prices.append(price)
+            self.category_ids.append(category_lookup[category])
+            self.unit_ids.append(unit_lookup[unit])
+            names += str(row.get("name") or "").encode("utf-8")
+            self.name_offsets.append(len(names))
+
+        self.names = bytes(names)
+
+    def __len__(self):
+        return len(self.prices)
+
+    def __contains__(self, code):
+        return code in self.index
+
+    def _name(self, i):
+        return self.names[self.name_offsets[i] : self.name_offsets[i + 1]].decode(
+            "utf-8"
+        )
+
+    def get(self, code):
+        """Позиция каталога по коду или None"""
+        i = self.index.get(code)
+        if i is None:
+            return None
+        return {
+            "code": code,
+            "name": self._name(i),
+            "category": self.categories[self.category_ids[i]],
+            "unit": self.units[self.unit_ids[i]],
+            "price": self.prices[i],
+        }
+
+    def estimate(self, items):
+        """Смета по списку {"code", "quantity"} с разбивкой по категориям.
+
+        Возвращает (смета, список неизвестных кодов).
+        """
+        lines = []
+        by_category = {}
+        unknown = []
+        total = 0.0
+
+        for item in items:
+            code = item["code"]
+            i = self.index.get(code)
+            if i is None:
+                unknown.append(code)
+                continue
+            quantity = float(item["quantity"])
+            if not math.isfinite(quantity):
+                raise ValueError(f"Нечисловое количество у позиции {code}")
+            price = self.prices[i]
+            cost = quantity * price
+            category = self.categories[self.category_ids[i]]
+            lines.append(
+                {
+                    "code": code,
+                    "name": self._name(i),
+                    "category": category,
+                    "unit": self.units[self.unit_ids[i]],
+                    "quantity": quantity,
+                    "price": price,
+                    "cost": cost,
+                }
+            )
+            by_category[category] = by_category.get(category, 0.0) + cost
+            total += cost
+
+        estimate = {
+            "lines": lines,
+            "categories": by_category,
+            "totalCost": total,
+        }
+        return estimate, unknown
+
+
+def _iter_rows(path):
+    """Построчно читает каталог; CSV не загружается в память целиком"""
+    ext = os.path.splitext(path)[1].lower()
+    if ext == ".json":
+        with open(path, encoding="utf-8") as f:
+            data = json.load(f)
+        if isinstance(data, dict):
+            data = data.get("items", [])
+        if not isinstance(data, list):
+            raise CatalogError("JSON-каталог должен быть списком позиций")
+        rows = iter(data)
+    elif ext == ".csv":
+        f = open(path, encoding="utf-8", newline="")
+        rows = csv.DictReader(f)
+    else:
+        raise CatalogError(f"Неподдерживаемый формат каталога: {ext}")
+
+    try:
+        for row in rows:
+            if not isinstance(row, dict) or any(
+                row.get(field) in (None, "") for field in REQUIRED_FIELDS
+            ):
+                raise CatalogError(
+                    f"Позиция каталога без обязательных полей {REQUIRED_FIELDS}: {row}"
+                )
+            yield row
+    finally:
+        if ext == ".csv":
+            f.close()
+
+
+def load_catalog(path):
+    """Загружает каталог из CSV или JSON"""
+    mtime = os.stat(path).st_mtime
+    return Catalog(_iter_rows(path), source=path, mtime=mtime)
+
+
+class CatalogStore:
+    """Текущий каталог с горячей перезагрузкой по изменению файла.
+
+    Новый индекс строится целиком в фоновом потоке и подменяется одной
+    операцией присваивания, поэтому запросы всегда видят целостный каталог.
+    При ошибке загрузки остаётся предыдущая версия.
+    """
+
+    def __init__(self, path, reload_interval=5.0):
+        self.path = path
+        self.reload_interval = reload_interval
+        self.catalog = None
+        self._stop = threading.Event()
+        self._thread = None
+
+    def load(self):
+        try:
+            mtime = os.stat(self.path).st_mtime
+        except OSError as e:
+            logger.error(
+                "Файл каталога недоступен",
+                extra={"request": "CATALOG_LOAD", "path": self.path, "error": str(e)},
+            )
+            return False
+
+        current = self.catalog
+        if current is not None and current.mtime == mtime:
+            return False
+
+        try:
+            catalog = load_catalog(self.path)
+        except (OSError, ValueError, csv.Error, CatalogError) as e:
+            logger.error(
+                "Ошибка загрузки каталога — оставляем предыдущую версию",
+                extra={"request": "CATALOG_LOAD", "path": self.path, "error": str(e)},
+            )
+            return False
+
+        self.catalog = catalog
+        logger.info(
+            "Каталог загружен",
+            extra={
+                "request": "CATALOG_LOAD",
+                "path": self.path,
+                "items": len(catalog),
+                "categories": len(catalog.categories),
+            },
+        )
+        return True
+
+    def start(self):
+        self.load()
+        if self.reload_interval > 0 and self._thread is None:
+            self._thread = threading.Thread(
+                target=self._watch, name="catalog-reload", daemon=True
+            )
+            self._thread.start()
+
+    def stop(self):
+        self._stop.set()
+
+    def _watch(self):
+        while not self._stop.wait(self.reload_interval):
+            self.load()
@@ -1,3 +1,4 @@
+import functools
 import http.server
 import socketserver
 import json
@@ -9,14 +10,33 @@ from concurrent.futures import ThreadPoolExecutor
 import threading
 from PIL import Image
 import io
-from datetime import datetime
 import uuid
 from cerberus import Validator
+from common import (
+    adaptive_timeout,
+    fluent_forward,
+    log_pipeline,
+    log_sampling,
+    memory,
+    metrics,
+    prefork,
+    profiling,
+    tracing,
+    unix_socket,
+)
+from common.log_format import JSONFormatter
+from common.log_rotation import RotatingBatchFileHandler
+from common.fastpath import FastPath
 
 # --- Загрузка переменных окружения ---
 PORT = int(os.environ.get("GALLERY_PORT", "8000"))
+# Путь Unix domain socket вместо порта (nginx на той же машине)
+UNIX_SOCKET = os.environ.get("GALLERY_UNIX_SOCKET", "")
 LOG_DIR = os.environ.get("GALLERY_LOG_DIR", "/var/log/gallery")
 IMAGES_DIR = os.environ.get("GALLERY_IMAGES_DIR", "images")
+# Потолок таймаута сервиса определения IP; сам таймаут и задержка
+# дублирующего запроса — по задержке этих сервисов
+IP_SERVICE_TIMEOUT = float(os.environ.get("GALLERY_IP_SERVICE_TIMEOUT", "3"))
 
 # Создаём директории
 os.makedirs(LOG_DIR, exist_ok=True)
@@ -28,57 +48,21 @@ logger.setLevel(logging.INFO)
 logger.handlers.clear()  # Убираем возможные дубликаты от других модулей
 
 log_file = os.path.join(LOG_DIR, "gallery.log")
-file_handler = logging.FileHandler(log_file, encoding="utf-8")
+file_handler = RotatingBatchFileHandler(log_file, encoding="utf-8")
 file_handler.setLevel(logging.INFO)
 
 
-# --- JSON-форматтер (ключевой компонент) ---
-class JSONFormatter(logging.Formatter):
-    def format(self, record):
-        log_entry = {
-            "timestamp": datetime.utcfromtimestamp(record.created).strftime(
-                "%Y-%m-%dT%H:%M:%SZ"
-            ),
-            "level": record.levelname,
-            "logger": record.name,
-            "message": record.getMessage(),
-            "module": record.module,
-            "function": record.funcName,
-            "line": record.lineno,
-        }
-
-        # Добавляем все поля из extra, кроме стандартных
-        for key, value in record.__dict__.items():
-            if key not in (
-                "asctime",
-                "created",
-                "filename",
-                "funcName",
-                "levelname",
-                "levelno",
-                "lineno",
-                "module",
-                "msecs",
-                "msg",
-                "name",
-                "pathname",
-                "process",
-                "processName",
-                "relativeCreated",
-                "thread",
-                "threadName",
-            ):
-                if key not in log_entry:
-                    log_entry[key] = value
-
-        return json.dumps(log_entry, ensure_ascii=False)
-
-
 # Применяем форматтер
-file_handler.setFormatter(JSONFormatter())
+file_handler.setFormatter(JSONFormatter(static_fields={"service": "gallery"}))
 logger.addHandler(file_handler)
 logger.propagate = False  # Не наследуем от root
 
+# LOG_FORWARD — отправка в fluent-bit по Forward-протоколу вместо файла
+fluent_forward.install(logger, tag="gallery")
+
+# Запись в файл — в фоновом потоке, пачками (LOG_ASYNC=0 — синхронно)
+log_pipeline.install(logger)
+
 
 # --- Фильтр для автодобавления полей (если не заданы) ---
 class GalleryContextFilter(logging.Filter):
@@ -98,6 +82,19 @@ class GalleryContextFilter(logging.Filter):
 
 logger.addFilter(GalleryContextFilter())
 
+# --- Сэмплирование частой диагностики: 1% записей + счётчики раз в 10 с ---
+log_sampling.install(
+    logger,
+    {
+        "IP_CHECK": 0.01,
+        "IP_VALIDATE": 0.01,
+        "HEADER_IP": 0.01,
+        "SOCKET_IP": 0.01,
+        "CORS_SET": 0.01,
+        "Извлечён индекс": 0.01,
+    },
+)
+
 # --- Проверка изображений ---
 IMAGE_FILES = sorted(
     [
@@ -125,6 +122,8 @@ class IPResolver:
             "https://ipinfo.io/ip",
             "https://ifconfig.me/ip",
         ]
+        # Сервисы равноценны: одно распределение задержки на всех
+        self.latency = adaptive_timeout.tracker("ip_service", IP_SERVICE_TIMEOUT)
 
     def get_public_ip(self, client_ip):
         logger.info(
@@ -153,6 +152,7 @@ class IPResolver:
         else:
             with self.cache_lock:
                 if client_ip in self.ip_cache:
+                    metrics.cache_hit("ip_cache")
                     public_ip, source = self.ip_cache[client_ip]
                     logger.info(
                         "Клиент — найден в кэше",
@@ -166,6 +166,7 @@ class IPResolver:
                     )
                     return public_ip, source
 
+            metrics.cache_miss("ip_cache")
             public_ip = self._resolve_public_ip(client_ip)
             source = "external_service"
             logger.info(
@@ -267,7 +268,9 @@ class IPResolver:
                         "service": service_url,
                     },
                 )
-                response = requests.get(service_url, timeout=3)
+                timeout = self.latency.timeout()
+                with self.latency.measure(timeout):
+                    response = requests.get(service_url, timeout=timeout)
                 if response.status_code == 200:
                     ip = response.text.strip()
                     if self._is_valid_ip(ip):
@@ -307,14 +310,14 @@ class IPResolver:
                 )
             return None
 
-        futures = [
-            self.executor.submit(try_service, service) for service in self.ip_services
-        ]
-
-        for future in futures:
-            result = future.result(timeout=5)
-            if result:
-                return result
+        # Сначала один сервис; следующий — если тот не ответил за p95 задержки
+        result = adaptive_timeout.first_result(
+            self.executor,
+            [functools.partial(try_service, service) for service in self.ip_services],
+            self.latency,
+        )
+        if result:
+            return result
 
         logger.warning(
             "Все сервисы не ответили — возвращаем клиентский IP",
@@ -388,8 +391,35 @@ ip_resolver = IPResolver()
 scale_cache = {}
 cache_lock = threading.Lock()
 
+# --- Быстрый путь: OPTIONS, /healthz, /readyz ---
+fast_path = FastPath(
+    "GET, OPTIONS",
+    options_status=204,
+    ready_check=lambda: len(IMAGE_FILES) > 0,
+    logger=logger,
+)
+# GET /metrics: запросы, задержка, этапы, попадания в кэши
+metrics.install(fast_path)
+# GET /debug/profile и /debug/memory: только при заданном PROFILE_TOKEN
+profiling.install(fast_path)
+memory.install(fast_path)
+metrics.CACHE_ENTRIES.labels("scale_cache").set_function(lambda: len(scale_cache))
+metrics.CACHE_ENTRIES.labels("ip_cache").set_function(
+    lambda: len(ip_resolver.ip_cache)
+)
+memory.register_cache(
+    "scale_cache",
+    lambda: len(scale_cache),
+    lambda: sum(len(data) for data, _ in list(scale_cache.values())),
+)
+memory.register_cache("ip_cache", lambda: len(ip_resolver.ip_cache))
+
 
-class MyHandler(http.server.SimpleHTTPRequestHandler):
+class MyHandler(
+    profiling.ProfiledHandler,
+    metrics.InstrumentedHandler,
+    http.server.SimpleHTTPRequestHandler,
+):
     def _get_client_ip(self):
         ip_headers = [
             "X-Real-IP",
@@ -431,7 +461,8 @@ class MyHandler(http.server.SimpleHTTPRequestHandler):
 
     def _get_public_ip(self):
         client_ip = self._get_client_ip()
-        public_ip, source = ip_resolver.get_public_ip(client_ip)
+        with tracing.span("resolve"):
+            public_ip, source = ip_resolver.get_public_ip(client_ip)
         logger.info(
             "Клиент → публичный IP",
             extra={
@@ -448,6 +479,7 @@ class MyHandler(http.server.SimpleHTTPRequestHandler):
         self.send_header("Access-Control-Allow-Origin", "*")
         self.send_header("Access-Control-Allow-Methods", "GET, OPTIONS")
         self.send_header("Access-Control-Allow-Headers", "Content-Type")
+        tracing.send_server_timing(self)
         logger.info(
             "CORS заголовки установлены",
             extra={
@@ -459,20 +491,15 @@ class MyHandler(http.server.SimpleHTTPRequestHandler):
         )
 
     def do_OPTIONS(self):
-        logger.info(
-            "OPTIONS запрос",
-            extra={
-                "request": "OPTIONS",
-                "client_ip": self.client_address[0],
-                "public_ip": self._get_public_ip(),
-                "response_status": "204",
-            },
-        )
-        self.send_response(204)
-        self._set_cors_headers()
-        self.end_headers()
+        fast_path.handle(self)
 
     def do_GET(self):
+        if fast_path.handle(self):
+            return
+
+        # Этапы для Server-Timing (SERVER_TIMING=1 или X-Server-Timing: 1)
+        tracing.start_timing(self.headers)
+
         logger.info(
             "Начало обработки GET-запроса",
             extra={
@@ -631,8 +658,11 @@ class MyHandler(http.server.SimpleHTTPRequestHandler):
                 if scale is not None:
                     cache_key = (file_path, scale)
                     with cache_lock:
-                        if cache_key in scale_cache:
-                            image_data, ct = scale_cache[cache_key]
+                        with tracing.span("cache"):
+                            cached = scale_cache.get(cache_key)
+                        if cached is not None:
+                            metrics.cache_hit("scale_cache")
+                            image_data, ct = cached
                             logger.info(
                                 "Кэшированное изображение — отдаём из кэша",
                                 extra={
@@ -645,6 +675,7 @@ class MyHandler(http.server.SimpleHTTPRequestHandler):
                                 },
                             )
                         else:
+                            metrics.cache_miss("scale_cache")
                             try:
                                 with Image.open(file_path) as img:
                                     original_size = img.size
@@ -665,22 +696,24 @@ class MyHandler(http.server.SimpleHTTPRequestHandler):
                                             "new_size": new_size,
                                         },
                                     )
-                                    img_resized = img.resize(
-                                        new_size, Image.Resampling.LANCZOS
-                                    )
-                                    buffer = io.BytesIO()
-                                    if ext in [".jpg", ".jpeg"]:
-                                        img_resized.save(
-                                            buffer, format="JPEG", quality=85
-                                        )
-                                    elif ext == ".png":
-                                        img_resized.save(
-                                            buffer, format="PNG", optimize=True
-                                        )
-                                    elif ext == ".gif":
-                                        img_resized.save(
-                                            buffer, format="GIF", optimize=True
+                                    with tracing.span("resize"):
+                                        img_resized = img.resize(
+                                            new_size, Image.Resampling.LANCZOS
                                         )
+                                    buffer = io.BytesIO()
+                                    with tracing.span("encode"):
+                                        if ext in [".jpg", ".jpeg"]:
+                                            img_resized.save(
+                                                buffer, format="JPEG", quality=85
+                                            )
+                                        elif ext == ".png":
+                                            img_resized.save(
+                                                buffer, format="PNG", optimize=True
+                                            )
+                                        elif ext == ".gif":
+                                            img_resized.save(
+                                                buffer, format="GIF", optimize=True
+                                            )
                                     image_data = buffer.getvalue()
                                     scale_cache[cache_key] = (image_data, content_type)
                                     logger.info(
@@ -791,8 +824,11 @@ class MyHandler(http.server.SimpleHTTPRequestHandler):
                 if scale is not None:
                     cache_key = (file_path, scale)
                     with cache_lock:
-                        if cache_key in scale_cache:
-                            image_data, ct = scale_cache[cache_key]
+                        with tracing.span("cache"):
+                            cached = scale_cache.get(cache_key)
+                        if cached is not None:
+                            metrics.cache_hit("scale_cache")
+                            image_data, ct = cached
                             logger.info(
                                 "Кэшированное изображение — отдаём из кэша",
                                 extra={
@@ -805,6 +841,7 @@ class MyHandler(http.server.SimpleHTTPRequestHandler):
                                 },
                             )
                         else:
+                            metrics.cache_miss("scale_cache")
                             try:
                                 with Image.open(file_path) as img:
                                     original_size = img.size
@@ -825,23 +862,25 @@ class MyHandler(http.server.SimpleHTTPRequestHandler):
                                             "new_size": new_size,
                                         },
                                     )
-                                    img_resized = img.resize(
-                                        new_size, Image.Resampling.LANCZOS
-                                    )
+                                    with tracing.span("resize"):
+                                        img_resized = img.resize(
+                                            new_size, Image.Resampling.LANCZOS
+                                        )
                                     buffer = io.BytesIO()
                                     ext = os.path.splitext(file_path)[1].lower()
-                                    if ext in [".jpg", ".jpeg"]:
-                                        img_resized.save(
-                                            buffer, format="JPEG", quality=85
-                                        )
-                                    elif ext == ".png":
-                                        img_resized.save(
-                                            buffer, format="PNG", optimize=True
-                                        )
-                                    elif ext == ".gif":
-                                        img_resized.save(
-                                            buffer, format="GIF", optimize=True
-                                        )
+                                    with tracing.span("encode"):
+                                        if ext in [".jpg", ".jpeg"]:
+                                            img_resized.save(
+                                                buffer, format="JPEG", quality=85
+                                            )
+                                        elif ext == ".png":
+                                            img_resized.save(
+                                                buffer, format="PNG", optimize=True
+                                            )
+                                        elif ext == ".gif":
+                                            img_resized.save(
+                                                buffer, format="GIF", optimize=True
+                                            )
                                     image_data = buffer.getvalue()
                                     scale_cache[cache_key] = (
                                         image_data,
@@ -984,14 +1023,52 @@ class MyHandler(http.server.SimpleHTTPRequestHandler):
 
 def run(server_class=http.server.HTTPServer, handler_class=MyHandler, port=PORT):
     os.chdir(".")
-    print(f"Запуск сервера на порту {port}")
+    server_address = UNIX_SOCKET or ("", port)
+    tcp_server = unix_socket.server_class(socketserver.TCPServer, UNIX_SOCKET)
+    listen_on = UNIX_SOCKET or f"порту {port}"
+    print(f"Запуск сервера на {listen_on}")
     print(f"Директория логов: {LOG_DIR}")
     print(f"Директория изображений: {IMAGES_DIR}")
     print(f"Найдено изображений: {len(IMAGE_FILES)}")
 
+    workers = prefork.worker_count()
+    if workers > 1:
+        print(f"Prefork: {workers} воркеров на {listen_on}")
+        logger.info(
+            "Сервер запущен",
+            extra={
+                "request": "SERVER_START",
+                "client_ip": "SYSTEM",
+                "public_ip": "SYSTEM",
+                "response_status": "200",
+                "port": port,
+                "unix_socket": UNIX_SOCKET,
+                "workers": workers,
+            },
+        )
+        prefork.serve(
+            lambda address, bind_and_activate=True: tcp_server(
+                address, handler_class, bind_and_activate
+            ),
+            server_address,
+            workers,
+            logger=logger,
+        )
+        ip_resolver.cleanup()
+        logger.info(
+            "Сервер остановлен",
+            extra={
+                "request": "SERVER_STOP",
+                "client_ip": "SYSTEM",
+                "public_ip": "SYSTEM",
+                "response_status": "200",
+            },
+        )
+        return
+
     try:
-        with socketserver.TCPServer(("", port), handler_class) as httpd:
-            print(f"HTTP сервер запущен на порту {port}")
+        with tcp_server(server_address, handler_class) as httpd:
+            print(f"HTTP сервер запущен на {listen_on}")
             logger.info(
                 "Сервер запущен",
                 extra={
@@ -1000,6 +1077,7 @@ def run(server_class=http.server.HTTPServer, handler_class=MyHandler, port=PORT)
                     "public_ip": "SYSTEM",
                     "response_status": "200",
                     "port": port,
+                    "unix_socket": UNIX_SOCKET,
                 },
             )
             httpd.serve_forever()
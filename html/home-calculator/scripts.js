@@ -2,8 +2,13 @@ const weatherBlock = document.querySelector('.weather');
 const weatherInfo = document.createTextNode(' загрузка...')
 weatherBlock.appendChild(weatherInfo)
 
+// Чуть больше GEO_REQUEST_DEADLINE geoservice: он отвечает в пределах бюджета
+const WEATHER_TIMEOUT_MS = 10000
+
 function getCityWeather() {
-    fetch('http://localhost:7999/api/get_city')
+    const controller = new AbortController()
+    const timer = setTimeout(() => controller.abort(), WEATHER_TIMEOUT_MS)
+    fetch('http://localhost:7999/api/get_city', { signal: controller.signal })
     .then(res => res.text())
     .then(data => {
       weatherBlock.textContent = data || "данных о погоде нет"
@@ -12,7 +17,7 @@ function getCityWeather() {
       weatherBlock.textContent = "данных о погоде нет"
       console.error(err)
     })
-    
+    .finally(() => clearTimeout(timer))
 }
 getCityWeather()
 
@@ -0,0 +1,355 @@
+"""Офлайн-индекс IP-диапазонов -> город для geoservice.
+
+Индекс собирается заранее из CSV и открывается через mmap: старт мгновенный,
+страницы файла общие для всех воркеров (page cache), поиск — бинарный,
+O(log n). Город, которого нет в индексе, geoservice спрашивает у DaData.
+
+Сборка:
+    python geo_index.py build ranges.csv geo.idx
+        CSV: start_ip,end_ip,city  или  network,city  (203.0.113.0/24,Москва)
+    python geo_index.py build --maxmind GeoLite2-City-Locations-ru.csv \\
+        GeoLite2-City-Blocks-IPv4.csv GeoLite2-City-Blocks-IPv6.csv geo.idx
+Проверка:
+    python geo_index.py lookup geo.idx 77.88.55.88
+
+Формат файла (little-endian):
+    заголовок  magic(8) n4 n6 ncity reserved       — 8s + 4 x uint32
+    IPv4       starts[n4] ends[n4] city[n4]         — uint32
+    IPv6       starts[n6] ends[n6]                  — 16 байт big-endian
+               city[n6]                             — uint32
+    города     offsets[ncity + 1] (uint32), затем UTF-8 названия подряд
+"""
+
+import argparse
+import array
+import bisect
+import csv
+import ipaddress
+import mmap
+import os
+import struct
+import sys
+import threading
+
+MAGIC = b"GEOIDX1\x00"
+HEADER = struct.Struct("<8sIIII")
+IPV6_KEY = 16
+
+
+class GeoIndexError(Exception):
+    pass
+
+
+def _u32_array(buf, offset, count):
+    # Размеры таблиц берутся из заголовка: проверяем их до cast
+    if offset + 4 * count > len(buf):
+        raise ValueError("файл обрезан")
+    view = memoryview(buf)[offset : offset + 4 * count]
+    if sys.byteorder == "little":
+        return view.cast("I")
+    # На big-endian платформах — копия с перестановкой байтов
+    values = array.array("I", view.tobytes())
+    values.byteswap()
+    return values
+
+
+class GeoIndex:
+    """Индекс, отображённый в память; lookup(ip) -> город или None"""
+
+    def __init__(self, path):
+        self.path = path
+        with open(path, "rb") as f:
+            self._mmap = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        try:
+            self._parse()
+        except (struct.error, ValueError, TypeError) as e:
+            # Уже созданные memoryview не дали бы закрыть mmap (BufferError)
+            self.close()
+            raise GeoIndexError(f"Повреждённый индекс {path}: {e}") from e
+
+    def _parse(self):
+        buf = self._mmap
+        magic, n4, n6, ncity, _ = HEADER.unpack_from(buf, 0)
+        if magic != MAGIC:
+            raise ValueError("неизвестный формат")
+        offset = HEADER.size
+        self.v4_starts = _u32_array(buf, offset, n4)
+        self.v4_ends = _u32_array(buf, offset + 4 * n4, n4)
+        self.v4_cities = _u32_array(buf, offset + 8 * n4, n4)
+        offset += 12 * n4
+        # IPv6-ключи читаются срезами mmap (bytes), по смещениям таблиц
+        self.v6_starts_offset = offset
+        offset += IPV6_KEY * n6
+        self.v6_ends_offset = offset
+        offset += IPV6_KEY * n6
+        self.v6_cities = _u32_array(buf, offset, n6)
+        offset += 4 * n6
+        self.city_offsets = _u32_array(buf, offset, ncity + 1)
+        self.names_offset = offset + 4 * (ncity + 1)
+        self.v6_count = n6
+        self.city_count = ncity
+        # Раскодированные названия: заполняется по мере поиска, чтобы старт
+        # оставался мгновенным; не больше ncity строк
+        self._city_names = {}
+        if self.names_offset + (self.city_offsets[-1] if ncity else 0) > len(buf):
+            raise ValueError("файл обрезан")
+
+    def __len__(self):
+        return len(self.v4_starts) + self.v6_count
+
+    def city_name(self, index):
+        name = self._city_names.get(index)
+        if name is None:
+            start = self.names_offset + self.city_offsets[index]
+            end = self.names_offset + self.city_offsets[index + 1]
+            name = self._city_names[index] = self._mmap[start:end].decode("utf-8")
+        return name
+
+    def _lookup_v6(self, key):
+        # bisect_right по 16-байтным ключам: big-endian сравнивается как bytes
+        buf, base = self._mmap, self.v6_starts_offset
+        lo, hi = 0, self.v6_count
+        while lo < hi:
+            mid = (lo + hi) // 2
+            position = base + mid * IPV6_KEY
+            if key < buf[position : position + IPV6_KEY]:
+                hi = mid
+            else:
+                lo = mid + 1
+        i = lo - 1
+        if i < 0:
+            return None
+        position = self.v6_ends_offset + i * IPV6_KEY
+        if key <= buf[position : position + IPV6_KEY]:
+            return self.v6_cities[i]
+        return None
+
+    def lookup(self, ip):
+        try:
+            address = ipaddress.ip_address(ip)
+        except ValueError:
+            return None
+        if address.version == 6 and address.ipv4_mapped is not None:
+            address = address.ipv4_mapped
+        if address.version == 4:
+            value = int(address)
+            i = bisect.bisect_right(self.v4_starts, value) - 1
+            if i < 0 or value > self.v4_ends[i]:
+                return None
+            city = self.v4_cities[i]
+        else:
+            city = self._lookup_v6(address.packed)
+            if city is None:
+                return None
+        return self.city_name(city)
+
+    def close(self):
+        self._city_names = {}
+        # memoryview держат буфер mmap: сначала освобождаем их; после ошибки
+        # в _parse часть таблиц ещё не создана
+        for name in ("v4_starts", "v4_ends", "v4_cities", "v6_cities", "city_offsets"):
+            value = getattr(self, name, None)
+            if isinstance(value, memoryview):
+                value.release()
+        self._mmap.close()
+
+
+# --- Индекс процесса: открывается лениво, после fork — заново ---
+# Так воркеры, перезапущенные по SIGHUP, подхватывают новый файл индекса.
+
+_lock = threading.Lock()
+_index = None
+_failed = False
+
+
+def _after_fork_child():
+    global _lock, _index, _failed
+    _lock = threading.Lock()
+    _index = None
+    _failed = False
+
+
+os.register_at_fork(after_in_child=_after_fork_child)
+
+
+def get_index(path, logger=None):
+    """Индекс из path или None, если его нет или он не открывается"""
+    global _index, _failed
+    if _index is not None or _failed or not path:
+        return _index
+    with _lock:
+        if _index is None and not _failed:
+            try:
+                _index = GeoIndex(path)
+            except (OSError, ValueError, GeoIndexError) as e:
+                _failed = True
+                if logger is not None:
+                    logger.error(
+                        "Не удалось открыть гео-индекс, используется только DaData",
+                        extra={
+                            "action": "geo_index_error",
+                            "path": path,
+                            "error": str(e),
+                        },
+                    )
+            else:
+                if logger is not None:
+                    logger.info(
+                        "Гео-индекс открыт",
+                        extra={
+                            "action": "geo_index_open",
+                            "path": path,
+                            "ranges": len(_index),
+                        },
+                    )
+    return _index
+
+
+# --- Сборка индекса ---
+
+
+def _parse_range(first, second=None):
+    """(начало, конец) по паре адресов, сети CIDR или целым числам"""
+    if second is None:
+        network = ipaddress.ip_network(first.strip(), strict=False)
+        return network.network_address, network.broadcast_address
+    start, end = first.strip(), second.strip()
+    if start.isdigit() and end.isdigit():
+        version = 4 if int(end) < 2**32 else 6
+        factory = ipaddress.IPv4Address if version == 4 else ipaddress.IPv6Address
+        return factory(int(start)), factory(int(end))
+    return ipaddress.ip_address(start), ipaddress.ip_address(end)
+
+
+def read_csv_ranges(path):
+    """start_ip,end_ip,city или network,city; строки-заголовки пропускаются"""
+    with open(path, newline="", encoding="utf-8") as f:
+        for row in csv.reader(f):
+            if not row or row[0].startswith("#"):
+                continue
+            try:
+                if len(row) >= 3:
+                    start, end = _parse_range(row[0], row[1])
+                    city = row[2]
+                else:
+                    start, end = _parse_range(row[0])
+                    city = row[1]
+            except (ValueError, IndexError):
+                continue  # заголовок или мусор
+            city = city.strip()
+            if city:
+                yield start, end, city
+
+
+def read_maxmind_ranges(locations_path, blocks_paths):
+    """GeoLite2-City CSV: Locations (geoname_id -> город) и Blocks (network)"""
+    names = {}
+    with open(locations_path, newline="", encoding="utf-8") as f:
+        for row in csv.DictReader(f):
+            city = row.get("city_name") or row.get("subdivision_1_name")
+            if city:
+                names[row["geoname_id"]] = city
+    for path in blocks_paths:
+        with open(path, newline="", encoding="utf-8") as f:
+            for row in csv.DictReader(f):
+                city = names.get(row.get("geoname_id"))
+                if city:
+                    start, end = _parse_range(row["network"])
+                    yield start, end, city
+
+
+def _merge(ranges):
+    """Сортирует диапазоны, отбрасывает перекрытия, склеивает соседние"""
+    merged = []
+    dropped = 0
+    for start, end, city in sorted(ranges):
+        if merged and start <= merged[-1][1]:
+            dropped += 1
+            continue
+        if merged and start == merged[-1][1] + 1 and city == merged[-1][2]:
+            merged[-1][1] = end
+        else:
+            merged.append([start, end, city])
+    return merged, dropped
+
+
+def build(ranges, output):
+    """Пишет индекс в output (атомарно); возвращает статистику"""
+    v4, v6 = [], []
+    for start, end, city in ranges:
+        if start.version != end.version or int(start) > int(end):
+            continue
+        target = v4 if start.version == 4 else v6
+        target.append((int(start), int(end), city))
+    v4, dropped4 = _merge(v4)
+    v6, dropped6 = _merge(v6)
+
+    cities = {}
+    for item in v4 + v6:
+        item[2] = cities.setdefault(item[2], len(cities))
+    names = [name.encode("utf-8") for name in cities]
+    offsets = [0]
+    for name in names:
+        offsets.append(offsets[-1] + len(name))
+
+    def u32(values):
+        data = array.array("I", values)
+        if sys.byteorder != "little":
+            data.byteswap()
+        return data.tobytes()
+
+    tmp = f"{output}.tmp"
+    with open(tmp, "wb") as f:
+        f.write(HEADER.pack(MAGIC, len(v4), len(v6), len(names), 0))
+        f.write(u32(r[0] for r in v4))
+        f.write(u32(r[1] for r in v4))
+        f.write(u32(r[2] for r in v4))
+        f.write(b"".join(r[0].to_bytes(IPV6_KEY, "big") for r in v6))
+        f.write(b"".join(r[1].to_bytes(IPV6_KEY, "big") for r in v6))
+        f.write(u32(r[2] for r in v6))
+        f.write(u32(offsets))
+        f.write(b"".join(names))
+    # Воркеры со старым mmap дочитывают прежний файл до перезапуска
+    os.replace(tmp, output)
+    return {
+        "ipv4_ranges": len(v4),
+        "ipv6_ranges": len(v6),
+        "cities": len(names),
+        "overlapping_dropped": dropped4 + dropped6,
+    }
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Офлайн-индекс IP -> город")
+    commands = parser.add_subparsers(dest="command", required=True)
+
+    build_cmd = commands.add_parser("build", help="собрать индекс из CSV")
+    build_cmd.add_argument(
+        "--maxmind",
+        metavar="LOCATIONS_CSV",
+        help="входные файлы — GeoLite2-City Blocks, города из LOCATIONS_CSV",
+    )
+    build_cmd.add_argument("inputs", nargs="+", help="CSV с диапазонами")
+    build_cmd.add_argument("output", help="файл индекса")
+
+    lookup_cmd = commands.add_parser("lookup", help="найти город по IP")
+    lookup_cmd.add_argument("index")
+    lookup_cmd.add_argument("ips", nargs="+")
+
+    args = parser.parse_args(argv)
+    if args.command == "build":
+        if args.maxmind:
+            ranges = read_maxmind_ranges(args.maxmind, args.inputs)
+        else:
+            ranges = (r for path in args.inputs for r in read_csv_ranges(path))
+        stats = build(ranges, args.output)
+        print(", ".join(f"{key}={value}" for key, value in stats.items()))
+    else:
+        index = GeoIndex(args.index)
+        for ip in args.ips:
+            print(f"{ip}\t{index.lookup(ip) or '-'}")
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
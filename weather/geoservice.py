@@ -1,16 +1,36 @@
+import functools
 import http.server
+import ipaddress
 import socketserver
 import json
 import logging
 import os
 import re
 import socket
-import urllib.request
-import urllib.parse
 from urllib.parse import urlparse
-from http.client import HTTPConnection
-from datetime import datetime
-import uuid
+
+from common import (
+    adaptive_timeout,
+    cache,
+    circuit_breaker,
+    deadline,
+    fluent_forward,
+    http_pool,
+    log_pipeline,
+    log_sampling,
+    memory,
+    metrics,
+    prefork,
+    profiling,
+    rate_limit,
+    tracing,
+    unix_socket,
+)
+from common.log_format import JSONFormatter
+from common.log_rotation import RotatingBatchFileHandler
+from common.fastpath import FastPath
+
+import geo_index
 
 # --- Конфигурация из переменных окружения ---
 LOG_DIR = os.getenv("GEOSERVICE_LOG_DIR", "/var/log/geoservice")
@@ -24,10 +44,65 @@ DADATA_API_URL = os.getenv(
 )
 DADATA_TOKEN = os.getenv("DADATA_TOKEN")
 
+IPIFY_URL = os.getenv("IPIFY_URL", "https://api.ipify.org")
+
+# Бюджет запроса /api/get_city, секунды: делится между ipify, DaData и
+# weather_service, остаток уходит в weather_service в X-Deadline-Ms
+GEO_REQUEST_DEADLINE = float(os.getenv("GEO_REQUEST_DEADLINE", "8"))
+# Потолок таймаута каждого этапа; сам таймаут — по p99 задержки upstream
+# (common/adaptive_timeout.py), не больше остатка бюджета
+IPIFY_TIMEOUT = float(os.getenv("GEO_IPIFY_TIMEOUT", "3"))
+DADATA_TIMEOUT = float(os.getenv("GEO_DADATA_TIMEOUT", "5"))
+WEATHER_TIMEOUT = float(os.getenv("GEO_WEATHER_TIMEOUT", "5"))
+# Нижняя граница таймаута weather_service. Его задержка двугорбая: попадание в
+# кэш погоды — миллисекунды, промах — полный вызов OpenWeather, а промахов
+# меньше 1% и в p99 они не видны. Граница должна покрывать холодный запрос
+# (OPENWEATHER_TIMEOUT weather_service плюс накладные расходы); по умолчанию
+# равна потолку, то есть таймаут этого этапа не адаптивный
+WEATHER_TIMEOUT_FLOOR = float(
+    os.getenv("GEO_WEATHER_TIMEOUT_FLOOR", str(WEATHER_TIMEOUT))
+)
+# Сколько бюджета ipify и DaData оставляют на запрос погоды
+GEO_WEATHER_RESERVE = float(os.getenv("GEO_WEATHER_RESERVE", "1"))
+
+# Ограничение частоты /api/get_city на клиента: GEO_RATE_LIMIT запросов в
+# секунду, всплеск до GEO_RATE_BURST; 0 — без ограничения. Таблица клиентов —
+# GEO_RATE_LIMIT_SLOTS ячеек по 16 байт
+GEO_RATE_LIMIT = float(os.getenv("GEO_RATE_LIMIT", "1"))
+GEO_RATE_BURST = int(os.getenv("GEO_RATE_BURST", "20"))
+GEO_RATE_LIMIT_SLOTS = int(os.getenv("GEO_RATE_LIMIT_SLOTS", "65536"))
+# Прокси (адреса и подсети через запятую), чьим X-Real-IP/X-Forwarded-For
+# верит ограничение частоты; от остальных клиент — адрес соединения
+GEO_TRUSTED_PROXIES = [
+    ipaddress.ip_network(network.strip(), strict=False)
+    for network in os.getenv("GEO_TRUSTED_PROXIES", "127.0.0.0/8,::1").split(",")
+    if network.strip()
+]
+
+# Офлайн-индекс IP -> город (geo_index.py build ...); пусто — только DaData
+GEO_INDEX_PATH = os.getenv("GEO_INDEX_PATH", "")
+
+# Кэш город по IP: ключ — подсеть /24 (IPv4) или /48 (IPv6), GEO_CACHE_PREFIX=0 —
+# точный адрес; ошибки DaData помним GEO_CACHE_NEGATIVE_TTL секунд
+GEO_CACHE_SIZE = int(os.getenv("GEO_CACHE_SIZE", "10000"))
+GEO_CACHE_TTL = float(os.getenv("GEO_CACHE_TTL", "86400"))
+GEO_CACHE_NEGATIVE_TTL = float(os.getenv("GEO_CACHE_NEGATIVE_TTL", "30"))
+# Сколько ещё после TTL помнить город, чтобы отдать его, пока DaData лежит
+GEO_CACHE_STALE_TTL = float(os.getenv("GEO_CACHE_STALE_TTL", "604800"))
+# Сколько помнить последнюю погоду в городе на случай отказа weather_service
+WEATHER_STALE_TTL = float(os.getenv("WEATHER_STALE_TTL", "3600"))
+GEO_CACHE_PREFIX = os.getenv("GEO_CACHE_PREFIX", "1").lower() in ("1", "true", "yes")
+
 # Weather Service (внутренний)
 WEATHER_SERVICE_HOST = os.getenv("WEATHER_SERVICE_HOST", "weather_service")
 WEATHER_SERVICE_PORT = int(os.getenv("WEATHER_SERVICE_PORT", "8002"))
 WEATHER_SERVICE_PATH = os.getenv("WEATHER_SERVICE_PATH", "/api/weather")
+# Путь Unix domain socket weather_service (общий том): вместо TCP-порта
+WEATHER_SERVICE_UNIX_SOCKET = os.getenv("WEATHER_SERVICE_UNIX_SOCKET", "")
+# http — weather_service по сети (отдельный контейнер, масштабируется);
+# inprocess — его код в этом же процессе: без HTTP-хопа и JSON, общие кэши
+WEATHER_MODE = os.getenv("WEATHER_MODE", "http").lower()
+WEATHER_MODES = ("http", "inprocess")
 
 # Локальные IP-шаблоны
 LOCAL_IP_PATTERNS = [
@@ -49,6 +124,11 @@ def validate_environment():
             "⚠️  ВНИМАНИЕ: Используется тестовый токен DaData. Замените его на реальный!"
         )
 
+    if WEATHER_MODE not in WEATHER_MODES:
+        errors.append(
+            f"Неизвестный WEATHER_MODE={WEATHER_MODE}, используется http"
+        )
+
     if not os.path.exists(LOG_DIR):
         try:
             os.makedirs(LOG_DIR)
@@ -64,56 +144,14 @@ for error in env_errors:
     print(error)
 
 
-# --- JSON-форматтер для логов ---
-class JSONFormatter(logging.Formatter):
-    def format(self, record):
-        log_entry = {
-            "timestamp": datetime.utcfromtimestamp(record.created).strftime(
-                "%Y-%m-%dT%H:%M:%SZ"
-            ),
-            "level": record.levelname,
-            "message": record.getMessage(),
-            "logger": record.name,
-            "module": record.module,
-            "function": record.funcName,
-            "line": record.lineno,
-        }
-
-        # Добавляем все поля из extra
-        for key, value in record.__dict__.items():
-            if key not in (
-                "asctime",
-                "created",
-                "filename",
-                "funcName",
-                "levelname",
-                "levelno",
-                "lineno",
-                "module",
-                "msecs",
-                "msg",
-                "name",
-                "pathname",
-                "process",
-                "processName",
-                "relativeCreated",
-                "thread",
-                "threadName",
-            ):
-                if key not in log_entry:
-                    log_entry[key] = value
-
-        return json.dumps(log_entry, ensure_ascii=False)
-
-
 # --- Настройка логирования (КРИТИЧЕСКИЙ ИСПРАВЛЕННЫЙ БЛОК) ---
 logger = logging.getLogger(__name__)
 logger.setLevel(LOG_LEVEL)  # ✅ УСТАНАВЛИВАЕМ УРОВЕНЬ ЛОГГЕРА ПЕРЕД ОБРАБОТЧИКАМИ!
 logger.handlers.clear()  # Убираем возможные дубликаты (например, от других модулей)
 
 # Файл-обработчик с JSON-форматтером
-file_handler = logging.FileHandler(LOG_FILE, encoding="utf-8")
-file_handler.setFormatter(JSONFormatter())
+file_handler = RotatingBatchFileHandler(LOG_FILE, encoding="utf-8")
+file_handler.setFormatter(JSONFormatter(static_fields={"service": "geoservice"}))
 logger.addHandler(file_handler)
 
 # Консольный вывод — отключён в продакшене. Включить при отладке:
@@ -124,6 +162,12 @@ logger.addHandler(file_handler)
 # Не наследовать логи от родительских логгеров (чтобы избежать дублирования)
 logger.propagate = False
 
+# LOG_FORWARD — отправка в fluent-bit по Forward-протоколу вместо файла
+fluent_forward.install(logger, tag="geoservice")
+
+# Запись в файл — в фоновом потоке, пачками (LOG_ASYNC=0 — синхронно)
+log_pipeline.install(logger)
+
 
 # --- Фильтр для добавления дефолтных полей ---
 class ContextFilter(logging.Filter):
@@ -139,8 +183,13 @@ class ContextFilter(logging.Filter):
         return True
 
 
+# request_id/trace_id текущего запроса — раньше значений по умолчанию
+logger.addFilter(tracing.TraceContextFilter())
 logger.addFilter(ContextFilter())
 
+# --- Сэмплирование: правила задаются через LOG_SAMPLE_RATES ---
+log_sampling.install(logger, {})
+
 
 # --- Основной код приложения ---
 def is_local_ip(ip: str) -> bool:
@@ -152,46 +201,205 @@ def is_local_ip(ip: str) -> bool:
     return False
 
 
+# --- Размыкатели и последние удачные ответы upstream ---
+# Пока цепь разомкнута, upstream не вызывается: вместо таймаута в секунды —
+# последний удачный ответ (город подсети, свой публичный IP, погода в городе)
+# или сразу ошибка, если такого ответа нет.
+DADATA_BREAKER = circuit_breaker.CircuitBreaker("dadata", logger)
+IPIFY_BREAKER = circuit_breaker.CircuitBreaker("ipify", logger)
+WEATHER_BREAKER = circuit_breaker.CircuitBreaker("weather_service", logger)
+
+IPIFY_LATENCY = adaptive_timeout.tracker("ipify", IPIFY_TIMEOUT)
+DADATA_LATENCY = adaptive_timeout.tracker("dadata", DADATA_TIMEOUT)
+WEATHER_LATENCY = adaptive_timeout.tracker(
+    "weather_service", WEATHER_TIMEOUT, floor=WEATHER_TIMEOUT_FLOOR
+)
+
+STALE_RESPONSES = metrics.counter(
+    "stale_responses_total",
+    "Ответы из последнего удачного значения при недоступном upstream",
+    ("upstream",),
+)
+
+# Запасной адрес, если ipify ни разу не ответил
+DEFAULT_PUBLIC_IP = "8.8.8.8"
+_last_public_ip = None
+
+
+def remember_public_ip(ip: str) -> str:
+    global _last_public_ip
+    _last_public_ip = ip
+    return ip
+
+
+def fallback_public_ip() -> str:
+    if _last_public_ip is not None:
+        STALE_RESPONSES.labels("ipify").inc()
+        return _last_public_ip
+    return DEFAULT_PUBLIC_IP
+
+
+def stage_timeout(breaker, latency, stage, reserve=GEO_WEATHER_RESERVE):
+    """Таймаут этапа или None, если upstream не вызываем: бюджет запроса
+    исчерпан или цепь разомкнута"""
+    try:
+        timeout = deadline.timeout(latency.timeout(), reserve, stage)
+    except deadline.DeadlineExceeded:
+        return None
+    return timeout if breaker.allow() else None
+
+
+def upstream_failed(breaker, error, reserve=GEO_WEATHER_RESERVE):
+    """Таймаут из-за урезанного бюджета запроса на upstream не списывается"""
+    budget = deadline.current()
+    if (
+        isinstance(error, TimeoutError)
+        and budget is not None
+        and budget.expired(reserve + deadline.DEADLINE_MIN_STAGE)
+    ):
+        breaker.record_ignored()
+    else:
+        breaker.record_failure()
+
+
 def get_public_ip() -> str:
+    timeout = stage_timeout(IPIFY_BREAKER, IPIFY_LATENCY, "ipify")
+    if timeout is None:
+        return fallback_public_ip()
     try:
-        with urllib.request.urlopen("https://api.ipify.org", timeout=3) as response:
-            return response.read().decode("utf-8").strip()
+        with tracing.span("ipify"), IPIFY_LATENCY.measure(timeout):
+            response = http_pool.request("GET", IPIFY_URL, timeout=timeout)
+        if response.status != 200:
+            raise ValueError(f"HTTP {response.status}")
+        ip = response.text().strip()
     except Exception as e:
+        upstream_failed(IPIFY_BREAKER, e)
         logger.warning(
             "Не удалось получить публичный IP",
             extra={"action": "get_public_ip", "error": str(e)},
         )
-        return "8.8.8.8"
+        return fallback_public_ip()
+    IPIFY_BREAKER.record_success()
+    return remember_public_ip(ip)
+
+
+city_cache = cache.TTLCache(
+    "city_cache",
+    GEO_CACHE_SIZE,
+    GEO_CACHE_TTL,
+    GEO_CACHE_NEGATIVE_TTL,
+    stale_ttl=GEO_CACHE_STALE_TTL,
+)
+memory.register_cache("city_cache", lambda: len(city_cache))
+
+GEO_INDEX_LOOKUPS = metrics.counter(
+    "geo_index_lookups_total", "Поиск города в офлайн-индексе", ("result",)
+)
 
+# Значение в кэше для подсети, город которой DaData не отдала
+CITY_UNAVAILABLE = "Сервис временно недоступен"
+CITY_ERROR = "Не удалось определить город"
+
+
+def city_cache_key(ip: str) -> str:
+    return cache.ip_prefix_key(ip) if GEO_CACHE_PREFIX else ip
+
+
+def cached_city(key: str):
+    """(найдено в кэше, город или None)"""
+    city = city_cache.get(key)
+    if city is None:
+        return False, None
+    return True, (None if city == CITY_UNAVAILABLE else city)
+
+
+def settle_city(key: str, city) -> str:
+    """Кладёт ответ DaData в кэш; при ошибке — последний удачный город или None"""
+    if city is not None:
+        city_cache.set(key, city)
+        return city
+    stale = city_cache.get_stale(key)
+    if stale is not None and stale != CITY_UNAVAILABLE:
+        STALE_RESPONSES.labels("dadata").inc()
+        # Следующая попытка — не раньше, чем через GEO_CACHE_NEGATIVE_TTL;
+        # срок хранения прежний: дольше GEO_CACHE_STALE_TTL город не отдаём
+        city_cache.extend(key, GEO_CACHE_NEGATIVE_TTL)
+        return stale
+    city_cache.set_negative(key, CITY_UNAVAILABLE)
+    return None
+
+
+def get_city_by_ip(ip: str):
+    """Город по IP или None, если определить его не удалось"""
+    # Сначала локальный индекс: микросекунды, без квоты DaData
+    index = geo_index.get_index(GEO_INDEX_PATH, logger)
+    if index is not None:
+        city = index.lookup(ip)
+        if city is not None:
+            GEO_INDEX_LOOKUPS.labels("hit").inc()
+            return city
+        GEO_INDEX_LOOKUPS.labels("miss").inc()
+
+    key = city_cache_key(ip)
+    found, city = cached_city(key)
+    if found:
+        return city
+    timeout = stage_timeout(DADATA_BREAKER, DADATA_LATENCY, "dadata")
+    city = None if timeout is None else fetch_city_from_dadata(ip, timeout)
+    return settle_city(key, city)
 
-def get_city_by_ip(ip: str) -> str:
+
+def fetch_city_from_dadata(ip: str, timeout: float = DADATA_TIMEOUT):
     try:
         data = json.dumps({"ip": ip}).encode("utf-8")
-        req = urllib.request.Request(
-            url=DADATA_API_URL,
-            data=data,
-            headers={
-                "Authorization": f"Token {DADATA_TOKEN}",
-                "Content-Type": "application/json",
-                "Accept": "application/json",
-            },
-            method="POST",
-        )
-        with urllib.request.urlopen(req, timeout=5) as response:
-            result = json.loads(response.read().decode("utf-8"))
-            location = result.get("location", {})
-            data = location.get("data", {})
-            city = data.get("city") or data.get("region") or "Неизвестно"
-            logger.info(
-                "DaData вернул город",
-                extra={"action": "dadata_success", "city": city, "ip": ip},
+        headers = {
+            "Authorization": f"Token {DADATA_TOKEN}",
+            "Content-Type": "application/json",
+            "Accept": "application/json",
+        }
+        with tracing.span("dadata"), DADATA_LATENCY.measure(timeout):
+            response = http_pool.request(
+                "POST", DADATA_API_URL, body=data, headers=headers, timeout=timeout
             )
-            return city
+        if response.status != 200:
+            raise ValueError(f"HTTP {response.status}: {response.reason}")
+        result = json.loads(response.text())
+        location = result.get("location", {})
+        data = location.get("data", {})
+        city = data.get("city") or data.get("region") or "Неизвестно"
     except Exception as e:
+        upstream_failed(DADATA_BREAKER, e)
         logger.error(
             "Ошибка DaData", extra={"action": "dadata_error", "ip": ip, "error": str(e)}
         )
-        return "Сервис временно недоступен"
+        return None
+    DADATA_BREAKER.record_success()
+    return city
+
+
+# Погода по городу: отдаётся, только если weather_service недоступен
+weather_last_good = cache.TTLCache("weather_last_good", 1000, WEATHER_STALE_TTL)
+
+
+def fallback_weather(city: str) -> dict:
+    weather = weather_last_good.get(city)
+    if weather is not None:
+        STALE_RESPONSES.labels("weather_service").inc()
+        return weather
+    return {"error": "Не удалось связаться с погодным сервисом"}
+
+
+if WEATHER_MODE == "inprocess":
+    # Логгер, кэш погоды и метрики weather_service — в этом процессе
+    import weather_service
+
+weather_pool = http_pool.HTTPPool(
+    WEATHER_SERVICE_HOST,
+    WEATHER_SERVICE_PORT,
+    timeout=WEATHER_TIMEOUT,
+    name="weather_service",
+    unix_socket=WEATHER_SERVICE_UNIX_SOCKET or None,
+)
 
 
 def send_city_to_weather_service(city: str, client_ip: str) -> dict:
@@ -199,178 +407,272 @@ def send_city_to_weather_service(city: str, client_ip: str) -> dict:
     Отправляет город в POST-запросе на weather_service
     Возвращает ответ в виде dict
     """
+    if WEATHER_MODE == "inprocess":
+        return weather_in_process(city, client_ip)
+    timeout = stage_timeout(WEATHER_BREAKER, WEATHER_LATENCY, "weather", reserve=0)
+    if timeout is None:
+        return fallback_weather(city)
     try:
         payload = json.dumps({"city": city}).encode("utf-8")
-        conn = HTTPConnection(WEATHER_SERVICE_HOST, WEATHER_SERVICE_PORT, timeout=5)
-        conn.request(
-            "POST",
-            WEATHER_SERVICE_PATH,
-            body=payload,
-            headers={
+        with tracing.span("weather") as span, WEATHER_LATENCY.measure(timeout):
+            headers = {
                 "Content-Type": "application/json",
                 "Content-Length": str(len(payload)),
                 "User-Agent": "geoservice",
-            },
-        )
-        response = conn.getresponse()
-        response_data = response.read().decode("utf-8")
-        conn.close()
-
-        if response.status != 200:
-            logger.error(
-                "weather-service вернул ошибку",
-                extra={
-                    "action": "weather_service_error",
-                    "status": response.status,
-                    "response": response_data,
-                    "city": city,
-                    "client_ip": client_ip,
-                },
+            }
+            # X-Request-ID и traceparent: weather_service продолжает трассу
+            headers.update(tracing.outgoing_headers(span))
+            # X-Deadline-Ms: weather_service не ждёт OpenWeather дольше нас
+            headers.update(deadline.outgoing_headers(timeout))
+            # Keep-alive: соединение остаётся в пуле для следующих запросов
+            response = weather_pool.request(
+                "POST",
+                WEATHER_SERVICE_PATH,
+                body=payload,
+                headers=headers,
+                timeout=timeout,
             )
-            return {"error": f"weather-service: HTTP {response.status}"}
+            response_data = response.text()
+    except Exception as e:
+        return weather_failed(city, client_ip, e)
+    return weather_result(city, client_ip, response.status, response_data)
+
+
+def weather_in_process(city: str, client_ip: str) -> dict:
+    """WEATHER_MODE=inprocess: погода от кода weather_service в этом процессе"""
+    with tracing.span("weather"):
+        status, response = weather_service.serve_in_process(city, client_ip)
+    if status == 200:
+        weather_last_good.set(city, response)
+        return response
+    # Причину уже записал weather_service; цепь без сети не размыкаем
+    weather = fallback_weather(city)
+    if "error" not in weather:
+        return weather
+    return {"error": f"weather-service: HTTP {status}"}
+
+
+def weather_result(city: str, client_ip: str, status: int, response_data: str) -> dict:
+    """Ответ weather_service -> dict; 5xx считается отказом upstream"""
+    if status == 200:
+        try:
+            weather = json.loads(response_data)
+        except ValueError as e:
+            return weather_failed(city, client_ip, e)
+        WEATHER_BREAKER.record_success()
+        weather_last_good.set(city, weather)
+        return weather
+
+    logger.error(
+        "weather-service вернул ошибку",
+        extra={
+            "action": "weather_service_error",
+            "status": status,
+            "response": response_data,
+            "city": city,
+            "client_ip": client_ip,
+        },
+    )
+    if status >= 500:
+        if status == 504:
+            # weather_service не успел в переданный ему бюджет
+            WEATHER_BREAKER.record_ignored()
+        else:
+            WEATHER_BREAKER.record_failure()
+        weather = fallback_weather(city)
+        if "error" not in weather:
+            return weather
+    else:
+        WEATHER_BREAKER.record_success()
+    return {"error": f"weather-service: HTTP {status}"}
+
+
+def weather_failed(city: str, client_ip: str, error: Exception) -> dict:
+    upstream_failed(WEATHER_BREAKER, error, reserve=0)
+    logger.error(
+        "Ошибка при отправке на weather-service",
+        exc_info=error,
+        extra={
+            "action": "weather_service_exception",
+            "city": city,
+            "client_ip": client_ip,
+            "error": str(error) or type(error).__name__,
+        },
+    )
+    return fallback_weather(city)
 
-        weather_result = json.loads(response_data)
-        logger.info(
-            "Погода получена от weather-service",
-            extra={
-                "action": "weather_service_success",
-                "city": city,
-                "weather": weather_result,
-                "client_ip": client_ip,
-            },
-        )
-        return weather_result
 
-    except Exception as e:
-        logger.exception(
-            "Ошибка при отправке на weather-service",
-            extra={
-                "action": "weather_service_exception",
-                "city": city,
-                "client_ip": client_ip,
-                "error": str(e),
-            },
-        )
-        return {"error": "Не удалось связаться с погодным сервисом"}
+# Общая для воркеров prefork: создаётся до fork
+rate_limiter = (
+    rate_limit.RateLimiter(
+        "get_city", GEO_RATE_LIMIT, GEO_RATE_BURST, GEO_RATE_LIMIT_SLOTS
+    )
+    if GEO_RATE_LIMIT > 0
+    else None
+)
+RATE_LIMITED_RESPONSE = "Ошибка: Слишком много запросов, повторите позже"
 
 
-class CityHandler(http.server.BaseHTTPRequestHandler):
+def check_rate_limit(client_ip: str):
+    """None — запрос разрешён, иначе значение Retry-After"""
+    if rate_limiter is None:
+        return None
+    allowed, retry_after = rate_limiter.hit(rate_limit.client_key(client_ip))
+    if allowed:
+        return None
+    return rate_limit.RateLimiter.retry_after_header(retry_after)
+
+
+def is_trusted_proxy(peer_ip: str) -> bool:
+    try:
+        address = ipaddress.ip_address(peer_ip)
+    except ValueError:
+        return False
+    return any(address in network for network in GEO_TRUSTED_PROXIES)
+
+
+def rate_limit_ip(headers, peer_ip: str) -> str:
+    """Клиент для ограничения частоты: заголовки — только от доверенного прокси.
+
+    Иначе любой клиент, подставляя случайный X-Forwarded-For, обходил бы
+    лимит и вытеснял из таблицы ведра настоящих клиентов.
+    """
+    if is_trusted_proxy(peer_ip):
+        return client_ip_from_headers(headers, peer_ip)
+    return peer_ip
+
+
+def client_ip_from_headers(headers, peer_ip: str) -> str:
+    """IP клиента из заголовков nginx, иначе адрес соединения"""
+    x_real_ip = headers.get("X-Real-IP")
+    x_forwarded_for = headers.get("X-Forwarded-For")
+    if x_real_ip:
+        return x_real_ip.strip()
+    if x_forwarded_for:
+        return x_forwarded_for.split(",")[0].strip()
+    return peer_ip
+
+
+def format_weather(city: str, weather_response: dict) -> str:
+    """Тело ответа /api/get_city: "город описание температура" или ошибка"""
+    if "error" in weather_response:
+        return f"Ошибка: {weather_response['error']}"
+    weather_data = weather_response.get("weather", {})
+    description = weather_data.get("description", "неизвестно")
+    temp = weather_data.get("temp", "неизвестно")
+    if isinstance(temp, (int, float)):
+        temp = round(temp, 1)
+    return f"{city} {description} {temp}"
+
+
+# --- Быстрый путь: OPTIONS, /healthz, /readyz ---
+fast_path = FastPath(
+    "GET, OPTIONS",
+    options_status=200,
+    ready_check=lambda: bool(DADATA_TOKEN),
+    logger=logger,
+)
+# GET /metrics: запросы, задержка, этапы ipify/dadata/weather
+metrics.install(fast_path)
+# GET /debug/profile и /debug/memory: только при заданном PROFILE_TOKEN
+profiling.install(fast_path)
+memory.install(fast_path)
+
+
+class CityHandler(
+    profiling.ProfiledHandler,
+    metrics.InstrumentedHandler,
+    http.server.BaseHTTPRequestHandler,
+):
     def do_GET(self):
-        client_ip = self.client_address[0]
-        request_id = str(uuid.uuid4())  # Генерируем уникальный ID для трассировки
+        if fast_path.handle(self):
+            return
 
-        logger.info(
-            "Получен GET-запрос",
-            extra={
-                "client_ip": client_ip,
-                "action": "get_request",
-                "request_id": request_id,
-            },
-        )
+        # Контекст трассы: из заголовков nginx/клиента или новый
+        trace = tracing.start(self.headers)
+        # Бюджет запроса: все этапы ниже укладываются в GEO_REQUEST_DEADLINE
+        budget = deadline.start(self.headers, GEO_REQUEST_DEADLINE)
+        client_ip = self.client_address[0]
 
         if self.path != "/api/get_city":
             self.send_response(404)
             self.send_header("Content-Type", "application/json")
+            self.send_header(tracing.REQUEST_ID_HEADER, trace.request_id)
             self.end_headers()
             self.wfile.write(b'{"error": "Not Found"}')
-            logger.warning(
+            tracing.finish(
+                logger,
                 "Неверный путь",
-                extra={
-                    "client_ip": client_ip,
-                    "action": "path_not_found",
-                    "status": 404,
-                    "path": self.path,
-                    "request_id": request_id,
-                },
+                level=logging.WARNING,
+                client_ip=client_ip,
+                action="path_not_found",
+                status=404,
+                path=self.path,
             )
             return
 
-        x_real_ip = self.headers.get("X-Real-IP")
-        x_forwarded_for = self.headers.get("X-Forwarded-For")
-
-        if x_real_ip:
-            client_ip = x_real_ip.strip()
-        elif x_forwarded_for:
-            client_ip = x_forwarded_for.split(",")[0].strip()
-
-        logger.info(
-            "IP получен из заголовков",
-            extra={
-                "client_ip": client_ip,
-                "action": "ip_initial",
-                "request_id": request_id,
-            },
-        )
+        # До DaData и OpenWeather: лишний запрос клиента не тратит их квоту
+        retry_after = check_rate_limit(rate_limit_ip(self.headers, client_ip))
+        client_ip = client_ip_from_headers(self.headers, client_ip)
+        if retry_after is not None:
+            self._send_rate_limited(trace, client_ip, retry_after)
+            return
 
+        original_ip = client_ip
         if is_local_ip(client_ip):
-            logger.info(
-                "Локальный IP, запрашиваем публичный",
-                extra={
-                    "client_ip": client_ip,
-                    "action": "ip_local",
-                    "request_id": request_id,
-                },
-            )
             client_ip = get_public_ip()
-            logger.info(
-                "IP заменён на публичный",
-                extra={
-                    "client_ip": client_ip,
-                    "action": "ip_replaced",
-                    "request_id": request_id,
-                },
-            )
 
         city = get_city_by_ip(client_ip)
-        logger.info(
-            "Город определён",
-            extra={
-                "client_ip": client_ip,
-                "action": "city_determined",
-                "city": city,
-                "request_id": request_id,
-            },
-        )
-
-        weather_response = send_city_to_weather_service(city, client_ip)
+        if city is None:
+            # Без города weather_service не спрашиваем
+            weather_response = {"error": CITY_ERROR}
+        else:
+            weather_response = send_city_to_weather_service(city, client_ip)
 
         self.send_response(200)
         self.send_header("Content-Type", "text/plain; charset=utf-8")
         self.send_header("Access-Control-Allow-Origin", "*")
         self.send_header("Access-Control-Allow-Methods", "GET, OPTIONS")
         self.send_header("Access-Control-Allow-Headers", "Content-Type")
+        self.send_header(tracing.REQUEST_ID_HEADER, trace.request_id)
+        tracing.send_server_timing(self)
         self.end_headers()
 
-        if "error" in weather_response:
-            response_body = f"Ошибка: {weather_response['error']}"
-        else:
-            weather_data = weather_response.get("weather", {})
-            description = weather_data.get("description", "неизвестно")
-            temp = weather_data.get("temp", "неизвестно")
-            if isinstance(temp, (int, float)):
-                temp = round(temp, 1)
-            response_body = f"{city} {description} {temp}"
-
+        response_body = format_weather(city, weather_response)
         self.wfile.write(response_body.encode("utf-8"))
-        logger.info(
-            "Отправлен ответ браузеру",
-            extra={
-                "client_ip": client_ip,
-                "action": "response_sent",
-                "status": 200,
-                "response": response_body,
-                "request_id": request_id,
-            },
+        # Одна сводная запись на запрос: этапы ipify/dadata/weather в timings_ms
+        tracing.finish(
+            logger,
+            "Запрос обработан",
+            client_ip=client_ip,
+            original_ip=original_ip,
+            action="request_summary",
+            city=city or "unknown",
+            status=200,
+            response=response_body,
+            budget_left_ms=round(budget.remaining() * 1000),
         )
 
-    def do_OPTIONS(self):
-        self.send_response(200)
+    def _send_rate_limited(self, trace, client_ip, retry_after):
+        self.send_response(429)
+        self.send_header("Content-Type", "text/plain; charset=utf-8")
+        self.send_header("Retry-After", retry_after)
         self.send_header("Access-Control-Allow-Origin", "*")
-        self.send_header("Access-Control-Allow-Methods", "GET, OPTIONS")
-        self.send_header("Access-Control-Allow-Headers", "Content-Type")
-        self.send_header("Access-Control-Max-Age", "86400")
+        self.send_header(tracing.REQUEST_ID_HEADER, trace.request_id)
         self.end_headers()
-        logger.info("CORS preflight ответ", extra={"action": "cors_preflight"})
+        self.wfile.write(RATE_LIMITED_RESPONSE.encode("utf-8"))
+        tracing.finish(
+            logger,
+            "Превышена частота запросов",
+            level=logging.WARNING,
+            client_ip=client_ip,
+            action="rate_limited",
+            status=429,
+            retry_after=retry_after,
+        )
+
+    def do_OPTIONS(self):
+        fast_path.handle(self)
 
     def do_POST(self):
         self.send_response(405)
@@ -383,6 +685,8 @@ class CityHandler(http.server.BaseHTTPRequestHandler):
 # Запуск сервера
 if __name__ == "__main__":
     PORT = int(os.getenv("GEOSERVICE_PORT", "7999"))
+    # Путь Unix domain socket вместо порта (nginx на той же машине)
+    UNIX_SOCKET = os.getenv("GEOSERVICE_UNIX_SOCKET", "")
 
     # Логирование настроек при старте
     logger.info(
@@ -390,25 +694,52 @@ if __name__ == "__main__":
         extra={
             "action": "server_start",
             "port": PORT,
+            "unix_socket": UNIX_SOCKET,
             "log_dir": LOG_DIR,
             "log_file": LOG_FILE,
             "log_level": logging.getLevelName(LOG_LEVEL),
             "dadata_url": DADATA_API_URL,
             "weather_host": WEATHER_SERVICE_HOST,
             "weather_port": WEATHER_SERVICE_PORT,
+            "weather_unix_socket": WEATHER_SERVICE_UNIX_SOCKET,
             "weather_path": WEATHER_SERVICE_PATH,
+            "weather_mode": WEATHER_MODE,
+            "request_deadline": GEO_REQUEST_DEADLINE,
+            "rate_limit": GEO_RATE_LIMIT,
+            "rate_burst": GEO_RATE_BURST,
+            "trusted_proxies": [str(network) for network in GEO_TRUSTED_PROXIES],
         },
     )
 
-    server_address = ("", PORT)
-    httpd = socketserver.TCPServer(server_address, CityHandler)
-    print(f"🌐 geoservice запущен на порту {PORT}")
-    logger.info(
-        "Сервер geoservice запущен", extra={"action": "server_started", "port": PORT}
-    )
-
-    try:
-        httpd.serve_forever()
-    except KeyboardInterrupt:
+    server_address = UNIX_SOCKET or ("", PORT)
+    server_class = unix_socket.server_class(socketserver.TCPServer, UNIX_SOCKET)
+    listen_on = UNIX_SOCKET or f"порту {PORT}"
+    workers = prefork.worker_count()
+    if workers > 1:
+        print(f"🌐 geoservice запущен на {listen_on}, воркеров: {workers}")
+        logger.info(
+            "Сервер geoservice запущен",
+            extra={"action": "server_started", "port": PORT, "workers": workers},
+        )
+        prefork.serve(
+            functools.partial(server_class, RequestHandlerClass=CityHandler),
+            server_address,
+            workers,
+            logger=logger,
+        )
         logger.info("Сервер geoservice остановлен", extra={"action": "server_stopped"})
-        httpd.server_close()
+    else:
+        httpd = server_class(server_address, CityHandler)
+        print(f"🌐 geoservice запущен на {listen_on}")
+        logger.info(
+            "Сервер geoservice запущен",
+            extra={"action": "server_started", "port": PORT},
+        )
+
+        try:
+            httpd.serve_forever()
+        except KeyboardInterrupt:
+            logger.info(
+                "Сервер geoservice остановлен", extra={"action": "server_stopped"}
+            )
+            httpd.server_close()
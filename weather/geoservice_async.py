@@ -0,0 +1,435 @@
+"""geoservice на asyncio (aiohttp): тот же контракт /api/get_city.
+
+Цепочка ipify -> DaData -> weather_service выполняется без блокировок:
+медленный ответ DaData задерживает только свой запрос, а не всех посетителей.
+Конфигурация, логгер, кэш города, офлайн-индекс и служебные эндпоинты
+(/healthz, /readyz, /metrics, /debug/*) — общие с geoservice.py.
+
+    python geoservice_async.py
+"""
+
+import asyncio
+import json
+import logging
+import os
+import time
+
+from aiohttp import ClientSession, ClientTimeout, TCPConnector, UnixConnector, web
+
+from common import deadline, http_pool, metrics, tracing, unix_socket
+
+import geoservice
+from geoservice import (
+    DADATA_API_URL,
+    DADATA_TIMEOUT,
+    DADATA_TOKEN,
+    GEO_REQUEST_DEADLINE,
+    IPIFY_TIMEOUT,
+    IPIFY_URL,
+    WEATHER_TIMEOUT,
+    WEATHER_SERVICE_HOST,
+    WEATHER_SERVICE_PATH,
+    WEATHER_SERVICE_PORT,
+    WEATHER_SERVICE_UNIX_SOCKET,
+    logger,
+    stage_timeout,
+    upstream_failed,
+)
+
+PORT = int(os.getenv("GEOSERVICE_PORT", "7999"))
+UNIX_SOCKET = os.getenv("GEOSERVICE_UNIX_SOCKET", "")
+
+# Одновременных исходящих соединений на всё приложение
+GEO_ASYNC_CONNECTIONS = int(os.getenv("GEO_ASYNC_CONNECTIONS", "200"))
+
+WEATHER_URL = (
+    f"http://{WEATHER_SERVICE_HOST}:{WEATHER_SERVICE_PORT}{WEATHER_SERVICE_PATH}"
+)
+
+CORS_HEADERS = {
+    "Access-Control-Allow-Origin": "*",
+    "Access-Control-Allow-Methods": "GET, OPTIONS",
+    "Access-Control-Allow-Headers": "Content-Type",
+}
+
+SESSION_KEY = web.AppKey("session", ClientSession)
+# Сессия к weather_service: через UDS, если задан WEATHER_SERVICE_UNIX_SOCKET,
+# иначе та же, что для остальных upstream
+WEATHER_SESSION_KEY = web.AppKey("weather_session", ClientSession)
+
+# Запросы к DaData в полёте: одновременные промахи по одной подсети ждут
+# один ответ, а не отправляют каждый свой
+_city_lookups = {}
+
+
+async def get_public_ip(session: ClientSession) -> str:
+    timeout = stage_timeout(
+        geoservice.IPIFY_BREAKER, geoservice.IPIFY_LATENCY, "ipify"
+    )
+    if timeout is None:
+        return geoservice.fallback_public_ip()
+    try:
+        with tracing.span("ipify"), geoservice.IPIFY_LATENCY.measure(timeout):
+            async with session.get(
+                IPIFY_URL, timeout=ClientTimeout(total=timeout)
+            ) as response:
+                if response.status != 200:
+                    raise ValueError(f"HTTP {response.status}")
+                ip = (await response.text()).strip()
+    except Exception as e:
+        upstream_failed(geoservice.IPIFY_BREAKER, e)
+        logger.warning(
+            "Не удалось получить публичный IP",
+            extra={"action": "get_public_ip", "error": str(e) or type(e).__name__},
+        )
+        return geoservice.fallback_public_ip()
+    geoservice.IPIFY_BREAKER.record_success()
+    return geoservice.remember_public_ip(ip)
+
+
+async def fetch_city_from_dadata(
+    session: ClientSession, ip: str, timeout: float = DADATA_TIMEOUT
+):
+    try:
+        with tracing.span("dadata"), geoservice.DADATA_LATENCY.measure(timeout):
+            async with session.post(
+                DADATA_API_URL,
+                json={"ip": ip},
+                headers={
+                    "Authorization": f"Token {DADATA_TOKEN}",
+                    "Accept": "application/json",
+                },
+                timeout=ClientTimeout(total=timeout),
+            ) as response:
+                if response.status != 200:
+                    raise ValueError(f"HTTP {response.status}: {response.reason}")
+                result = json.loads(await response.text())
+        location = result.get("location", {})
+        data = location.get("data", {})
+        city = data.get("city") or data.get("region") or "Неизвестно"
+    except Exception as e:
+        upstream_failed(geoservice.DADATA_BREAKER, e)
+        logger.error(
+            "Ошибка DaData",
+            extra={
+                "action": "dadata_error",
+                "ip": ip,
+                "error": str(e) or type(e).__name__,
+            },
+        )
+        return None
+    geoservice.DADATA_BREAKER.record_success()
+    return city
+
+
+async def _lookup_city(session, ip, key):
+    # Бюджет — того запроса, который начал поиск (контекст копируется в задачу)
+    timeout = stage_timeout(
+        geoservice.DADATA_BREAKER, geoservice.DADATA_LATENCY, "dadata"
+    )
+    city = None
+    if timeout is not None:
+        city = await fetch_city_from_dadata(session, ip, timeout)
+    return geoservice.settle_city(key, city)
+
+
+async def get_city_by_ip(session: ClientSession, ip: str):
+    """Город по IP или None, если определить его не удалось"""
+    index = geoservice.geo_index.get_index(geoservice.GEO_INDEX_PATH, logger)
+    if index is not None:
+        city = index.lookup(ip)
+        if city is not None:
+            geoservice.GEO_INDEX_LOOKUPS.labels("hit").inc()
+            return city
+        geoservice.GEO_INDEX_LOOKUPS.labels("miss").inc()
+
+    key = geoservice.city_cache_key(ip)
+    found, city = geoservice.cached_city(key)
+    if found:
+        return city
+    task = _city_lookups.get(key)
+    if task is None:
+        task = asyncio.ensure_future(_lookup_city(session, ip, key))
+        _city_lookups[key] = task
+        task.add_done_callback(lambda _: _city_lookups.pop(key, None))
+    # shield: отменённый клиентом или по бюджету запрос не отменяет общий поиск
+    budget = deadline.current()
+    try:
+        return await asyncio.wait_for(asyncio.shield(task), budget.remaining())
+    except TimeoutError:
+        deadline.DEADLINE_EXCEEDED.labels("dadata").inc()
+        return None
+
+
+async def send_city_to_weather_service(
+    session: ClientSession, city: str, client_ip: str
+) -> dict:
+    if geoservice.WEATHER_MODE == "inprocess":
+        # OpenWeather вызывается блокирующе — в потоке; трасса и бюджет
+        # запроса копируются в него вместе с контекстом
+        return await asyncio.to_thread(geoservice.weather_in_process, city, client_ip)
+    timeout = stage_timeout(
+        geoservice.WEATHER_BREAKER, geoservice.WEATHER_LATENCY, "weather", reserve=0
+    )
+    if timeout is None:
+        return geoservice.fallback_weather(city)
+    try:
+        with tracing.span("weather") as span, geoservice.WEATHER_LATENCY.measure(
+            timeout
+        ):
+            headers = {"User-Agent": "geoservice"}
+            headers.update(tracing.outgoing_headers(span))
+            headers.update(deadline.outgoing_headers(timeout))
+            async with session.post(
+                WEATHER_URL,
+                json={"city": city},
+                headers=headers,
+                timeout=ClientTimeout(total=timeout),
+            ) as response:
+                status = response.status
+                response_data = await response.text()
+    except Exception as e:
+        return geoservice.weather_failed(city, client_ip, e)
+    return geoservice.weather_result(city, client_ip, status, response_data)
+
+
+async def get_city(request: web.Request) -> web.Response:
+    trace = tracing.start(request.headers)
+    budget = deadline.start(request.headers, GEO_REQUEST_DEADLINE)
+    session = request.app[SESSION_KEY]
+
+    # У соединения по UDS нет адреса: как и в geoservice, это локальный прокси
+    peer_ip = request.remote or unix_socket.CLIENT_ADDRESS[0]
+    retry_after = geoservice.check_rate_limit(
+        geoservice.rate_limit_ip(request.headers, peer_ip)
+    )
+    client_ip = geoservice.client_ip_from_headers(request.headers, peer_ip)
+    if retry_after is not None:
+        tracing.finish(
+            logger,
+            "Превышена частота запросов",
+            level=logging.WARNING,
+            client_ip=client_ip,
+            action="rate_limited",
+            status=429,
+            retry_after=retry_after,
+        )
+        return web.Response(
+            status=429,
+            text=geoservice.RATE_LIMITED_RESPONSE,
+            content_type="text/plain",
+            charset="utf-8",
+            headers={
+                "Retry-After": retry_after,
+                "Access-Control-Allow-Origin": "*",
+                tracing.REQUEST_ID_HEADER: trace.request_id,
+            },
+        )
+
+    original_ip = client_ip
+    if geoservice.is_local_ip(client_ip):
+        client_ip = await get_public_ip(session)
+
+    city = await get_city_by_ip(session, client_ip)
+    if city is None:
+        weather_response = {"error": geoservice.CITY_ERROR}
+    else:
+        weather_response = await send_city_to_weather_service(
+            request.app[WEATHER_SESSION_KEY], city, client_ip
+        )
+    response_body = geoservice.format_weather(city, weather_response)
+
+    headers = dict(CORS_HEADERS)
+    headers[tracing.REQUEST_ID_HEADER] = trace.request_id
+    if tracing.server_timing_requested(request.headers):
+        headers["Server-Timing"] = trace.server_timing()
+        headers["Timing-Allow-Origin"] = "*"
+    tracing.finish(
+        logger,
+        "Запрос обработан",
+        client_ip=client_ip,
+        original_ip=original_ip,
+        action="request_summary",
+        city=city or "unknown",
+        status=200,
+        response=response_body,
+        budget_left_ms=round(budget.remaining() * 1000),
+    )
+    return web.Response(
+        text=response_body, content_type="text/plain", charset="utf-8", headers=headers
+    )
+
+
+# --- Служебные эндпоинты geoservice.fast_path ---
+
+
+class _FastPathRequest:
+    """То, что маршруты FastPath читают у BaseHTTPRequestHandler"""
+
+    command = "GET"
+    protocol_version = "HTTP/1.1"
+
+    def __init__(self, request):
+        self.headers = request.headers
+        self.path = request.path_qs
+
+
+def _raw_to_response(data):
+    """Готовый ответ build_response (bytes) -> web.Response"""
+    head, body = data.split(b"\r\n\r\n", 1)
+    lines = head.decode("latin-1").split("\r\n")
+    status = int(lines[0].split(" ", 2)[1])
+    headers = {}
+    for line in lines[1:]:
+        name, value = line.split(": ", 1)
+        if name.lower() != "content-length":
+            headers[name] = value
+    return web.Response(status=status, body=body, headers=headers)
+
+
+def fast_path_response(request):
+    """Ответ служебного маршрута или None, если путь не служебный"""
+    fast_path = geoservice.fast_path
+    if request.method == "OPTIONS":
+        return _raw_to_response(fast_path.options_response["HTTP/1.1"])
+    route = fast_path.routes.get(request.path)
+    if route is None:
+        return None
+    result = route(_FastPathRequest(request))
+    if isinstance(result, dict):
+        return _raw_to_response(result["HTTP/1.1"])
+    status, content_type, body = result
+    if isinstance(body, str):
+        body = body.encode("utf-8")
+    return web.Response(
+        status=status,
+        body=body,
+        headers={"Content-Type": content_type, "Access-Control-Allow-Origin": "*"},
+    )
+
+
+async def dispatch(request: web.Request) -> web.Response:
+    """Разбор как у CityHandler: служебные пути, /api/get_city, 404, 405"""
+    response = fast_path_response(request)
+    if response is not None:
+        request["fast_path"] = True
+        return response
+
+    if request.method == "GET":
+        if request.path_qs == "/api/get_city":
+            return await get_city(request)
+        trace = tracing.start(request.headers)
+        tracing.finish(
+            logger,
+            "Неверный путь",
+            level=logging.WARNING,
+            client_ip=request.remote,
+            action="path_not_found",
+            status=404,
+            path=request.path_qs,
+        )
+        return web.Response(
+            status=404,
+            body=b'{"error": "Not Found"}',
+            content_type="application/json",
+            headers={tracing.REQUEST_ID_HEADER: trace.request_id},
+        )
+
+    if request.method == "POST":
+        logger.warning("Попытка POST на geo-service", extra={"action": "post_blocked"})
+        return web.Response(
+            status=405,
+            body=b'{"error": "Method Not Allowed"}',
+            content_type="application/json",
+        )
+
+    return web.Response(status=501, text="Unsupported method")
+
+
+@web.middleware
+async def metrics_middleware(request, handler):
+    """То же, что metrics.InstrumentedHandler для синхронных сервисов"""
+    start = time.perf_counter()
+    metrics.HTTP_IN_FLIGHT.inc()
+    status = 500
+    try:
+        response = await handler(request)
+        status = response.status
+        return response
+    except web.HTTPException as e:
+        status = e.status
+        raise
+    finally:
+        metrics.HTTP_IN_FLIGHT.dec()
+        method = metrics.method_label(request.method)
+        metrics.HTTP_REQUESTS.labels(method, status).inc()
+        if not request.get("fast_path"):
+            metrics.HTTP_LATENCY.labels(method).observe(
+                time.perf_counter() - start
+            )
+
+
+async def _open_session(app):
+    # Одна сессия на процесс: пул keep-alive соединений ко всем upstream
+    connector = TCPConnector(
+        limit=GEO_ASYNC_CONNECTIONS,
+        keepalive_timeout=http_pool.HTTP_POOL_IDLE_TIMEOUT,
+        ttl_dns_cache=300,
+    )
+    app[SESSION_KEY] = ClientSession(connector=connector)
+    if WEATHER_SERVICE_UNIX_SOCKET:
+        app[WEATHER_SESSION_KEY] = ClientSession(
+            connector=UnixConnector(
+                path=WEATHER_SERVICE_UNIX_SOCKET,
+                keepalive_timeout=http_pool.HTTP_POOL_IDLE_TIMEOUT,
+            )
+        )
+    else:
+        app[WEATHER_SESSION_KEY] = app[SESSION_KEY]
+
+
+async def _close_session(app):
+    if app[WEATHER_SESSION_KEY] is not app[SESSION_KEY]:
+        await app[WEATHER_SESSION_KEY].close()
+    await app[SESSION_KEY].close()
+
+
+def make_app() -> web.Application:
+    app = web.Application(middlewares=[metrics_middleware])
+    app.router.add_route("*", "/{tail:.*}", dispatch)
+    app.on_startup.append(_open_session)
+    app.on_cleanup.append(_close_session)
+    return app
+
+
+if __name__ == "__main__":
+    logger.info(
+        "Сервер geoservice (asyncio) запускается с настройками",
+        extra={
+            "action": "server_start",
+            "port": PORT,
+            "unix_socket": UNIX_SOCKET,
+            "mode": "asyncio",
+            "dadata_url": DADATA_API_URL,
+            "weather_url": WEATHER_URL,
+            "weather_unix_socket": WEATHER_SERVICE_UNIX_SOCKET,
+            "weather_mode": geoservice.WEATHER_MODE,
+            "request_deadline": GEO_REQUEST_DEADLINE,
+            "timeouts": {
+                "ipify": IPIFY_TIMEOUT,
+                "dadata": DADATA_TIMEOUT,
+                "weather": WEATHER_TIMEOUT,
+            },
+        },
+    )
+    if UNIX_SOCKET:
+        sock, inode = unix_socket.listen(UNIX_SOCKET)
+        print(f"🌐 geoservice (asyncio) запущен на {UNIX_SOCKET}")
+        try:
+            web.run_app(make_app(), sock=sock, access_log=None, print=None)
+        finally:
+            unix_socket.remove(UNIX_SOCKET, inode)
+    else:
+        print(f"🌐 geoservice (asyncio) запущен на порту {PORT}")
+        web.run_app(make_app(), port=PORT, access_log=None, print=None)
+    logger.info("Сервер geoservice остановлен", extra={"action": "server_stopped"})
@@ -1,3 +1,4 @@
+import functools
 import http.server
 import socketserver
 import json
@@ -9,6 +10,24 @@ import urllib.request
 from urllib.parse import urlparse, parse_qs
 import uuid
 
+from common import (
+    adaptive_timeout,
+    cache,
+    deadline,
+    fluent_forward,
+    log_pipeline,
+    log_sampling,
+    memory,
+    metrics,
+    prefork,
+    profiling,
+    tracing,
+    unix_socket,
+)
+from common.log_format import JSONFormatter
+from common.log_rotation import RotatingBatchFileHandler
+from common.fastpath import FastPath
+
 # --- Конфигурация из переменных окружения ---
 LOG_DIR = os.getenv("WEATHER_SERVICE_LOG_DIR", "/var/log/weather_service")
 LOG_FILE = os.getenv("WEATHER_SERVICE_LOG_FILE", os.path.join(LOG_DIR, "app.log"))
@@ -19,7 +38,21 @@ OPENWEATHER_URL = os.getenv(
     "OPENWEATHER_URL", "https://api.openweathermap.org/data/2.5/weather"
 )
 
+# Потолок ожидания OpenWeather: сам таймаут — по p99 задержки
+# (common/adaptive_timeout.py); geoservice может сократить его заголовком
+# X-Deadline-Ms — остатком бюджета своего запроса
+OPENWEATHER_TIMEOUT = float(os.getenv("OPENWEATHER_TIMEOUT", "5"))
+
+# Кэш погоды по городу: OpenWeather обновляет данные раз в ~10 минут
+WEATHER_CACHE_SIZE = int(os.getenv("WEATHER_CACHE_SIZE", "1000"))
+WEATHER_CACHE_TTL = float(os.getenv("WEATHER_CACHE_TTL", "600"))
+
 PORT = int(os.getenv("WEATHER_SERVICE_PORT", "8002"))
+# Путь Unix domain socket вместо порта; тот же путь задаётся geoservice
+UNIX_SOCKET = os.getenv("WEATHER_SERVICE_UNIX_SOCKET", "")
+# Сколько секунд держать простаивающее keep-alive соединение geoservice;
+# больше HTTP_POOL_IDLE_TIMEOUT пула, чтобы закрывал клиент, а не сервер
+KEEPALIVE_TIMEOUT = float(os.getenv("WEATHER_SERVICE_KEEPALIVE_TIMEOUT", "60"))
 
 
 def validate_environment():
@@ -60,64 +93,30 @@ if any("Ошибка" in e or "нет прав" in e for e in env_errors):
     exit(1)
 
 
-# --- JSON-форматтер для логов ---
-class JSONFormatter(logging.Formatter):
-    def format(self, record):
-        log_entry = {
-            "timestamp": logging.Formatter.converter(record.created),
-            "timestamp_iso": time.strftime(
-                "%Y-%m-%dT%H:%M:%SZ", logging.Formatter.converter(record.created)
-            ),
-            "level": record.levelname,
-            "logger": record.name,
-            "message": record.getMessage(),
-            "module": record.module,
-            "function": record.funcName,
-            "line": record.lineno,
-            "request_id": getattr(record, "request_id", str(uuid.uuid4())),
-        }
-
-        # Добавляем все поля из extra, кроме стандартных
-        for key, value in record.__dict__.items():
-            if key not in (
-                "asctime",
-                "created",
-                "filename",
-                "funcName",
-                "levelname",
-                "levelno",
-                "lineno",
-                "module",
-                "msecs",
-                "msg",
-                "name",
-                "pathname",
-                "process",
-                "processName",
-                "relativeCreated",
-                "thread",
-                "threadName",
-                "request_id",
-            ):
-                if key not in log_entry:
-                    log_entry[key] = value
-
-        return json.dumps(log_entry, ensure_ascii=False, default=str)
-
-
 # --- Настройка логгера ---
 logger = logging.getLogger("weather_service")
 logger.setLevel(LOG_LEVEL)
 logger.handlers.clear()  # Убираем дубликаты
 
 # Создаём файловый хендлер
-file_handler = logging.FileHandler(LOG_FILE, encoding="utf-8")
+file_handler = RotatingBatchFileHandler(LOG_FILE, encoding="utf-8")
 file_handler.setLevel(LOG_LEVEL)
-file_handler.setFormatter(JSONFormatter())
+file_handler.setFormatter(
+    JSONFormatter(
+        static_fields={"service": "weather_service"},
+        timestamp_fields=("timestamp", "timestamp_iso"),
+    )
+)
 
 logger.addHandler(file_handler)
 logger.propagate = False  # Предотвращает дублирование в root-логгер
 
+# LOG_FORWARD — отправка в fluent-bit по Forward-протоколу вместо файла
+fluent_forward.install(logger, tag="weather_service")
+
+# Запись в файл — в фоновом потоке, пачками (LOG_ASYNC=0 — синхронно)
+log_pipeline.install(logger)
+
 
 # --- Фильтр для автодобавления полей ---
 class WeatherContextFilter(logging.Filter):
@@ -136,11 +135,21 @@ class WeatherContextFilter(logging.Filter):
             record.api_response = "none"
         if not hasattr(record, "duration_ms"):
             record.duration_ms = 0
+        if not hasattr(record, "request_id"):
+            record.request_id = str(uuid.uuid4())
         return True
 
 
+# request_id/trace_id из трассы geoservice — раньше значений по умолчанию
+logger.addFilter(tracing.TraceContextFilter())
 logger.addFilter(WeatherContextFilter())
 
+# --- Сэмплирование: правила задаются через LOG_SAMPLE_RATES ---
+log_sampling.install(logger, {}, event_fields=("api_response",))
+
+
+OPENWEATHER_LATENCY = adaptive_timeout.tracker("openweather", OPENWEATHER_TIMEOUT)
+
 
 def is_valid_city_name(city: str) -> bool:
     if not city or len(city) > 100:
@@ -150,7 +159,7 @@ def is_valid_city_name(city: str) -> bool:
     )  # ✅ ИСПРАВЛЕНО: лишняя запятая в регулярке
 
 
-def fetch_weather(city_name: str) -> dict:
+def fetch_weather(city_name: str, timeout: float = OPENWEATHER_TIMEOUT) -> dict:
     if not is_valid_city_name(city_name):
         logger.warning(
             "Недопустимое название города",
@@ -169,28 +178,14 @@ def fetch_weather(city_name: str) -> dict:
 
     try:
         url = OPENWEATHER_URL + "?" + urllib.parse.urlencode(params)
-        with urllib.request.urlopen(url, timeout=5) as response:
+        with tracing.span("openweather"), OPENWEATHER_LATENCY.measure(
+            timeout
+        ), urllib.request.urlopen(url, timeout=timeout) as response:
             data = json.loads(response.read().decode("utf-8"))
-            duration_ms = int((time.time() - start_time) * 1000)
-
-            weather_desc = data["weather"][0]["description"]
-            temp = data["main"]["temp"]
-
-            result = {"description": weather_desc, "temp": round(temp, 1)}
-
-            logger.info(
-                f"Успешно получена погода: {weather_desc}, {temp}°C",
-                extra={
-                    "requested_city": city_name,
-                    "response_status": 200,
-                    "response_data": json.dumps(
-                        {"weather": result}, ensure_ascii=False
-                    ),
-                    "api_response": "success",
-                    "duration_ms": duration_ms,
-                },
-            )
-            return result
+
+        weather_desc = data["weather"][0]["description"]
+        temp = data["main"]["temp"]
+        return {"description": weather_desc, "temp": round(temp, 1)}
 
     except urllib.error.HTTPError as e:
         duration_ms = int((time.time() - start_time) * 1000)
@@ -245,28 +240,102 @@ def fetch_weather(city_name: str) -> dict:
     return None
 
 
-class WeatherHandler(http.server.BaseHTTPRequestHandler):
-    def do_POST(self):
-        client_ip = self.client_address[0]
-        request_target = self.path
-        start_time = time.time()
+weather_cache = cache.TTLCache("weather_cache", WEATHER_CACHE_SIZE, WEATHER_CACHE_TTL)
+memory.register_cache("weather_cache", lambda: len(weather_cache))
 
-        # Генерируем request_id для трассировки
-        request_id = str(uuid.uuid4())
+# api_response -> (сообщение сводной записи, уровень)
+RESULT_LOG = {
+    "success": ("Отправлен ответ с погодой", logging.INFO),
+    "deadline_exceeded": ("Истёк срок запроса", logging.WARNING),
+    "failed": ("Не удалось получить погоду", logging.ERROR),
+}
 
-        logger.info(
-            "Получен POST-запрос",
-            extra={
-                "client_ip": client_ip,
-                "request_target": request_target,
-                "requested_city": "pending",
-                "response_status": 0,
-                "response_data": "processing",
-                "api_response": "pending",
-                "duration_ms": 0,
-                "request_id": request_id,  # ✅ Добавляем request_id в extra
-            },
+
+def weather_for_city(city: str, budget) -> tuple:
+    """(HTTP-статус, тело ответа, api_response) для города в пределах budget"""
+    key = city.casefold()
+    with tracing.span("cache"):
+        weather_data = weather_cache.get(key)
+    if weather_data is not None:
+        return 200, {"weather": weather_data}, "success"
+
+    try:
+        # Запас DEADLINE_MIN_STAGE — на то, чтобы ответ успел дойти
+        timeout = budget.timeout(
+            OPENWEATHER_LATENCY.timeout(),
+            deadline.DEADLINE_MIN_STAGE,
+            "openweather",
         )
+    except deadline.DeadlineExceeded:
+        # geoservice уже не ждёт ответа — OpenWeather не спрашиваем
+        return 504, {"error": "Истёк срок запроса"}, "deadline_exceeded"
+
+    weather_data = fetch_weather(city, timeout)
+    if weather_data:
+        weather_cache.set(key, weather_data)
+        return 200, {"weather": weather_data}, "success"
+    if budget.expired(deadline.DEADLINE_MIN_STAGE):
+        return 504, {"error": "Истёк срок запроса"}, "deadline_exceeded"
+    return 500, {"error": "Не удалось получить погоду"}, "failed"
+
+
+def serve_in_process(city: str, client_ip: str) -> tuple:
+    """Вызов из geoservice при WEATHER_MODE=inprocess: (статус, тело ответа).
+
+    Тот же результат и та же запись в лог, что у POST /api/weather, но без
+    HTTP и JSON. Бюджет и трасса — текущего запроса geoservice: этапы cache и
+    openweather попадают в его timings_ms.
+    """
+    start = time.perf_counter()
+    budget = deadline.current() or deadline.Deadline(OPENWEATHER_TIMEOUT)
+    city = city.strip()
+    status, body, api_response = weather_for_city(city, budget)
+    message, level = RESULT_LOG[api_response]
+    logger.log(
+        level,
+        message,
+        extra={
+            "client_ip": client_ip,
+            "request_target": "inprocess",
+            "requested_city": city,
+            "response_status": status,
+            "response_data": json.dumps(body, ensure_ascii=False),
+            "api_response": api_response,
+            "duration_ms": round((time.perf_counter() - start) * 1000, 2),
+        },
+    )
+    return status, body
+
+
+# --- Быстрый путь: OPTIONS, /healthz, /readyz ---
+fast_path = FastPath(
+    "POST, OPTIONS",
+    options_status=200,
+    ready_check=lambda: bool(API_KEY),
+    logger=logger,
+)
+# GET /metrics: запросы, задержка, этапы cache и openweather
+metrics.install(fast_path)
+# GET /debug/profile и /debug/memory: только при заданном PROFILE_TOKEN
+profiling.install(fast_path)
+memory.install(fast_path)
+
+
+class WeatherHandler(
+    profiling.ProfiledHandler,
+    metrics.InstrumentedHandler,
+    http.server.BaseHTTPRequestHandler,
+):
+    # HTTP/1.1: geoservice держит пул keep-alive соединений
+    protocol_version = "HTTP/1.1"
+    timeout = KEEPALIVE_TIMEOUT
+
+    def do_POST(self):
+        # Продолжаем трассу geoservice (X-Request-ID, traceparent)
+        trace = tracing.start(self.headers)
+        budget = deadline.start(self.headers, OPENWEATHER_TIMEOUT)
+        client_ip = self.client_address[0]
+        request_target = self.path
 
         content_length = int(self.headers.get("Content-Length", 0))
         post_data = self.rfile.read(content_length).decode("utf-8")
@@ -277,88 +346,55 @@ class WeatherHandler(http.server.BaseHTTPRequestHandler):
             if not city:
                 raise ValueError("Поле 'city' пустое")
         except (json.JSONDecodeError, ValueError) as e:
-            logger.error(
-                f"Неверный JSON или отсутствует city: {e}",
-                extra={
-                    "client_ip": client_ip,
-                    "request_target": request_target,
-                    "requested_city": "invalid_json",
-                    "response_status": 400,
-                    "response_data": '{"error": "Неверный JSON или отсутствует поле city"}',
-                    "api_response": "invalid_json",
-                    "duration_ms": int((time.time() - start_time) * 1000),
-                    "request_id": request_id,
-                },
+            response_body = json.dumps(
+                {"error": "Неверный JSON или отсутствует поле city"},
+                ensure_ascii=False,
             )
-            self.send_response(400)
-            self.send_header("Content-Type", "application/json")
-            self.end_headers()
-            self.wfile.write(
-                json.dumps(
-                    {"error": "Неверный JSON или отсутствует поле city"},
-                    ensure_ascii=False,
-                ).encode("utf-8")
+            self._send_json(400, response_body, trace)
+            tracing.finish(
+                logger,
+                f"Неверный JSON или отсутствует city: {e}",
+                level=logging.ERROR,
+                client_ip=client_ip,
+                request_target=request_target,
+                requested_city="invalid_json",
+                response_status=400,
+                response_data=response_body,
+                api_response="invalid_json",
             )
             return
 
-        logger.info(
-            f"Получен город от geo-service: {city}",
-            extra={
-                "client_ip": client_ip,
-                "request_target": request_target,
-                "requested_city": city,
-                "response_status": 200,
-                "response_data": "ok",
-                "api_response": "city_received",
-                "duration_ms": int((time.time() - start_time) * 1000),
-                "request_id": request_id,
-            },
+        status, body, api_response = weather_for_city(city, budget)
+        response_body = json.dumps(body, ensure_ascii=False)
+        self._send_json(status, response_body, trace)
+        # Одна сводная запись на запрос: этапы (cache, openweather) в timings_ms
+        message, level = RESULT_LOG[api_response]
+        tracing.finish(
+            logger,
+            message,
+            level=level,
+            client_ip=client_ip,
+            request_target=request_target,
+            requested_city=city,
+            response_status=status,
+            response_data=response_body,
+            api_response=api_response,
         )
 
-        weather_data = fetch_weather(city)
-
-        if weather_data:
-            self.send_response(200)
-            self.send_header("Content-Type", "application/json")
-            self.end_headers()
-            response_body = json.dumps({"weather": weather_data}, ensure_ascii=False)
-            self.wfile.write(response_body.encode("utf-8"))
-            logger.info(
-                "Отправлен ответ с погодой",
-                extra={
-                    "client_ip": client_ip,
-                    "request_target": request_target,
-                    "requested_city": city,
-                    "response_status": 200,
-                    "response_data": response_body,
-                    "api_response": "success",
-                    "duration_ms": int((time.time() - start_time) * 1000),
-                    "request_id": request_id,
-                },
-            )
-        else:
-            self.send_response(500)
-            self.send_header("Content-Type", "application/json")
-            self.end_headers()
-            response_body = json.dumps(
-                {"error": "Не удалось получить погоду"}, ensure_ascii=False
-            )
-            self.wfile.write(response_body.encode("utf-8"))
-            logger.error(
-                "Не удалось получить погоду",
-                extra={
-                    "client_ip": client_ip,
-                    "request_target": request_target,
-                    "requested_city": city,
-                    "response_status": 500,
-                    "response_data": response_body,
-                    "api_response": "failed",
-                    "duration_ms": int((time.time() - start_time) * 1000),
-                    "request_id": request_id,
-                },
-            )
+    def _send_json(self, status, body, trace):
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header(tracing.REQUEST_ID_HEADER, trace.request_id)
+        tracing.send_server_timing(self)
+        body = body.encode("utf-8")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
 
     def do_GET(self):
+        if fast_path.handle(self):
+            return
+
         client_ip = self.client_address[0]
         logger.warning(
             "Попытка GET-запроса к weather-service (запрещено)",
@@ -373,35 +409,24 @@ class WeatherHandler(http.server.BaseHTTPRequestHandler):
                 "request_id": str(uuid.uuid4()),
             },
         )
+        body = json.dumps(
+            {"error": "Метод не поддерживается"}, ensure_ascii=False
+        ).encode("utf-8")
         self.send_response(405)
         self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(body)))
         self.end_headers()
-        self.wfile.write(
-            json.dumps({"error": "Метод не поддерживается"}, ensure_ascii=False).encode(
-                "utf-8"
-            )
-        )
+        self.wfile.write(body)
 
     def do_OPTIONS(self):
-        client_ip = self.client_address[0]
-        self.send_response(200)
-        self.send_header("Access-Control-Allow-Origin", "*")
-        self.send_header("Access-Control-Allow-Methods", "POST, OPTIONS")
-        self.send_header("Access-Control-Allow-Headers", "Content-Type")
-        self.end_headers()
-        logger.info(
-            "CORS preflight ответ",
-            extra={
-                "client_ip": client_ip,
-                "request_target": self.path,
-                "requested_city": "cors",
-                "response_status": 200,
-                "response_data": "{}",
-                "api_response": "cors_allowed",
-                "duration_ms": 0,
-                "request_id": str(uuid.uuid4()),
-            },
-        )
+        fast_path.handle(self)
+
+
+class WeatherServer(socketserver.ThreadingMixIn, socketserver.TCPServer):
+    """Поток на соединение: простаивающее keep-alive соединение из пула
+    geoservice не блокирует остальные"""
+
+    daemon_threads = True
 
 
 # Запуск сервера
@@ -411,22 +436,41 @@ if __name__ == "__main__":
         "Сервер weather-service запускается с настройками:",
         extra={
             "port": PORT,
+            "unix_socket": UNIX_SOCKET,
             "log_dir": LOG_DIR,
             "log_file": LOG_FILE,
             "log_level": logging.getLevelName(LOG_LEVEL),
             "openweather_url": OPENWEATHER_URL,
+            "openweather_timeout": OPENWEATHER_TIMEOUT,
             "api_key_set": bool(API_KEY),
             "api_key_masked": "*" * len(API_KEY) if API_KEY else "not_set",
         },
     )
 
-    server_address = ("", PORT)
-    httpd = socketserver.TCPServer(server_address, WeatherHandler)
-    print(f"🌐 weather-service запущен на порту {PORT}")
-    logger.info(f"Сервер weather-service запущен на порту {PORT}")
-
-    try:
-        httpd.serve_forever()
-    except KeyboardInterrupt:
+    server_address = UNIX_SOCKET or ("", PORT)
+    server_class = unix_socket.server_class(WeatherServer, UNIX_SOCKET)
+    listen_on = UNIX_SOCKET or f"порту {PORT}"
+    workers = prefork.worker_count()
+    if workers > 1:
+        print(f"🌐 weather-service запущен на {listen_on}, воркеров: {workers}")
+        logger.info(
+            f"Сервер weather-service запущен на {listen_on}",
+            extra={"workers": workers},
+        )
+        prefork.serve(
+            functools.partial(server_class, RequestHandlerClass=WeatherHandler),
+            server_address,
+            workers,
+            logger=logger,
+        )
         logger.info("Сервер weather-service остановлен")
-        httpd.server_close()
+    else:
+        httpd = server_class(server_address, WeatherHandler)
+        print(f"🌐 weather-service запущен на {listen_on}")
+        logger.info(f"Сервер weather-service запущен на {listen_on}")
+
+        try:
+            httpd.serve_forever()
+        except KeyboardInterrupt:
+            logger.info("Сервер weather-service остановлен")
+            httpd.server_close()